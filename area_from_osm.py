@@ -1,90 +1,116 @@
 import argparse
+import concurrent.futures
 import datetime
-import requests
-import sqlite3
 
+import numpy as np
 import shapely
 import tqdm
 
 import feature
 import database
+import osm_extract
+import overpass
 import util
 
 
 zoom_level = 18
-
-
-def run_overpass_query(query):
-    overpass_url = "https://overpass-api.de/api/interpreter"
-    params = {'data': query}
-    headers = {'User-Agent': 'zidel'}
-    request = requests.get(overpass_url,
-                           params=params,
-                           headers=headers)
-    request.raise_for_status()
-    return request.text
-
-
-def intersect_way_with_tile(db, way, tile):
-    way_poly = shapely.Polygon([(node['lat'], node['lon'])
-                                for node in way['nodes']])
-
-    tile_min_lat, tile_min_lon = util.tile2deg(tile['x'], tile['y'], zoom_level)
-    tile_max_lat, tile_max_lon = util.tile2deg(tile['x'] + 1, tile['y'] + 1, zoom_level)
-    tile_poly = shapely.Polygon([
-        (tile_min_lat, tile_min_lon),
-        (tile_min_lat, tile_max_lon),
-        (tile_max_lat, tile_max_lon),
-        (tile_max_lat, tile_min_lon),
-        ])
-
-    intersect = way_poly.intersection(tile_poly)
-    return intersect.area * 1e9
+earth_radius = 6371008.8
+# Scores are square metres, where 'OSM' scores were the covered fraction of
+# the tile, so they get their own version
+model_version = 'OSM-m2'
+
+
+def project(lat, lon):
+    """Lambert cylindrical equal-area projection, areas come out in m^2"""
+    x = earth_radius * np.radians(lon)
+    y = earth_radius * np.sin(np.radians(lat))
+    return x, y
+
+
+def tile_edges(min_tile, max_tile):
+    """Projected coordinates of the tile edges from min_tile to max_tile + 1,
+    for both axes"""
+    n = 2 ** zoom_level
+    x = np.arange(min_tile[0], max_tile[0] + 2)
+    y = np.arange(min_tile[1], max_tile[1] + 2)
+    lon = x / n * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * y / n))))
+    return project(lat, lon)
+
+
+def way_tile_areas(coordinates):
+    """Area of the way with node coordinates (lat, lon) inside each tile it
+    overlaps, as (x, y, area) arrays"""
+    lat, lon = coordinates
+    if len(lat) < 4:
+        return np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0)
+
+    way_poly = shapely.make_valid(shapely.Polygon(np.column_stack(
+        project(lat, lon))))
+    shapely.prepare(way_poly)
+
+    min_tile = util.deg2tile(lat.max(), lon.min(), zoom_level)
+    max_tile = util.deg2tile(lat.min(), lon.max(), zoom_level)
+    edge_x, edge_y = tile_edges(min_tile, max_tile)
+
+    # Tile y grows southwards, so the top edge is the larger projected y
+    x, y = np.meshgrid(np.arange(max_tile[0] - min_tile[0] + 1),
+                       np.arange(max_tile[1] - min_tile[1] + 1))
+    x = x.ravel()
+    y = y.ravel()
+    boxes = shapely.box(edge_x[x], edge_y[y + 1], edge_x[x + 1], edge_y[y])
+
+    overlapping = shapely.intersects(way_poly, boxes)
+    areas = shapely.area(shapely.intersection(way_poly,
+                                              boxes[overlapping]))
+    return (x[overlapping] + min_tile[0],
+            y[overlapping] + min_tile[1],
+            areas)
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--database', default='data/tiles.db')
-    parser.add_argument('--cutoff', default=0.0, type=float)
+    parser.add_argument('--cutoff', default=0.0, type=float,
+                        help='Minimum area in square metres')
     parser.add_argument('--feature', type=str, required=True)
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--extract', type=str,
+                        help='Read a local .osm.pbf or .osm file instead of '
+                             'querying Overpass')
     args = parser.parse_args()
 
     now = datetime.datetime.now()
     timestamp = now.isoformat()
 
     db = database.Database(args.database)
-    overpass_query = feature.overpass_query(args.feature)
-    overpass_raw_data = run_overpass_query(overpass_query)
-    overpass_ways = util.ways_from_overpass_data(overpass_raw_data)
+    if args.extract is not None:
+        osm = osm_extract.load(args.extract, args.feature)
+    else:
+        osm = overpass.Client().load(feature.overpass_query(args.feature))
 
     tile_scores = {}
-    for way in overpass_ways:
-        bbox = util.bbox_from_way(way)
-        min_x, min_y = util.deg2tile(bbox['max_lat'], bbox['min_lon'], zoom_level)
-        max_x, max_y = util.deg2tile(bbox['min_lat'], bbox['max_lon'], zoom_level)
-
-        for x in range(min_x, max_x + 1):
-            for y in range(min_y, max_y + 1):
-                area = intersect_way_with_tile(db, way, {'x': x, 'y': y})
-                try:
-                    tile_scores[(x, y)] += area
-                except KeyError:
-                    tile_scores[(x, y)] = area
+    with concurrent.futures.ProcessPoolExecutor(args.workers) as executor:
+        results = executor.map(way_tile_areas, osm.ways(), chunksize=16)
+        for x, y, areas in tqdm.tqdm(results, total=len(osm.way_ids)):
+            for position, area in zip(zip(x.tolist(), y.tolist()),
+                                      areas.tolist()):
+                tile_scores[position] = tile_scores.get(position, 0.0) + area
 
     with db.transaction('write_area_from_osm') as c:
         for x, y in tqdm.tqdm(tile_scores):
             database.add_tile(c, zoom_level, x, y)
-            area = tile_scores[(x, y)]
-            if area < args.cutoff:
-                continue
-
-            for tile_hash in database.get_tile_hash(c, zoom_level, x, y):
-                database.write_score(c,
-                                     tile_hash,
-                                     args.feature,
-                                     area,
-                                     'OSM',
-                                     timestamp)
+
+        covered = [position for position, area in tile_scores.items()
+                   if area >= args.cutoff]
+        database.write_scores(c, [(tile_hash,
+                                   args.feature,
+                                   tile_scores[(x, y)],
+                                   model_version,
+                                   timestamp)
+                                  for x, y, tile_hash
+                                  in database.tile_hashes_at(c, zoom_level,
+                                                             covered)])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,133 @@
+import argparse
+import concurrent.futures
+import functools
+import hashlib
+import io
+import logging
+import pathlib
+import sys
+
+import PIL.Image
+import tqdm
+
+import database
+import util
+
+
+base_zoom = 18
+tile_size = 256
+missing_colour = (128, 128, 128)
+write_batch_size = 1000
+
+
+def children_digest(children):
+    h = hashlib.sha256()
+    h.update(','.join([tile_hash or '' for tile_hash in children]).encode())
+    return h.hexdigest()
+
+
+def downsample(source_dir, output_dir, children):
+    """Stitches the four children (top left, top right, bottom left, bottom
+    right) and halves the result, stored content addressed in output_dir"""
+    image = PIL.Image.new('RGB', (2 * tile_size, 2 * tile_size),
+                          missing_colour)
+    for index, tile_hash in enumerate(children):
+        if tile_hash is None:
+            continue
+
+        try:
+            with PIL.Image.open(util.tile_to_paths(source_dir,
+                                                   tile_hash)) as child:
+                image.paste(child.convert('RGB'),
+                            ((index % 2) * tile_size,
+                             (index // 2) * tile_size))
+        except OSError as e:
+            logging.debug(f'Failed to read {tile_hash}', exc_info=e)
+
+    output = io.BytesIO()
+    image.reduce(2).save(output, format='JPEG', quality=85)
+    data = output.getvalue()
+
+    tile_hash = hashlib.sha256(data).hexdigest()
+    path = util.tile_to_paths(output_dir, tile_hash)
+    if not path.exists():
+        path.parent.mkdir(exist_ok=True, parents=True)
+        partial_path = path.with_suffix('.partial')
+        with open(partial_path, 'wb') as f:
+            f.write(data)
+        partial_path.rename(path)
+
+    return tile_hash
+
+
+def group_children(children):
+    parents = {}
+    for (x, y), tile_hash in children.items():
+        quadrants = parents.setdefault((x >> 1, y >> 1), [None] * 4)
+        quadrants[(y & 1) * 2 + (x & 1)] = tile_hash
+    return parents
+
+
+def build_level(db, executor, z, tile_path, output_dir):
+    with db.transaction('get_overview_children') as c:
+        if z + 1 == base_zoom:
+            children = database.latest_tile_hashes_at_zoom(c, base_zoom)
+        else:
+            children = {position: tile_hash
+                        for position, (tile_hash, _)
+                        in database.overview_tiles(c, z + 1).items()}
+        existing = database.overview_tiles(c, z)
+
+    source_dir = tile_path if z + 1 == base_zoom else output_dir
+
+    parents = group_children(children)
+    dirty = []
+    for (x, y), quadrants in parents.items():
+        digest = children_digest(quadrants)
+        _, old_digest = existing.get((x, y), (None, None))
+        if digest != old_digest:
+            dirty.append((x, y, quadrants, digest))
+
+    print(f'z{z}: {len(dirty)} of {len(parents)} tiles changed')
+
+    results = executor.map(
+            functools.partial(downsample, source_dir, output_dir),
+            [quadrants for _, _, quadrants, _ in dirty],
+            chunksize=32)
+
+    batch = []
+    for (x, y, _, digest), tile_hash in tqdm.tqdm(zip(dirty, results),
+                                                  total=len(dirty)):
+        batch.append((z, x, y, tile_hash, digest))
+        if len(batch) >= write_batch_size:
+            with db.transaction('write_overview_tiles') as c:
+                database.write_overview_tiles(c, batch)
+            batch = []
+
+    if batch:
+        with db.transaction('write_overview_tiles') as c:
+            database.write_overview_tiles(c, batch)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--database', default='data/tiles.db')
+    parser.add_argument('--tile-path', type=str, default='data/images')
+    parser.add_argument('--output', type=str, default='data/overviews')
+    parser.add_argument('--min-zoom', type=int, default=10)
+    parser.add_argument('--workers', type=int)
+    args = parser.parse_args()
+
+    db = database.Database(args.database)
+    tile_path = pathlib.Path(args.tile_path)
+    output_dir = pathlib.Path(args.output)
+
+    with concurrent.futures.ProcessPoolExecutor(args.workers) as executor:
+        for z in range(base_zoom - 1, args.min_zoom - 1, -1):
+            build_level(db, executor, z, tile_path, output_dir)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,165 @@
+import datetime
+import math
+import sqlite3
+import time
+
+import numpy as np
+
+import database
+import evaluation
+
+
+# Tiles are scored in chunks of this many, so stage scores reach the database
+# regularly
+chunk_size = 1000
+# Score recorded for tiles the screen rejects. Their screen score stays in
+# stage_scores, it is on another scale than the full model
+rejected_score = 0.0
+
+
+def calibrate_threshold(labels, scores, max_recall_loss):
+    """Highest screen threshold that loses at most max_recall_loss of the
+    positives, as (threshold, recall, pass rate)"""
+    if not 0.0 <= max_recall_loss < 1.0:
+        raise ValueError(f'max_recall_loss must be in [0, 1), not '
+                         f'{max_recall_loss}')
+
+    labels = np.asarray(labels, dtype=bool)
+    scores = np.asarray(scores, dtype=np.float64)
+    if not labels.any():
+        raise ValueError('Need at least one positive tile to calibrate')
+
+    positive_scores = np.sort(scores[labels])
+    lost = int(math.floor(max_recall_loss * len(positive_scores)))
+    threshold = float(positive_scores[lost])
+
+    recall = float((positive_scores >= threshold).mean())
+    pass_rate = float((scores >= threshold).mean())
+    return threshold, recall, pass_rate
+
+
+def load_image(path):
+    import tensorflow
+
+    data = tensorflow.io.read_file(path)
+    data = tensorflow.io.decode_jpeg(data, channels=3)
+    return tensorflow.cast(data, tensorflow.float32)
+
+
+def predict(m, image_dir, tile_hashes, batch_size):
+    """Scores of m for the tiles, as a float array"""
+    import tensorflow
+
+    if not tile_hashes:
+        return np.zeros(0)
+
+    paths = [str(image_dir / f'{tile_hash[:2]}/{tile_hash[2:]}.jpeg')
+             for tile_hash in tile_hashes]
+    dataset = tensorflow.data.Dataset.from_tensor_slices(paths)
+    dataset = dataset.map(load_image,
+                          num_parallel_calls=tensorflow.data.AUTOTUNE)
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.prefetch(tensorflow.data.AUTOTUNE)
+
+    return m.predict(dataset, verbose=0).reshape(-1).astype(np.float64)
+
+
+def calibrate(db, image_dir, feature_name, screen_model, screen_version,
+              max_recall_loss, batch_size, tiles, labels_digest):
+    """Picks and stores the screen threshold for feature_name from labelled
+    (tile_hash, label) validation tiles"""
+    if not tiles:
+        raise RuntimeError(f'No labelled validation tiles for {feature_name}')
+
+    tile_hashes, labels = zip(*tiles)
+    scores = predict(screen_model, image_dir, list(tile_hashes), batch_size)
+    threshold, recall, pass_rate = calibrate_threshold(labels, scores,
+                                                       max_recall_loss)
+
+    with db.transaction('write_cascade_threshold') as c:
+        database.write_cascade_threshold(
+                c, feature_name, screen_version, max_recall_loss,
+                labels_digest, threshold, recall, pass_rate,
+                datetime.datetime.now().isoformat())
+
+    print(f'Screen threshold {threshold:.4f}: {recall:.1%} recall, '
+          f'{pass_rate:.1%} of validation tiles go to the full model')
+    return threshold
+
+
+def get_threshold(db, image_dir, feature_name, screen_model, screen_version,
+                  max_recall_loss, batch_size):
+    """The stored threshold, unless it was calibrated for another recall
+    loss or other validation labels"""
+    with db.transaction('get_cascade_threshold') as c:
+        tiles = [(tile_hash, label)
+                 for tile_hash, label, _
+                 in database.validation_tiles(c, feature_name)
+                 if label is not None]
+        labels_digest = evaluation.digest(tiles)
+        stored = database.get_cascade_threshold(c, feature_name,
+                                                screen_version,
+                                                max_recall_loss,
+                                                labels_digest)
+    if stored is not None:
+        return stored[0]
+    return calibrate(db, image_dir, feature_name, screen_model,
+                     screen_version, max_recall_loss, batch_size, tiles,
+                     labels_digest)
+
+
+def version(full_version, screen_version):
+    """Model version recorded for scores from the cascade"""
+    return f'{full_version}/{screen_version}'
+
+
+def score(db, image_dir, feature_name, screen_model, screen_version,
+          full_model, full_version, threshold, batch_size, tiles):
+    """Screens (tile_hash, previous score) tiles and runs the full model on
+    the ones that pass. Returns (screened, passed) counts"""
+    cascade_version = version(full_version, screen_version)
+    screened = 0
+    passed = 0
+
+    for start in range(0, len(tiles), chunk_size):
+        tile_hashes = [tile[0] for tile in tiles[start:start + chunk_size]]
+        screen_scores = predict(screen_model, image_dir, tile_hashes,
+                                batch_size)
+
+        keep = screen_scores >= threshold
+        passing = [tile_hash
+                   for tile_hash, k in zip(tile_hashes, keep.tolist())
+                   if k]
+        full_scores = predict(full_model, image_dir, passing, batch_size)
+
+        final_scores = np.full(len(tile_hashes), rejected_score)
+        final_scores[keep] = full_scores
+
+        timestamp = datetime.datetime.now().isoformat()
+        while True:
+            try:
+                with db.transaction('write_cascade_scores') as c:
+                    database.write_stage_scores(
+                            c, feature_name, 'screen', screen_version,
+                            timestamp,
+                            list(zip(tile_hashes, screen_scores.tolist())))
+                    database.write_stage_scores(
+                            c, feature_name, 'full', full_version, timestamp,
+                            list(zip(passing, full_scores.tolist())))
+                    database.write_scores(
+                            c,
+                            [(tile_hash, feature_name, s, cascade_version,
+                              timestamp)
+                             for tile_hash, s
+                             in zip(tile_hashes, final_scores.tolist())])
+                break
+            except sqlite3.OperationalError as e:
+                if database.temporary_error(e):
+                    time.sleep(1)
+                    continue
+                raise
+
+        screened += len(tile_hashes)
+        passed += len(passing)
+
+    return screened, passed
@@ -0,0 +1,159 @@
+import json
+
+import numpy as np
+
+import util
+
+
+# Half of the 8-neighbourhood, the other half is covered from the other end
+neighbour_offsets = [(1, -1), (1, 0), (1, 1), (0, 1)]
+
+
+class Site(object):
+    def __init__(self, z, min_x, min_y, max_x, max_y, tile_count, area):
+        self.z = z
+        self.min_x = min_x
+        self.min_y = min_y
+        self.max_x = max_x
+        self.max_y = max_y
+        self.tile_count = tile_count
+        self.area = area
+
+    def bbox(self):
+        north, west = util.tile2deg(self.min_x, self.min_y, self.z)
+        south, east = util.tile2deg(self.max_x + 1, self.max_y + 1, self.z)
+        return {'north': north, 'west': west, 'south': south, 'east': east}
+
+    def centre(self):
+        bbox = self.bbox()
+        return ((bbox['north'] + bbox['south']) / 2,
+                (bbox['west'] + bbox['east']) / 2)
+
+
+def connected_components(x, y):
+    """Labels 8-connected components of the tiles at x, y.
+
+    Returns (keys, labels) where keys are the sorted packed positions and
+    labels[i] is the smallest index in keys of the component keys[i] is in.
+    """
+    keys = np.unique(util.pack_positions(x, y))
+    x, y = util.unpack_positions(keys)
+    count = len(keys)
+
+    edges_a = []
+    edges_b = []
+    for dx, dy in neighbour_offsets:
+        neighbour_keys = util.pack_positions(x + dx, y + dy)
+        index = np.minimum(np.searchsorted(keys, neighbour_keys), count - 1)
+        found = keys[index] == neighbour_keys
+        edges_a.append(np.flatnonzero(found))
+        edges_b.append(index[found])
+    edges_a = np.concatenate(edges_a)
+    edges_b = np.concatenate(edges_b)
+
+    # Vectorized union-find: hook the larger root of every edge onto the
+    # smaller one, then compress paths fully, until every edge is inside one
+    # tree. Parents only ever point to smaller indices, so there are no cycles.
+    parent = np.arange(count)
+    while True:
+        root_a = parent[edges_a]
+        root_b = parent[edges_b]
+        differ = root_a != root_b
+        if not differ.any():
+            break
+
+        low = np.minimum(root_a[differ], root_b[differ])
+        high = np.maximum(root_a[differ], root_b[differ])
+        np.minimum.at(parent, high, low)
+
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+
+    return keys, parent
+
+
+def find_sites(z, x, y, area_keys=None, area_scores=None):
+    """Groups positive tiles into sites, largest first.
+
+    area_keys/area_scores are packed positions with an area score each, the
+    area of a site is the sum over its tiles.
+    """
+    if len(x) == 0:
+        return []
+
+    keys, labels = connected_components(x, y)
+    roots, component = np.unique(labels, return_inverse=True)
+    x, y = util.unpack_positions(keys)
+
+    tile_count = np.bincount(component)
+    min_x = np.full(len(roots), np.iinfo(np.int64).max)
+    min_y = np.full(len(roots), np.iinfo(np.int64).max)
+    max_x = np.full(len(roots), -1)
+    max_y = np.full(len(roots), -1)
+    np.minimum.at(min_x, component, x)
+    np.minimum.at(min_y, component, y)
+    np.maximum.at(max_x, component, x)
+    np.maximum.at(max_y, component, y)
+
+    area = np.zeros(len(roots))
+    if area_keys is not None and len(area_keys) > 0:
+        order = np.argsort(area_keys)
+        area_keys = np.asarray(area_keys)[order]
+        area_scores = np.asarray(area_scores, dtype=np.float64)[order]
+        index = np.minimum(np.searchsorted(area_keys, keys),
+                           len(area_keys) - 1)
+        found = area_keys[index] == keys
+        area = np.bincount(component[found],
+                           weights=area_scores[index[found]],
+                           minlength=len(roots))
+
+    sites = [Site(z,
+                  int(min_x[i]),
+                  int(min_y[i]),
+                  int(max_x[i]),
+                  int(max_y[i]),
+                  int(tile_count[i]),
+                  float(area[i]))
+             for i in range(len(roots))]
+    sites.sort(key=lambda site: site.tile_count, reverse=True)
+    return sites
+
+
+def write_gpx(sites, f):
+    f.write('<gpx creator="{}" version="1.0">\n'.format(
+        'https://github.com/zidel/solar_panels'))
+    for site in sites:
+        lat, lon = site.centre()
+        f.write('<wpt lat="{}" lon="{}"><name>{} tiles, area {:.0f}</name>'
+                '</wpt>\n'.format(lat, lon, site.tile_count, site.area))
+    f.write('</gpx>\n')
+
+
+def write_geojson(sites, f):
+    f.write('{"type": "FeatureCollection", "features": [\n')
+    for i, site in enumerate(sites):
+        bbox = site.bbox()
+        feature = {
+                'type': 'Feature',
+                'geometry': {
+                    'type': 'Polygon',
+                    'coordinates': [[
+                        [bbox['west'], bbox['north']],
+                        [bbox['east'], bbox['north']],
+                        [bbox['east'], bbox['south']],
+                        [bbox['west'], bbox['south']],
+                        [bbox['west'], bbox['north']],
+                        ]],
+                    },
+                'properties': {
+                    'tile_count': site.tile_count,
+                    'area': site.area,
+                    },
+                }
+        if i > 0:
+            f.write(',\n')
+        f.write(json.dumps(feature))
+    f.write('\n]}\n')
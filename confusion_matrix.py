@@ -1,29 +1,14 @@
 import argparse
+import datetime
 import pathlib
 import sys
 
-import tensorflow
-
 import database
+import evaluation
 import feature
-import model
-import score_tiles
 import util
 
 
-def load_image_from_path(input_path, channels):
-    input_data = tensorflow.io.read_file(input_path)
-    input_data = tensorflow.io.decode_jpeg(input_data, channels=channels)
-    input_data = tensorflow.cast(input_data, tensorflow.float32)
-    input_data = tensorflow.keras.applications.vgg19.preprocess_input(
-            input_data)
-    return input_data
-
-
-def load_nib_data(path):
-    return load_image_from_path(path, 3)
-
-
 def print_matrix(matrix):
     results = {
             'false': {
@@ -61,9 +46,9 @@ def print_matrix(matrix):
     all_pred_positive = int(matrix[0][2] + matrix[1][2] + matrix[2][2])
     all_real_positive = int(sum(matrix[2]))
 
-    precision = true_positives / all_pred_positive
-    recall = true_positives / all_real_positive
-    f_score = (2 * precision * recall) / (precision + recall)
+    precision = true_positives / max(all_pred_positive, 1)
+    recall = true_positives / max(all_real_positive, 1)
+    f_score = (2 * precision * recall) / max(precision + recall, 1e-9)
 
     print()
     print('Positive accuracy: {:.0f}%'.format(
@@ -74,84 +59,76 @@ def print_matrix(matrix):
         100 * f_score))
 
 
-def print_num_positive_in_top(tiles, to_check, prefix):
-    tiles.sort(key=lambda t: t[2], reverse=True)
-    tiles = tiles[:to_check]
+def print_num_positive_in_top(top, prefix):
+    if top['unknown']:
+        print(f'  {prefix}: Review {top["unknown"]} more tiles')
+    else:
+        print(f'  {prefix}: {top["positive"]}')
+
 
-    try:
-        num_solar = sum([t[1] for t in tiles])
-        print(f'  {prefix}: {num_solar}')
-    except TypeError:
-        num_missing = sum([1 if t[1] is None else 0 for t in tiles])
-        print(f'  {prefix}: Review {num_missing} more tiles')
+def print_report(report):
+    print_matrix(report['matrix'])
+    if report['best_threshold'] is not None:
+        print('    Best F-score: {:.0f}% at {:.3f}, {:.0f}% accuracy, '
+              '{:.0f}% coverage'.format(
+                  100 * report['best_f1'],
+                  report['best_threshold'],
+                  100 * report['best_precision'],
+                  100 * report['best_recall']))
+    print('         ROC AUC: {:.3f}'.format(report['roc_auc']))
+    print('   Avg precision: {:.3f}'.format(report['average_precision']))
+
+    print()
+    for count in evaluation.top_counts:
+        label = f'{count // 1000}k' if count >= 1000 else str(count)
+        print_num_positive_in_top(report['top'][str(count)],
+                                  f'Feature in top {label}')
+
+
+def score_missing(db, args, model_version, tile_hashes):
+    """Scores validation tiles model_version hasn't seen, this is the only
+    part that needs TensorFlow"""
+    import cascade
+    import model
+
+    image_dir = pathlib.Path(args.tile_path)
+    m, _ = model.load_for_scoring(args.model,
+                                  feature.result_type(args.feature),
+                                  args.load_model)
+    scores = cascade.predict(m, image_dir, tile_hashes, args.batch_size)
+    predictions = list(zip(tile_hashes, scores.tolist()))
+
+    timestamp = datetime.datetime.now().isoformat()
+    with db.transaction('write_validation_predictions') as c:
+        database.write_validation_predictions(c, args.feature, model_version,
+                                              predictions)
+        database.write_scores(c, [(tile_hash, args.feature, score,
+                                   model_version, timestamp)
+                                  for tile_hash, score in predictions])
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--database', default='data/tiles.db')
     parser.add_argument('--model', default='VGG19')
-    parser.add_argument('--load-model', default='data/model.hdf5')
-    parser.add_argument('--NiB-key', type=str, default="secret/NiB_key.json")
+    parser.add_argument('--load-model', default='data/model.hdf5',
+                        help='Weights file or model from export_model.py')
+    parser.add_argument('--NiB-key', type=str, default="secret/NiB_key.json",
+                        help='Unused, kept for old command lines')
     parser.add_argument('--tile-path', type=str, default="data/images")
-    parser.add_argument('--batch-size', default=10, type=int)
+    parser.add_argument('--batch-size', default=64, type=int)
     parser.add_argument('--feature', type=str, required=True)
     args = parser.parse_args()
 
     db = database.Database(args.database)
-    model_version = util.hash_file(args.load_model)
-    nib_api_key = util.load_key(args.NiB_key)
-    image_dir = pathlib.Path(args.tile_path)
+    model_version = util.model_version(args.load_model)
+
+    missing = evaluation.missing_predictions(db, args.feature, model_version)
+    if missing:
+        print(f'Scoring {len(missing)} validation tiles')
+        score_missing(db, args, model_version, missing)
 
-    with db.transaction('get_validation_tiles_for_scoring') as c:
-        tiles_for_scoring = database.validation_tiles_for_scoring(
-                c, model_version, args.feature)
-
-    progress = score_tiles.Progress()
-    progress.remaining(len(tiles_for_scoring))
-    try:
-        score_tiles.score_tiles(
-                db,
-                image_dir,
-                nib_api_key,
-                args.feature,
-                progress,
-                model.get(args.model,
-                          feature.result_type(args.feature),
-                          args.load_model),
-                model_version,
-                args.batch_size,
-                None,
-                tiles_for_scoring)
-    finally:
-        progress.clear()
-
-    with db.transaction('get_validation_tiles') as c:
-        tiles = database.validation_tiles(c, args.feature)
-
-    tiles = [tile for tile in tiles if tile[2] is not None]
-
-    labels = []
-    predictions = []
-    for _, has_solar, score in tiles:
-        if has_solar is None:
-            labels.append(1)
-        elif has_solar:
-            labels.append(2)
-        else:
-            labels.append(0)
-
-        if score < 0.1:
-            predictions.append(0)
-        elif score < 0.9:
-            predictions.append(1)
-        else:
-            predictions.append(2)
-
-    matrix = tensorflow.math.confusion_matrix(labels, predictions)
-    print_matrix(matrix)
-    print_num_positive_in_top(tiles, 100, 'Feature in top 100')
-    print_num_positive_in_top(tiles, 250, 'Feature in top 250')
-    print_num_positive_in_top(tiles, 1000, 'Feature in top 1k')
+    print_report(evaluation.evaluate(db, args.feature, model_version))
 
     return 0
 
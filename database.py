@@ -1,12 +1,17 @@
 import datetime
 import logging
+import math
 import sqlite3
 
 import feature
+import util
 
 
 log = logging.getLogger('database')
 
+# Versions of scores that were set by hand or imported rather than predicted
+pseudo_model_versions = ('OSM', 'OSM-m2', 'neighbour')
+
 
 def temporary_error(sqlite_exception):
     temporary_errors = [
@@ -72,6 +77,24 @@ class Database(object):
                              primary key (tile_hash),
                              foreign key (z, x, y) references last_update)
                       ''')
+            c.execute('''create index if not exists tile_positions_by_position
+                         on tile_positions (z, x, y, added)
+                      ''')
+            c.execute('''select count(*)
+                         from sqlite_master
+                         where name = 'tile_bounds'
+                      ''')
+            if c.fetchone()[0] == 0:
+                # Positions are stored as 32 bit floats, rounded outwards
+                c.execute('''create virtual table tile_bounds using rtree (
+                                 id,
+                                 min_lat, max_lat,
+                                 min_lon, max_lon,
+                                 +z integer,
+                                 +x integer,
+                                 +y integer)
+                          ''')
+                rebuild_tile_bounds(c)
             c.execute('''create table if not exists has_feature (
                              tile_hash string not null,
                              feature_name string not null,
@@ -103,6 +126,128 @@ class Database(object):
                              primary key (feature_name, z, x, y),
                              foreign key (z, x, y) references last_update)
                       ''')
+            c.execute('''create table if not exists overview_tiles (
+                             z integer not null,
+                             x integer not null,
+                             y integer not null,
+                             tile_hash string not null,
+                             children string not null,
+                             added string not null,
+                             primary key (z, x, y))
+                      ''')
+            c.execute('''create table if not exists heatmap_renders (
+                             feature_name string not null,
+                             statistic string not null,
+                             timestamp string not null,
+                             primary key (feature_name, statistic))
+                      ''')
+            c.execute('''create table if not exists score_versions (
+                             feature_name string not null,
+                             model_version string not null,
+                             timestamp string not null,
+                             primary key (feature_name, model_version))
+                      ''')
+            # Scores removed or inherited from an earlier tile, neither of
+            # which leaves a new timestamp in scores
+            c.execute('''create table if not exists score_changes (
+                             tile_hash string not null,
+                             feature_name string not null,
+                             timestamp string not null,
+                             primary key (tile_hash, feature_name),
+                             foreign key (tile_hash) references tile_positions)
+                      ''')
+            c.execute('''create table if not exists tile_fingerprints (
+                             tile_hash string not null,
+                             dhash integer not null,
+                             thumbnail blob not null,
+                             primary key (tile_hash),
+                             foreign key (tile_hash) references tile_positions)
+                      ''')
+            c.execute('''create table if not exists recheck_schedule (
+                             z integer not null,
+                             x integer not null,
+                             y integer not null,
+                             due string not null,
+                             priority real not null,
+                             rate real not null,
+                             primary key (z, x, y),
+                             foreign key (z, x, y) references last_update)
+                      ''')
+            c.execute('''create index if not exists recheck_schedule_by_due
+                         on recheck_schedule (due)
+                      ''')
+            c.execute('''create table if not exists download_frontier (
+                             id integer not null,
+                             priority real not null,
+                             primary key (id))
+                      ''')
+            c.execute('''create table if not exists tile_stats (
+                             tile_hash string not null,
+                             file_size integer not null,
+                             variance real not null,
+                             water_fraction real not null,
+                             green_fraction real not null,
+                             primary key (tile_hash),
+                             foreign key (tile_hash) references tile_positions)
+                      ''')
+            c.execute('''create table if not exists trivially_negative (
+                             tile_hash string not null,
+                             feature_name string not null,
+                             reason string not null,
+                             primary key (tile_hash, feature_name),
+                             foreign key (tile_hash) references tile_positions)
+                      ''')
+            c.execute('''create table if not exists stage_scores (
+                             tile_hash string not null,
+                             feature_name string not null,
+                             stage string not null,
+                             score real not null,
+                             model_version string not null,
+                             timestamp string not null,
+                             primary key (tile_hash, feature_name, stage),
+                             foreign key (tile_hash) references tile_positions)
+                      ''')
+            c.execute('''create table if not exists cascade_thresholds (
+                             feature_name string not null,
+                             screen_version string not null,
+                             max_recall_loss real not null,
+                             labels_digest string not null,
+                             threshold real not null,
+                             recall real not null,
+                             pass_rate real not null,
+                             timestamp string not null,
+                             primary key (feature_name, screen_version))
+                      ''')
+            c.execute('''create table if not exists label_log (
+                             id integer primary key,
+                             tile_hash string not null,
+                             feature_name string not null,
+                             timestamp string not null)
+                      ''')
+            c.execute('''create table if not exists fine_tune_state (
+                             feature_name string not null,
+                             last_label_id integer not null,
+                             model_version string not null,
+                             timestamp string not null,
+                             primary key (feature_name))
+                      ''')
+            c.execute('''create table if not exists validation_predictions (
+                             tile_hash string not null,
+                             feature_name string not null,
+                             model_version string not null,
+                             score real not null,
+                             primary key (feature_name, model_version,
+                                          tile_hash),
+                             foreign key (tile_hash) references tile_positions)
+                      ''')
+            c.execute('''create table if not exists evaluation_reports (
+                             feature_name string not null,
+                             model_version string not null,
+                             digest string not null,
+                             report string not null,
+                             timestamp string not null,
+                             primary key (feature_name, model_version))
+                      ''')
             c.execute('''create table if not exists validation_set (
                              feature_name string not null,
                              z integer not null,
@@ -121,18 +266,22 @@ class Database(object):
                            where feature_name = ?
                            )
                        where
-                           model_version is null
-                           or model_version != ?
+                           (model_version is null
+                            or model_version != ?)
+                           and tile_hash not in (
+                               select tile_hash
+                               from trivially_negative
+                               where feature_name = ?)
                        {}
                     '''
         with self.transaction('get_tiles_for_scoring') as c:
             c.execute(query_fmt.format('count(*)', ''),
-                      [feature_name, current_model])
+                      [feature_name, current_model, feature_name])
             count = c.fetchone()[0]
 
             c.execute(query_fmt.format('tile_hash, score',
                                        'order by score desc limit ?'),
-                      [feature_name, current_model, limit])
+                      [feature_name, current_model, feature_name, limit])
             tiles = c.fetchall()
 
         return (tiles, count)
@@ -249,14 +398,6 @@ class Database(object):
                               limit])
             return c.fetchall()
 
-    def tiles_with_solar(self):
-        with self.transaction('get_tiles_with_solar') as c:
-            c.execute('''select tile_hash
-                         from with_solar
-                         where has_solar = True
-                      ''')
-            return c.fetchall()
-
 
 def get_tile_hash(cursor, z, x, y):
     assert type(z) == int
@@ -273,6 +414,67 @@ def get_tile_hash(cursor, z, x, y):
     return [tile_hash for tile_hash, in cursor]
 
 
+def latest_tile_hashes(cursor, z, min_x, min_y, max_x, max_y):
+    assert isinstance(z, int)
+    assert isinstance(min_x, int)
+    assert isinstance(min_y, int)
+    assert isinstance(max_x, int)
+    assert isinstance(max_y, int)
+
+    # SQLite picks tile_hash from the row that has max(added)
+    cursor.execute('''select x, y, tile_hash, max(added)
+                      from tile_positions
+                      where z = ?
+                            and x between ? and ?
+                            and y between ? and ?
+                      group by x, y
+                   ''',
+                   (z, min_x, max_x, min_y, max_y))
+    return {(x, y): tile_hash for x, y, tile_hash, _ in cursor}
+
+
+def tile_hashes_at(cursor, z, positions):
+    """Every tile hash stored at any of the (x, y) positions, as
+    (x, y, tile_hash)"""
+    assert isinstance(z, int)
+
+    cursor.execute('''create temp table if not exists wanted_positions (
+                          x integer not null,
+                          y integer not null,
+                          primary key (x, y))
+                   ''')
+    cursor.execute('delete from wanted_positions')
+    cursor.executemany('''insert or ignore into wanted_positions (x, y)
+                          values (?, ?)
+                       ''',
+                       positions)
+    cursor.execute('''select tile_positions.x,
+                             tile_positions.y,
+                             tile_positions.tile_hash
+                      from wanted_positions
+                      join tile_positions
+                          on tile_positions.z = ?
+                             and tile_positions.x = wanted_positions.x
+                             and tile_positions.y = wanted_positions.y
+                   ''',
+                   (z,))
+    result = cursor.fetchall()
+    cursor.execute('delete from wanted_positions')
+    return result
+
+
+def latest_tile_hashes_at_zoom(cursor, z):
+    assert isinstance(z, int)
+
+    cursor.execute('''select x, y, tile_hash, max(added)
+                      from tile_positions
+                      where z = ?
+                      group by x, y
+                   ''',
+                   [z])
+    return {(x, y): tile_hash for x, y, tile_hash, _ in cursor}
+
+
 def get_tile_pos(cursor, tile_hash):
     assert type(tile_hash) == str
 
@@ -284,6 +486,22 @@ def get_tile_pos(cursor, tile_hash):
     return cursor.fetchone()
 
 
+def known_tile_hashes(cursor, tile_hashes):
+    """The subset of tile_hashes that are registered in tile_positions"""
+    tile_hashes = list(tile_hashes)
+    known = set()
+    # Stay well below the limit on the number of query parameters
+    for start in range(0, len(tile_hashes), 500):
+        chunk = tile_hashes[start:start + 500]
+        cursor.execute(f'''select tile_hash
+                           from tile_positions
+                           where tile_hash in ({", ".join("?" * len(chunk))})
+                        ''',
+                       chunk)
+        known.update(row[0] for row in cursor.fetchall())
+    return known
+
+
 def add_tile(cursor, z, x, y):
     assert type(z) == int
     assert type(x) == int
@@ -297,6 +515,7 @@ def add_tile(cursor, z, x, y):
                       on conflict do nothing
                    ''',
                    (z, x, y, timestamp))
+    add_tile_bounds(cursor, [(z, x, y)])
 
 
 def has_tile(cursor, z, x, y):
@@ -314,6 +533,36 @@ def has_tile(cursor, z, x, y):
     return cursor.fetchone()[0] > 0
 
 
+def position_id(z, x, y):
+    return (z << 50) | (x << 25) | y
+
+
+def position_from_id(position_id):
+    mask = (1 << 25) - 1
+    return (position_id >> 50, (position_id >> 25) & mask, position_id & mask)
+
+
+def _tile_bounds_row(z, x, y):
+    north, west = util.tile2deg(x, y, z)
+    south, east = util.tile2deg(x + 1, y + 1, z)
+    return (position_id(z, x, y), south, north, west, east, z, x, y)
+
+
+def add_tile_bounds(cursor, positions):
+    cursor.executemany('''insert or ignore into tile_bounds
+                          (id, min_lat, max_lat, min_lon, max_lon, z, x, y)
+                          values (?, ?, ?, ?, ?, ?, ?, ?)
+                       ''',
+                       [_tile_bounds_row(z, x, y) for z, x, y in positions])
+
+
+def rebuild_tile_bounds(cursor):
+    cursor.execute('''select z, x, y
+                      from last_update
+                   ''')
+    add_tile_bounds(cursor, cursor.fetchall())
+
+
 def add_tile_hash(cursor, z, x, y, tile_hash):
     assert type(z) == int
     assert type(x) == int
@@ -332,6 +581,27 @@ def add_tile_hash(cursor, z, x, y, tile_hash):
                    (tile_hash, z, x, y, timestamp))
 
 
+def add_tile_hashes(cursor, tiles):
+    epoch = datetime.datetime.fromtimestamp(0)
+    now = datetime.datetime.now()
+
+    cursor.executemany('''insert into last_update
+                          (z, x, y, timestamp)
+                          values (?, ?, ?, ?)
+                          on conflict do nothing
+                       ''',
+                       [(z, x, y, epoch.isoformat())
+                        for z, x, y, _ in tiles])
+    add_tile_bounds(cursor, [(z, x, y) for z, x, y, _ in tiles])
+    cursor.executemany('''insert into tile_positions
+                          (tile_hash, z, x, y, added)
+                          values (?, ?, ?, ?, ?)
+                          on conflict do nothing
+                       ''',
+                       [(tile_hash, z, x, y, now.isoformat())
+                        for z, x, y, tile_hash in tiles])
+
+
 def get_score(cursor, tile_hash, feature_name):
     cursor.execute('''select score
                       from scores
@@ -362,6 +632,60 @@ def write_score(cursor, tile_hash, feature_name, score, model_version,
                                  timestamp=excluded.timestamp
                    ''',
                    (tile_hash, feature_name, score, model_version, timestamp))
+    _stamp_score_versions(cursor, [(feature_name, model_version, timestamp)])
+
+
+def _stamp_score_versions(cursor, versions):
+    """Records when each (feature_name, model_version) last wrote a score,
+    so that readers can notice a new model without scanning the scores.
+    Scores that don't come from a model are left out"""
+    latest = {}
+    for feature_name, model_version, timestamp in versions:
+        if model_version in pseudo_model_versions:
+            continue
+        key = (feature_name, model_version)
+        latest[key] = max(timestamp, latest.get(key, timestamp))
+
+    cursor.executemany('''insert into score_versions
+                          (feature_name, model_version, timestamp)
+                          values (?, ?, ?)
+                          on conflict do
+                          update set timestamp=max(timestamp,
+                                                   excluded.timestamp)
+                       ''',
+                       [key + (timestamp,)
+                        for key, timestamp in latest.items()])
+
+
+def latest_score_version(cursor, feature_name):
+    """The model version that most recently wrote a feature_name score"""
+    cursor.execute('''select model_version
+                      from score_versions
+                      where feature_name = ?
+                      order by timestamp desc
+                      limit 1
+                   ''',
+                   [feature_name])
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def write_scores(cursor, scores):
+    """Like write_score, for a list of (tile_hash, feature_name, score,
+    model_version, timestamp)"""
+    cursor.executemany('''insert into scores
+                          (tile_hash, feature_name, score, model_version,
+                           timestamp)
+                          values (?, ?, ?, ?, ?)
+                          on conflict(tile_hash, feature_name) do
+                          update set score=excluded.score,
+                                     model_version=excluded.model_version,
+                                     timestamp=excluded.timestamp
+                       ''',
+                       scores)
+    _stamp_score_versions(cursor, [(feature_name, model_version, timestamp)
+                                   for _, feature_name, _, model_version,
+                                   timestamp in scores])
 
 
 def remove_score(cursor, feature_name, tile_hash):
@@ -371,6 +695,19 @@ def remove_score(cursor, feature_name, tile_hash):
                           and tile_hash = ?
                    ''',
                    [feature_name, tile_hash])
+    # Remembered so that the heatmap is rendered again where it was
+    _log_score_change(cursor, feature_name, tile_hash)
+
+
+def _log_score_change(cursor, feature_name, tile_hash):
+    cursor.execute('''insert into score_changes
+                      (tile_hash, feature_name, timestamp)
+                      values (?, ?, ?)
+                      on conflict do
+                      update set timestamp=excluded.timestamp
+                   ''',
+                   [tile_hash, feature_name,
+                    datetime.datetime.now().isoformat()])
 
 
 def set_has_feature(cursor, tile_hash, feature_name, has_feature):
@@ -383,6 +720,7 @@ def set_has_feature(cursor, tile_hash, feature_name, has_feature):
                       values (?, ?, ?)
                    ''',
                    (tile_hash, feature_name, has_feature))
+    _log_label(cursor, tile_hash, feature_name)
 
 
 def all_tiles(cursor):
@@ -430,6 +768,276 @@ def mark_checked(cursor, z, x, y):
                    [z, x, y, timestamp])
 
 
+def reset_last_checked(cursor, tile_hashes):
+    """Makes the positions of tile_hashes due for download again"""
+    epoch = datetime.datetime.fromtimestamp(0)
+    cursor.executemany('''update last_update
+                          set timestamp = ?
+                          where (z, x, y) = (
+                              select z, x, y
+                              from tile_positions
+                              where tile_hash = ?)
+                       ''',
+                       [(epoch.isoformat(), tile_hash)
+                        for tile_hash in tile_hashes])
+
+
+def write_fingerprint(cursor, tile_hash, dhash, thumbnail):
+    assert isinstance(tile_hash, str)
+    assert isinstance(dhash, int)
+    assert isinstance(thumbnail, bytes)
+
+    cursor.execute('''insert into tile_fingerprints
+                      (tile_hash, dhash, thumbnail)
+                      values (?, ?, ?)
+                      on conflict do nothing
+                   ''',
+                   (tile_hash, dhash, thumbnail))
+
+
+def get_fingerprint(cursor, tile_hash):
+    """Returns (dhash, thumbnail) or None"""
+    cursor.execute('''select dhash, thumbnail
+                      from tile_fingerprints
+                      where tile_hash = ?
+                   ''',
+                   (tile_hash,))
+    return cursor.fetchone()
+
+
+def inherit_scores(cursor, from_hash, to_hash):
+    """Copies the scores of from_hash to to_hash, keeping any that to_hash
+    already has. Labels are left behind, even a small change may be what
+    makes them wrong, so the new tile is reviewed again"""
+    cursor.execute('''insert or ignore into scores
+                      (tile_hash, feature_name, score, model_version,
+                       timestamp)
+                      select ?, feature_name, score, model_version, timestamp
+                      from scores
+                      where tile_hash = ?
+                   ''',
+                   (to_hash, from_hash))
+
+    # Inherited scores keep their old timestamp, so the heatmap needs telling
+    cursor.execute('''select feature_name
+                      from scores
+                      where tile_hash = ?
+                   ''',
+                   (from_hash,))
+    for feature_name, in cursor.fetchall():
+        _log_score_change(cursor, feature_name, to_hash)
+
+
+def tile_history(cursor):
+    """Per position: (z, x, y, hash count, first added, last checked).
+    Positions that have never been downloaded have no hashes and None as
+    first added"""
+    cursor.execute('''select z, x, y, count(tile_hash), min(added), timestamp
+                      from last_update
+                      left join tile_positions using (z, x, y)
+                      group by z, x, y
+                   ''')
+    return cursor.fetchall()
+
+
+def write_recheck_schedule(cursor, schedule):
+    """Replaces the schedule with (z, x, y, due, priority, rate) rows"""
+    cursor.execute('delete from recheck_schedule')
+    cursor.executemany('''insert into recheck_schedule
+                          (z, x, y, due, priority, rate)
+                          values (?, ?, ?, ?, ?, ?)
+                       ''',
+                       schedule)
+
+
+def due_rechecks(cursor, timestamp, limit=-1):
+    """(z, x, y, priority) due at timestamp, highest priority first"""
+    cursor.execute('''select z, x, y, priority
+                      from recheck_schedule
+                      where due <= ?
+                      order by priority desc
+                      limit ?
+                   ''',
+                   (timestamp, limit))
+    return cursor.fetchall()
+
+
+def recheck_rate(cursor, z, x, y):
+    cursor.execute('''select rate
+                      from recheck_schedule
+                      where z = ?
+                            and x = ?
+                            and y = ?
+                   ''',
+                   (z, x, y))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def reschedule(cursor, z, x, y, due, rate):
+    cursor.execute('''insert into recheck_schedule
+                      (z, x, y, due, priority, rate)
+                      values (?, ?, ?, ?, 0.0, ?)
+                      on conflict do
+                      update set due=excluded.due,
+                                 priority=excluded.priority,
+                                 rate=excluded.rate
+                   ''',
+                   (z, x, y, due, rate))
+
+
+def download_frontier(cursor):
+    """The saved download queue as (position_id, priority)"""
+    cursor.execute('''select id, priority
+                      from download_frontier
+                   ''')
+    return cursor.fetchall()
+
+
+def update_download_frontier(cursor, queued, removed):
+    cursor.executemany('''insert into download_frontier (id, priority)
+                          values (?, ?)
+                          on conflict do
+                          update set priority=excluded.priority
+                       ''',
+                       queued)
+    cursor.executemany('''delete from download_frontier
+                          where id = ?
+                       ''',
+                       [(position_id,) for position_id in removed])
+
+
+def tiles_without_stats(cursor):
+    cursor.execute('''select tile_hash
+                      from tile_positions
+                      where tile_hash not in (
+                          select tile_hash
+                          from tile_stats)
+                   ''')
+    return [tile_hash for tile_hash, in cursor]
+
+
+def write_tile_stats(cursor, stats):
+    """Stores (tile_hash, file_size, variance, water_fraction,
+    green_fraction) rows"""
+    cursor.executemany('''insert or replace into tile_stats
+                          (tile_hash, file_size, variance, water_fraction,
+                           green_fraction)
+                          values (?, ?, ?, ?, ?)
+                       ''',
+                       stats)
+
+
+def all_tile_stats(cursor):
+    cursor.execute('''select tile_hash,
+                             file_size,
+                             variance,
+                             water_fraction,
+                             green_fraction
+                      from tile_stats
+                   ''')
+    return cursor.fetchall()
+
+
+def likely_positive_tiles(cursor, feature_name, min_score):
+    """Hashes labelled as having feature_name, or scored at least
+    min_score"""
+    cursor.execute('''select tile_hash
+                      from has_feature
+                      where feature_name = ?
+                            and has_feature
+                      union
+                      select tile_hash
+                      from true_score
+                      where feature_name = ?
+                            and score > 0
+                      union
+                      select tile_hash
+                      from scores
+                      where feature_name = ?
+                            and score >= ?
+                   ''',
+                   (feature_name, feature_name, feature_name, min_score))
+    return set(row[0] for row in cursor)
+
+
+def write_trivially_negative(cursor, feature_name, negatives):
+    """Replaces the trivially negative tiles for feature_name with the
+    (tile_hash, reason) pairs in negatives"""
+    cursor.execute('''delete from trivially_negative
+                      where feature_name = ?
+                   ''',
+                   (feature_name,))
+    cursor.executemany('''insert into trivially_negative
+                          (tile_hash, feature_name, reason)
+                          values (?, ?, ?)
+                       ''',
+                       [(tile_hash, feature_name, reason)
+                        for tile_hash, reason in negatives])
+
+
+def count_trivially_negative(cursor, feature_name, model_version=None):
+    """Trivially negative tiles without a score from model_version, or
+    without any score if it is None"""
+    cursor.execute('''select count(*)
+                      from trivially_negative
+                      left join scores
+                          using (tile_hash, feature_name)
+                      where feature_name = ?
+                            and (scores.model_version is null
+                                 or (? is not null
+                                     and scores.model_version != ?))
+                   ''',
+                   (feature_name, model_version, model_version))
+    return cursor.fetchone()[0]
+
+
+def write_stage_scores(cursor, feature_name, stage, model_version,
+                       timestamp, scores):
+    """Stores the (tile_hash, score) pairs from one cascade stage"""
+    cursor.executemany('''insert into stage_scores
+                          (tile_hash, feature_name, stage, score,
+                           model_version, timestamp)
+                          values (?, ?, ?, ?, ?, ?)
+                          on conflict(tile_hash, feature_name, stage) do
+                          update set score=excluded.score,
+                                     model_version=excluded.model_version,
+                                     timestamp=excluded.timestamp
+                       ''',
+                       [(tile_hash, feature_name, stage, score, model_version,
+                         timestamp)
+                        for tile_hash, score in scores])
+
+
+def get_cascade_threshold(cursor, feature_name, screen_version,
+                          max_recall_loss, labels_digest):
+    """Returns (threshold, recall, pass_rate) if it was calibrated for the
+    same recall loss and validation labels, otherwise None"""
+    cursor.execute('''select threshold, recall, pass_rate
+                      from cascade_thresholds
+                      where feature_name = ?
+                            and screen_version = ?
+                            and max_recall_loss = ?
+                            and labels_digest = ?
+                   ''',
+                   (feature_name, screen_version, max_recall_loss,
+                    labels_digest))
+    return cursor.fetchone()
+
+
+def write_cascade_threshold(cursor, feature_name, screen_version,
+                            max_recall_loss, labels_digest, threshold,
+                            recall, pass_rate, timestamp):
+    cursor.execute('''insert or replace into cascade_thresholds
+                      (feature_name, screen_version, max_recall_loss,
+                       labels_digest, threshold, recall, pass_rate,
+                       timestamp)
+                      values (?, ?, ?, ?, ?, ?, ?, ?)
+                   ''',
+                   (feature_name, screen_version, max_recall_loss,
+                    labels_digest, threshold, recall, pass_rate, timestamp))
+
+
 def training_tiles(cursor, feature_name):
     if feature.result_type(feature_name) == 'probability':
         cursor.execute('''select tile_hash, has_feature, 0
@@ -477,6 +1085,69 @@ def validation_tiles(cursor, feature_name):
     return cursor.fetchall()
 
 
+def validation_predictions(cursor, feature_name, model_version):
+    """(tile_hash, label, prediction) for every validation tile, prediction
+    is None if model_version hasn't scored it"""
+    if feature.result_type(feature_name) == 'probability':
+        label_query = '''select tile_hash, has_feature as label
+                          from has_feature
+                          where feature_name = ?'''
+    elif feature.result_type(feature_name) == 'area':
+        label_query = '''select tile_hash, score as label
+                          from true_score
+                          where feature_name = ?'''
+    else:
+        raise RuntimeError
+
+    cursor.execute(f'''select tile_hash, label, prediction
+                       from validation_set
+                       natural join tile_positions
+                       natural left join ({label_query})
+                       natural left join (
+                           select tile_hash, score as prediction
+                           from validation_predictions
+                           where feature_name = ?
+                                 and model_version = ?)
+                       where feature_name = ?
+                    ''',
+                   [feature_name, feature_name, model_version, feature_name])
+    return cursor.fetchall()
+
+
+def write_validation_predictions(cursor, feature_name, model_version,
+                                 predictions):
+    cursor.executemany('''insert or replace into validation_predictions
+                          (tile_hash, feature_name, model_version, score)
+                          values (?, ?, ?, ?)
+                       ''',
+                       [(tile_hash, feature_name, model_version, score)
+                        for tile_hash, score in predictions])
+
+
+def get_evaluation_report(cursor, feature_name, model_version, digest):
+    """The stored report as a JSON string, if it was made from the same
+    labels and predictions"""
+    cursor.execute('''select report
+                      from evaluation_reports
+                      where feature_name = ?
+                            and model_version = ?
+                            and digest = ?
+                   ''',
+                   [feature_name, model_version, digest])
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def write_evaluation_report(cursor, feature_name, model_version, digest,
+                            report, timestamp):
+    cursor.execute('''insert or replace into evaluation_reports
+                      (feature_name, model_version, digest, report,
+                       timestamp)
+                      values (?, ?, ?, ?, ?)
+                   ''',
+                   (feature_name, model_version, digest, report, timestamp))
+
+
 def validation_tiles_for_scoring(cursor, current_model, feature_name):
     cursor.execute('''select tile_hash, score
                       from validation_set
@@ -491,6 +1162,30 @@ def validation_tiles_for_scoring(cursor, current_model, feature_name):
     return cursor.fetchall()
 
 
+def distillation_tiles(cursor, feature_name, teacher_version, limit):
+    """A random sample of (tile_hash, score) scored by the teacher, leaving
+    out the positions in the training and validation sets"""
+    cursor.execute('''select tile_hash, score
+                      from scores
+                      natural join tile_positions
+                      where feature_name = ?
+                            and model_version = ?
+                            and (z, x, y) not in (
+                                select z, x, y
+                                from training_set
+                                where feature_name = ?
+                                union all
+                                select z, x, y
+                                from validation_set
+                                where feature_name = ?)
+                      order by random()
+                      limit ?
+                   ''',
+                   [feature_name, teacher_version, feature_name,
+                    feature_name, limit])
+    return cursor.fetchall()
+
+
 def set_true_score(cursor, tile_hash, feature_name, true_score):
     assert type(tile_hash) == str
     assert type(feature_name) == str
@@ -501,3 +1196,271 @@ def set_true_score(cursor, tile_hash, feature_name, true_score):
                       values (?, ?, ?)
                    ''',
                    (tile_hash, feature_name, true_score))
+    _log_label(cursor, tile_hash, feature_name)
+
+
+def _log_label(cursor, tile_hash, feature_name):
+    cursor.execute('''insert into label_log
+                      (tile_hash, feature_name, timestamp)
+                      values (?, ?, ?)
+                   ''',
+                   (tile_hash, feature_name,
+                    datetime.datetime.now().isoformat()))
+
+
+def new_labels(cursor, feature_name, after_id):
+    """(tile_hash, label, label id) for tiles labelled after label id
+    after_id, leaving out the validation set"""
+    if feature.result_type(feature_name) == 'probability':
+        table, label = 'has_feature', 'has_feature'
+    elif feature.result_type(feature_name) == 'area':
+        table, label = 'true_score', 'score'
+    else:
+        raise RuntimeError
+
+    cursor.execute(f'''select tile_hash, {label}, max(label_log.id)
+                       from label_log
+                       natural join tile_positions
+                       natural join {table}
+                       where feature_name = ?
+                             and label_log.id > ?
+                             and (z, x, y) not in (
+                                 select z, x, y
+                                 from validation_set
+                                 where feature_name = ?)
+                       group by tile_hash
+                    ''',
+                   [feature_name, after_id, feature_name])
+    return cursor.fetchall()
+
+
+def last_fine_tuned_label(cursor, feature_name):
+    cursor.execute('''select last_label_id
+                      from fine_tune_state
+                      where feature_name = ?
+                   ''',
+                   [feature_name])
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def write_fine_tune_state(cursor, feature_name, last_label_id,
+                          model_version, timestamp):
+    cursor.execute('''insert or replace into fine_tune_state
+                      (feature_name, last_label_id, model_version, timestamp)
+                      values (?, ?, ?, ?)
+                   ''',
+                   (feature_name, last_label_id, model_version, timestamp))
+
+
+def position_scores(cursor, feature_name, z):
+    cursor.execute('''select x, y, max(score)
+                      from scores
+                      natural join tile_positions
+                      where feature_name = ?
+                            and z = ?
+                      group by x, y
+                   ''',
+                   [feature_name, z])
+    return cursor.fetchall()
+
+
+def positions_scored_since(cursor, feature_name, z, timestamp):
+    """Positions where a score was written, removed or inherited after
+    timestamp"""
+    cursor.execute('''select x, y
+                      from scores
+                      natural join tile_positions
+                      where feature_name = ?
+                            and z = ?
+                            and timestamp > ?
+                      union
+                      select x, y
+                      from score_changes
+                      natural join tile_positions
+                      where feature_name = ?
+                            and z = ?
+                            and timestamp > ?
+                   ''',
+                   [feature_name, z, timestamp] * 2)
+    return cursor.fetchall()
+
+
+def last_heatmap_render(cursor, feature_name, statistic):
+    cursor.execute('''select timestamp
+                      from heatmap_renders
+                      where feature_name = ?
+                            and statistic = ?
+                   ''',
+                   [feature_name, statistic])
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def mark_heatmap_rendered(cursor, feature_name, statistic, timestamp):
+    cursor.execute('''insert into heatmap_renders
+                      (feature_name, statistic, timestamp)
+                      values (?, ?, ?)
+                      on conflict do
+                      update set timestamp=excluded.timestamp
+                   ''',
+                   [feature_name, statistic, timestamp])
+
+
+def overview_tiles(cursor, z):
+    assert isinstance(z, int)
+
+    cursor.execute('''select x, y, tile_hash, children
+                      from overview_tiles
+                      where z = ?
+                   ''',
+                   [z])
+    return {(x, y): (tile_hash, children) for x, y, tile_hash, children
+            in cursor}
+
+
+def get_overview_tile(cursor, z, x, y):
+    cursor.execute('''select tile_hash
+                      from overview_tiles
+                      where z = ?
+                            and x = ?
+                            and y = ?
+                   ''',
+                   [z, x, y])
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def write_overview_tiles(cursor, tiles):
+    now = datetime.datetime.now().isoformat()
+    cursor.executemany('''insert into overview_tiles
+                          (z, x, y, tile_hash, children, added)
+                          values (?, ?, ?, ?, ?, ?)
+                          on conflict do
+                          update set tile_hash=excluded.tile_hash,
+                                     children=excluded.children,
+                                     added=excluded.added
+                       ''',
+                       [(z, x, y, tile_hash, children, now)
+                        for z, x, y, tile_hash, children in tiles])
+
+
+def positive_tiles(cursor, feature_name, z, threshold):
+    """Positions labelled as having the feature or scored at or above the
+    threshold, except those labelled as not having it"""
+    cursor.execute('''select x, y
+                      from tile_positions
+                      natural join has_feature
+                      where feature_name = ?
+                            and z = ?
+                            and has_feature
+                      union
+                      select x, y
+                      from tile_positions
+                      natural join scores
+                      left join (
+                          select tile_hash as negative_hash
+                          from has_feature
+                          where feature_name = ?
+                                and not has_feature)
+                      on negative_hash = tile_hash
+                      where feature_name = ?
+                            and z = ?
+                            and score >= ?
+                            and negative_hash is null
+                   ''',
+                   [feature_name, z, feature_name, feature_name, z,
+                    threshold])
+    return cursor.fetchall()
+
+
+def tiles_in_bbox(cursor, feature_name, south, west, north, east):
+    """Positions overlapping the bbox with their newest tile hash and its
+    score, if any, as (z, x, y, tile_hash, score)"""
+    cursor.execute('''select tile_bounds.z,
+                             tile_bounds.x,
+                             tile_bounds.y,
+                             tile_positions.tile_hash,
+                             scores.score,
+                             max(tile_positions.added)
+                      from tile_bounds
+                      join tile_positions
+                          on tile_positions.z = tile_bounds.z
+                             and tile_positions.x = tile_bounds.x
+                             and tile_positions.y = tile_bounds.y
+                      left join scores
+                          on scores.tile_hash = tile_positions.tile_hash
+                             and scores.feature_name = ?
+                      where tile_bounds.max_lat >= ?
+                            and tile_bounds.min_lat <= ?
+                            and tile_bounds.max_lon >= ?
+                            and tile_bounds.min_lon <= ?
+                      group by tile_bounds.id
+                   ''',
+                   [feature_name, south, north, west, east])
+    return [row[:5] for row in cursor]
+
+
+def neighbourhood_tiles(cursor, z, x, y):
+    """The position and its 8 neighbours at zoom z, as far as we know about
+    them, with every tile hash stored there as (x, y, tile_hash, added).
+    Positions without tiles have None for both"""
+    # From the centres of the neighbours, so that nothing further away
+    # overlaps
+    north, west = util.tile2deg(x - 0.5, y - 0.5, z)
+    south, east = util.tile2deg(x + 1.5, y + 1.5, z)
+    cursor.execute('''select tile_bounds.x,
+                             tile_bounds.y,
+                             tile_positions.tile_hash,
+                             tile_positions.added
+                      from tile_bounds
+                      left join tile_positions
+                          on tile_positions.z = tile_bounds.z
+                             and tile_positions.x = tile_bounds.x
+                             and tile_positions.y = tile_bounds.y
+                      where tile_bounds.max_lat >= ?
+                            and tile_bounds.min_lat <= ?
+                            and tile_bounds.max_lon >= ?
+                            and tile_bounds.min_lon <= ?
+                            and tile_bounds.z = ?
+                   ''',
+                   [south, north, west, east, z])
+    return cursor.fetchall()
+
+
+def tiles_near(cursor, feature_name, lat, lon, radius):
+    """Like tiles_in_bbox, but for positions within radius metres of a
+    point, nearest first"""
+    metres_per_degree = 111320.0
+    delta_lat = radius / metres_per_degree
+    delta_lon = radius / (metres_per_degree * math.cos(math.radians(lat)))
+    candidates = tiles_in_bbox(cursor,
+                               feature_name,
+                               lat - delta_lat,
+                               lon - delta_lon,
+                               lat + delta_lat,
+                               lon + delta_lon)
+
+    result = []
+    for z, x, y, tile_hash, score in candidates:
+        north, west = util.tile2deg(x, y, z)
+        south, east = util.tile2deg(x + 1, y + 1, z)
+        nearest_lat = min(max(lat, south), north)
+        nearest_lon = min(max(lon, west), east)
+        distance = _distance(lat, lon, nearest_lat, nearest_lon)
+        if distance <= radius:
+            result.append((distance, (z, x, y, tile_hash, score)))
+
+    result.sort(key=lambda r: r[0])
+    return [row for _, row in result]
+
+
+def _distance(lat_1, lon_1, lat_2, lon_2):
+    earth_radius = 6371000.0
+    phi_1 = math.radians(lat_1)
+    phi_2 = math.radians(lat_2)
+    delta_phi = phi_2 - phi_1
+    delta_lambda = math.radians(lon_2 - lon_1)
+    a = math.sin(delta_phi / 2) ** 2 \
+        + math.cos(phi_1) * math.cos(phi_2) * math.sin(delta_lambda / 2) ** 2
+    return 2 * earth_radius * math.asin(math.sqrt(a))
@@ -2,7 +2,6 @@ import argparse
 import datetime
 import logging
 import pathlib
-import random
 import sys
 import time
 
@@ -11,61 +10,120 @@ import sqlite3
 import tqdm
 
 import database
+import fingerprint
+import frontier
+import model_server
+import recheck
 import util
 
 
-recheck_interval = datetime.timedelta(days=90)
 minimum_image_duration = 10
+# Above any scheduled priority, so neighbours of changed tiles go first
+neighbour_priority = 2.0
 
 
 def download_location(db, image_dir, nib_api_key, z, x, y):
+    """Returns the hash of the tile if it is new and needs scoring,
+    otherwise None"""
     with db.transaction('should_download') as c:
         try:
             timestamp = database.last_checked(c, z, x, y)
         except sqlite3.OperationalError as e:
             logging.debug('Failed when checking if tile should be downloaded',
                           exc_info=e)
-            return False
+            return None
 
         if timestamp is not None:
+            # Neighbours of changed tiles are checked before they are due,
+            # but not over and over again
             delta = datetime.datetime.now() - timestamp
-            if delta < recheck_interval:
-                return False
+            if delta < recheck.min_interval:
+                return None
         else:
             # We only want to try to download if we have seen this position
             # before, this is not the place to add new positions
             if not database.get_tile_hash(c, z, x, y):
-                return False
+                return None
 
     try:
         written, tile_hash = util.download_single_tile(
                 image_dir, nib_api_key, z, x, y, retry=False)
     except requests.exceptions.ConnectionError:
-        return False
+        return None
     except requests.HTTPError:
-        return False
+        return None
 
+    tiles = [(z, x, y, tile_hash)] if written else []
     try:
+        tiles, fingerprints, unchanged = fingerprint.compare(db, image_dir,
+                                                             tiles)
         with db.transaction('write_download_result') as c:
-            if written:
-                database.add_tile_hash(c, z, x, y, tile_hash)
-
+            inherited = fingerprint.register(c, tiles, fingerprints,
+                                             unchanged)
             database.mark_checked(c, z, x, y)
+            recheck.reschedule(c, z, x, y, datetime.datetime.now())
     except sqlite3.OperationalError as e:
         # Ignore it and try again in the next round of downloads
         logging.debug('Failed when writing download result', exc_info=e)
-        return False
+        return None
+
+    if not tiles or tile_hash in inherited:
+        return None
+    return tile_hash
+
+
+def neighbours(cursor, z, x, y):
+    """Known positions around (x, y)"""
+    found = set((z, neighbour_x, neighbour_y)
+                for neighbour_x, neighbour_y, _, _
+                in database.neighbourhood_tiles(cursor, z, x, y))
+    found.discard((z, x, y))
+    return sorted(found)
 
-    return written
 
+def load_frontier(db, feature_name, now, update_schedule=True):
+    """Returns the saved frontier with due rechecks added, and the number of
+    resumed, due and scheduled positions. Without update_schedule the
+    recheck schedule is used as is and the scheduled count is None"""
+    scheduled = None
+    if update_schedule:
+        scheduled = recheck.update(db, feature_name, now)
+    with db.transaction('get_tiles_to_download') as c:
+        positions = frontier.Frontier.load(c)
+        resumed = len(positions)
+        due = database.due_rechecks(c, now.isoformat())
+        for z, x, y, priority in due:
+            positions.push(z, x, y, priority)
+        positions.sync(c)
+    return positions, resumed, len(due), scheduled
+
+
+def check_next(db, image_dir, nib_api_key, positions, already_downloaded):
+    """Checks the position with the highest priority and queues its
+    neighbours if the tile changed. Returns (new tile hash or None, number
+    of positions added to the frontier)"""
+    z, x, y = positions.pop()
+    new_tile = download_location(db, image_dir, nib_api_key, z, x, y)
+    already_downloaded.add((z, x, y))
+
+    added = 0
+    try:
+        with db.transaction('sync_download_frontier') as c:
+            if new_tile:
+                for position in neighbours(c, z, x, y):
+                    if position in already_downloaded:
+                        continue
+
+                    if position not in positions:
+                        added += 1
+                    positions.push(*position, neighbour_priority)
 
-def neighbours(z, x, y):
-    for neighbour_x in [x - 1, x, x + 1]:
-        for neighbour_y in [y - 1, y, y + 1]:
-            if neighbour_x == x and neighbour_y == y:
-                continue
+            positions.sync(c)
+    except sqlite3.OperationalError as e:
+        # Unsaved changes are written by the next sync
+        logging.debug('Failed to save download frontier', exc_info=e)
 
-            yield (z, neighbour_x, neighbour_y)
+    return new_tile, added
 
 
 def main():
@@ -74,6 +132,11 @@ def main():
     parser.add_argument('--NiB-key', type=str, default="secret/NiB_key.json")
     parser.add_argument('--tile-path', type=str, default='data/images')
     parser.add_argument('--log', type=str)
+    parser.add_argument('--feature', type=str, default='solar',
+                        help='Positions likely to have this feature are '
+                             'rechecked first')
+    parser.add_argument('--model-server', type=str,
+                        help='Score new tiles with this model server')
     args = parser.parse_args()
 
     if args.log:
@@ -90,20 +153,15 @@ def main():
     db = database.Database(db_path)
     nib_api_key = util.load_key(args.NiB_key)
     image_dir = pathlib.Path(args.tile_path)
+    score_client = None
+    if args.model_server:
+        score_client = model_server.Client(args.model_server)
 
-    positions = []
-    with db.transaction('get_tiles_to_download') as c:
-        now = datetime.datetime.now()
-        for z, x, y in database.all_tiles(c):
-            timestamp = database.last_checked(c, z, x, y)
-            if timestamp is not None:
-                delta = now - timestamp
-                if delta < recheck_interval:
-                    continue
-
-            positions.append((z, x, y))
-
-    random.shuffle(positions)
+    now = datetime.datetime.now()
+    positions, resumed, due, scheduled = load_frontier(db, args.feature,
+                                                       now)
+    print(f'{due} of {scheduled} positions due for a recheck, '
+          f'{resumed} left from the last run')
 
     new_tiles = tqdm.tqdm(desc='New')
     downloads = tqdm.tqdm(desc='Checks', total=len(positions))
@@ -112,24 +170,15 @@ def main():
     while positions:
         start = time.time()
 
-        z, x, y = positions.pop()
-        new_tile = download_location(db, image_dir, nib_api_key, z, x, y)
+        new_tile, added = check_next(db, image_dir, nib_api_key, positions,
+                                     already_downloaded)
         downloads.update()
-        already_downloaded.add((z, x, y))
+        downloads.total += added
 
         if new_tile:
             new_tiles.update()
-
-            for z_new, x_new, y_new in neighbours(z, x, y):
-                position = (z_new, x_new, y_new)
-                if position in already_downloaded:
-                    continue
-
-                try:
-                    positions.remove(position)
-                except ValueError:
-                    pass
-                positions.append(position)
+            if score_client is not None:
+                score_client.submit([new_tile])
 
         duration = time.time() - start
         if duration < minimum_image_duration:
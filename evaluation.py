@@ -0,0 +1,136 @@
+import datetime
+import hashlib
+import json
+
+import numpy as np
+
+import database
+
+
+# Scores below low are predicted negative, at or above high positive and
+# anything in between unknown
+low_cutoff = 0.1
+high_cutoff = 0.9
+top_counts = (100, 250, 1000)
+
+
+def digest(rows):
+    """Identifies a set of (tile_hash, label, prediction) rows"""
+    h = hashlib.sha256()
+    for row in sorted(rows):
+        h.update(repr(row).encode('utf-8'))
+    return h.hexdigest()
+
+
+def confusion(labels, scores):
+    """3x3 matrix of true class (negative, unknown, positive) by predicted
+    class, with nan labels for unknown"""
+    known = ~np.isnan(labels)
+    true_class = np.where(known, np.where(labels > 0, 2, 0), 1)
+    predicted_class = np.digitize(scores, [low_cutoff, high_cutoff])
+    return np.bincount(true_class * 3 + predicted_class,
+                       minlength=9).reshape(3, 3)
+
+
+def report(labels, scores):
+    """Evaluation of scores against labels, both as float arrays with nan
+    labels for unknown tiles, as a JSON compatible dict"""
+    labels = np.asarray(labels, dtype=np.float64)
+    scores = np.asarray(scores, dtype=np.float64)
+
+    # One descending sort gives both the top-k counts and the threshold
+    # sweep, where every distinct score is a threshold
+    order = np.argsort(-scores, kind='stable')
+    sorted_scores = scores[order]
+    sorted_labels = labels[order]
+    unknown = np.isnan(sorted_labels)
+    positive = ~unknown & (sorted_labels > 0)
+    negative = ~unknown & ~positive
+
+    # The last of each run of equal scores, and the very last tile
+    last = np.zeros(len(scores), dtype=bool)
+    if len(scores):
+        last[:-1] = sorted_scores[1:] != sorted_scores[:-1]
+        last[-1] = True
+    thresholds = sorted_scores[last]
+    true_positives = np.cumsum(positive)[last]
+    false_positives = np.cumsum(negative)[last]
+    positives = int(positive.sum())
+    negatives = int(negative.sum())
+
+    predicted = np.maximum(true_positives + false_positives, 1)
+    precision = true_positives / predicted
+    recall = true_positives / max(positives, 1)
+    with np.errstate(invalid='ignore'):
+        f1 = np.nan_to_num(2 * precision * recall / (precision + recall))
+    false_positive_rate = false_positives / max(negatives, 1)
+
+    roc_x = np.append(0.0, false_positive_rate)
+    roc_y = np.append(0.0, recall)
+    roc_auc = float(np.sum(np.diff(roc_x) * (roc_y[1:] + roc_y[:-1]) / 2))
+    average_precision = float(np.sum(np.diff(np.append(0.0, recall))
+                                     * precision))
+
+    best = int(np.argmax(f1)) if len(f1) else None
+    top = {}
+    for count in top_counts:
+        top[str(count)] = {
+                'positive': int(positive[:count].sum()),
+                'unknown': int(unknown[:count].sum()),
+                }
+
+    return {
+            'tiles': len(scores),
+            'positives': positives,
+            'negatives': negatives,
+            'matrix': confusion(labels, scores).tolist(),
+            'roc_auc': roc_auc,
+            'average_precision': average_precision,
+            'best_threshold': None if best is None
+            else float(thresholds[best]),
+            'best_precision': None if best is None
+            else float(precision[best]),
+            'best_recall': None if best is None else float(recall[best]),
+            'best_f1': None if best is None else float(f1[best]),
+            'top': top,
+            'curve': {
+                'threshold': thresholds.tolist(),
+                'precision': precision.tolist(),
+                'recall': recall.tolist(),
+                'false_positive_rate': false_positive_rate.tolist(),
+                },
+            }
+
+
+def missing_predictions(db, feature_name, model_version):
+    """Validation tiles model_version hasn't scored yet"""
+    with db.transaction('get_validation_predictions') as c:
+        rows = database.validation_predictions(c, feature_name,
+                                               model_version)
+    return [tile_hash for tile_hash, _, prediction in rows
+            if prediction is None]
+
+
+def evaluate(db, feature_name, model_version):
+    """The report for model_version, from the cache if neither labels nor
+    predictions have changed since it was made"""
+    with db.transaction('get_validation_predictions') as c:
+        rows = [row for row in database.validation_predictions(
+                    c, feature_name, model_version)
+                if row[2] is not None]
+        rows_digest = digest(rows)
+        cached = database.get_evaluation_report(c, feature_name,
+                                                model_version, rows_digest)
+    if cached is not None:
+        return json.loads(cached)
+
+    labels = [np.nan if label is None else float(label)
+              for _, label, _ in rows]
+    scores = [prediction for _, _, prediction in rows]
+    result = report(labels, scores)
+
+    with db.transaction('write_evaluation_report') as c:
+        database.write_evaluation_report(
+                c, feature_name, model_version, rows_digest,
+                json.dumps(result), datetime.datetime.now().isoformat())
+    return result
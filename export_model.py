@@ -0,0 +1,40 @@
+import argparse
+import pathlib
+import sys
+
+import feature
+import model
+import util
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Export trained weights as a self-contained model '
+                        'that loads quickly for scoring')
+    parser.add_argument('--model', default='VGG19')
+    parser.add_argument('--input-size', type=int, default=256)
+    parser.add_argument('--load-model', default='data/model.hdf5')
+    parser.add_argument('--save-to', type=str,
+                        help='Defaults to --load-model with a .model suffix')
+    parser.add_argument('--feature', type=str, required=True)
+    args = parser.parse_args()
+
+    weights_path = pathlib.Path(args.load_model)
+    save_to = args.save_to or weights_path.with_suffix('.model')
+
+    # Same version as scoring with the weights file directly, so existing
+    # scores stay current
+    version = util.hash_file(weights_path)
+    m = model.get(args.model,
+                  feature.result_type(args.feature),
+                  str(weights_path),
+                  input_size=args.input_size)
+    model.export(m, save_to, args.model, args.feature, args.input_size,
+                 version)
+    print(f'Exported {weights_path} to {save_to}, version {version}')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
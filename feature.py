@@ -26,6 +26,22 @@ def overpass_query(feature):
                '''
 
 
+def osm_tags(feature):
+    """Tags a way must have to be included, matching overpass_query"""
+    assert feature in _known_features
+
+    if feature == 'playground':
+        return {'leisure': 'playground'}
+    elif feature in ['solar', 'large_solar', 'solar_area']:
+        return {'power': 'generator', 'generator:source': 'solar'}
+
+
+def osm_centres(feature):
+    """Whether way centres are used as points, like `out center`"""
+    assert feature in _known_features
+    return feature == 'playground'
+
+
 def result_type(feature):
     return {
             'large_solar': 'probability',
@@ -0,0 +1,191 @@
+import argparse
+import datetime
+import logging
+import os
+import pathlib
+import random
+import shutil
+import sys
+import time
+
+import tensorflow as tf
+
+import database
+import feature
+import model
+import train
+import util
+
+
+def labelled_data(image_dir, tiles):
+    """(path, target, rotation, flips, weight) tuples as used by
+    train.load_distillation_data"""
+    return [(str(util.tile_to_paths(image_dir, tile_hash)),
+             str(float(label)),
+             '0',  # Rotate
+             '0',  # Horizontal flip
+             '0',  # Vertical flip
+             '1.0')
+            for tile_hash, label, _ in tiles
+            if label is not None]
+
+
+def dataset(tiles, batch_size, shuffle=False):
+    data = tf.data.Dataset.from_tensor_slices(tiles)
+    if shuffle:
+        data = data.shuffle(len(tiles))
+    data = data.map(train.load_distillation_data,
+                    num_parallel_calls=tf.data.AUTOTUNE)
+    return data.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+
+def publish(m, save_to, export_to, model_type, feature_name):
+    """Replaces the weights file, and the exported model if any, so that
+    readers never see a half written file. Returns the new version.
+
+    The exported model is written to a new directory next to export_to,
+    and export_to is a symlink that is swapped over to it with a rename.
+    Readers resolve the link once, so they load either the old or the new
+    model"""
+    save_to = pathlib.Path(save_to)
+    partial = save_to.with_name(save_to.name + '.partial')
+    m.save(str(partial), save_format='h5')
+    os.replace(partial, save_to)
+    version = util.hash_file(save_to)
+
+    if export_to:
+        export_to = pathlib.Path(export_to)
+        target = export_to.with_name(f'{export_to.name}.{version[:16]}')
+        shutil.rmtree(target, ignore_errors=True)
+        model.export(m, target, model_type, feature_name,
+                     m.input_shape[1], version)
+
+        old = export_to.resolve() if export_to.is_symlink() else None
+        if export_to.is_dir() and not export_to.is_symlink():
+            # Exported before exports were versioned, replaced just once
+            shutil.rmtree(export_to)
+        link = export_to.with_name(export_to.name + '.partial')
+        link.unlink(missing_ok=True)
+        link.symlink_to(target.name)
+        os.replace(link, export_to)
+        if old is not None and old != target.resolve():
+            shutil.rmtree(old, ignore_errors=True)
+
+    return version
+
+
+def fine_tune(db, image_dir, args):
+    """Fine-tunes the head if there are enough new labels. Returns True if
+    a new model was published"""
+    with db.transaction('get_new_labels') as c:
+        after = database.last_fine_tuned_label(c, args.feature)
+        new = database.new_labels(c, args.feature, after)
+        if len(new) < args.min_new_labels:
+            print(f'{len(new)} new {args.feature} labels, waiting for '
+                  f'{args.min_new_labels}')
+            return False
+
+        new_hashes = set(tile_hash for tile_hash, _, _ in new)
+        old = [tile for tile in database.training_tiles(c, args.feature)
+               if tile[0] not in new_hashes]
+        validation = database.validation_tiles(c, args.feature)
+
+    replay = random.sample(old, min(len(old),
+                                    int(args.replay_ratio * len(new))))
+    training_tiles = train.apply_rotation(labelled_data(image_dir, new)) \
+        + labelled_data(image_dir, replay)
+    validation_tiles = labelled_data(image_dir, validation)
+    if not validation_tiles:
+        raise RuntimeError(f'No labelled {args.feature} validation tiles')
+    print(f'Fine-tuning on {len(new)} new labels and {len(replay)} old ones')
+
+    # The backbone is frozen by model.get, so only the dense head is trained
+    m = model.get(args.model,
+                  feature.result_type(args.feature),
+                  args.load_model,
+                  args.learning_rate,
+                  args.input_size)
+    validation_data = dataset(validation_tiles, args.batch_size)
+    before = m.evaluate(validation_data, return_dict=True, verbose=0)
+
+    m.fit(dataset(training_tiles, args.batch_size, shuffle=True),
+          epochs=args.epochs,
+          verbose=0)
+    after_tuning = m.evaluate(validation_data, return_dict=True, verbose=0)
+
+    print(f'Validation loss {before["loss"]:.4f} -> '
+          f'{after_tuning["loss"]:.4f}')
+    if after_tuning['loss'] > before['loss'] * (1 + args.tolerance):
+        # Keep the labels for the next attempt, with more of them
+        print('Worse than the current model, not publishing')
+        return False
+
+    version = publish(m, args.save_to or args.load_model, args.export_to,
+                      args.model, args.feature)
+    with db.transaction('write_fine_tune_state') as c:
+        database.write_fine_tune_state(
+                c,
+                args.feature,
+                max(label_id for _, _, label_id in new),
+                version,
+                datetime.datetime.now().isoformat())
+    print(f'Published {args.feature} model {version}')
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Fine-tune the head of a trained model on labels '
+                        'added since the last fine-tuning')
+    parser.add_argument('--database', default='data/tiles.db')
+    parser.add_argument('--tile-path', type=str, default='data/images')
+    parser.add_argument('--model', type=str, default='VGG19')
+    parser.add_argument('--input-size', type=int, default=256)
+    parser.add_argument('--load-model', type=str, required=True)
+    parser.add_argument('--save-to', type=str,
+                        help='Defaults to replacing --load-model')
+    parser.add_argument('--export-to', type=str,
+                        help='Also replace this exported model')
+    parser.add_argument('--feature', type=str, required=True)
+    parser.add_argument('--log', type=str)
+
+    parser.add_argument('--min-new-labels', default=50, type=int)
+    parser.add_argument('--replay-ratio', default=4.0, type=float,
+                        help='Old labels to mix in per new label')
+    parser.add_argument('--tolerance', default=0.0, type=float,
+                        help='Relative increase in validation loss to accept')
+    parser.add_argument('--batch-size', default=64, type=int)
+    parser.add_argument('--epochs', default=2, type=int)
+    parser.add_argument('--learning-rate', default=1e-5, type=float)
+    parser.add_argument('--watch', type=float, metavar='SECONDS',
+                        help='Keep running and look for new labels this '
+                             'often')
+    args = parser.parse_args()
+
+    if args.log:
+        logging.basicConfig(
+                filename=args.log,
+                format='%(asctime)s %(name)s %(levelname)s %(message)s',
+                datefmt='%Y-%m-%dT%H:%M:%S',
+                level=logging.DEBUG,
+                )
+    else:
+        logging.basicConfig(level=logging.CRITICAL)
+
+    db = database.Database(args.database)
+    image_dir = pathlib.Path(args.tile_path)
+
+    while True:
+        if fine_tune(db, image_dir, args) and args.save_to:
+            # Build on the published model from now on
+            args.load_model = args.save_to
+
+        if not args.watch:
+            break
+        time.sleep(args.watch)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
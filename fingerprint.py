@@ -0,0 +1,124 @@
+import io
+import logging
+
+import numpy as np
+import PIL.Image
+
+import database
+import util
+
+
+log = logging.getLogger('fingerprint')
+
+thumbnail_size = 16
+# Tiles are equivalent if their dHashes differ in at most this many bits, the
+# mean absolute difference of their thumbnails is at most max_difference grey
+# levels and no thumbnail pixel differs by more than max_pixel_difference.
+# A thumbnail pixel covers about 10 m, so the last catches a new array on a
+# single roof, which barely moves the other two
+max_hamming_distance = 4
+max_difference = 6.0
+max_pixel_difference = 10
+
+
+class Fingerprint(object):
+    """Perceptual hash and grey thumbnail of one tile"""
+
+    def __init__(self, dhash, thumbnail):
+        self.dhash = dhash
+        self.thumbnail = thumbnail
+
+    def pixels(self):
+        return np.frombuffer(self.thumbnail, dtype=np.uint8).astype(np.int16)
+
+    def equivalent(self, other):
+        distance = bin((self.dhash ^ other.dhash) & (2 ** 64 - 1)).count('1')
+        if distance > max_hamming_distance:
+            return False
+
+        difference = np.abs(self.pixels() - other.pixels())
+        return difference.mean() <= max_difference \
+            and difference.max() <= max_pixel_difference
+
+
+def compute(data):
+    """Fingerprints the image in data, given as bytes or a path"""
+    if isinstance(data, bytes):
+        data = io.BytesIO(data)
+
+    with PIL.Image.open(data) as image:
+        grey = image.convert('L')
+
+    gradient = np.asarray(grey.resize((9, 8), PIL.Image.BILINEAR),
+                          dtype=np.int16)
+    bits = (gradient[:, 1:] > gradient[:, :-1]).ravel()
+    dhash = int(np.packbits(bits).view('>i8')[0])
+
+    thumbnail = grey.resize((thumbnail_size, thumbnail_size),
+                            PIL.Image.BILINEAR)
+    return Fingerprint(dhash, thumbnail.tobytes())
+
+
+def compare(db, image_dir, tiles):
+    """Fingerprints downloaded (z, x, y, tile_hash) tiles and the latest
+    tile at each of their positions. Decoding tiles is slow, so this is done
+    before the results are written. Returns the tiles to register, leaving
+    out new ones that can't be decoded, the fingerprints to store as
+    {tile_hash: Fingerprint} and (previous_hash, tile_hash) pairs of tiles
+    that look the same"""
+    with db.transaction('get_previous_fingerprints') as c:
+        known = database.known_tile_hashes(
+                c, [tile_hash for _, _, _, tile_hash in tiles])
+        new = []
+        for z, x, y, tile_hash in tiles:
+            if tile_hash in known:
+                continue
+            previous_hash = database.latest_tile_hashes(c, z, x, y, x, y) \
+                .get((x, y))
+            previous = None
+            if previous_hash is not None:
+                row = database.get_fingerprint(c, previous_hash)
+                if row is not None:
+                    previous = Fingerprint(*row)
+            new.append((tile_hash, previous_hash, previous))
+
+    fingerprints = {}
+    unchanged = []
+    unreadable = set()
+    for tile_hash, previous_hash, previous in new:
+        try:
+            fingerprints[tile_hash] = compute(
+                    util.tile_to_paths(image_dir, tile_hash))
+        except (OSError, ValueError) as e:
+            # Left on disk for fsck to report as an orphan
+            log.warning(f'Not registering unreadable tile {tile_hash}',
+                        exc_info=e)
+            unreadable.add(tile_hash)
+            continue
+
+        if previous_hash is None:
+            continue
+        if previous is None:
+            try:
+                previous = compute(util.tile_to_paths(image_dir,
+                                                      previous_hash))
+            except (OSError, ValueError):
+                continue
+            fingerprints[previous_hash] = previous
+
+        if previous.equivalent(fingerprints[tile_hash]):
+            unchanged.append((previous_hash, tile_hash))
+
+    tiles = [tile for tile in tiles if tile[3] not in unreadable]
+    return tiles, fingerprints, unchanged
+
+
+def register(cursor, tiles, fingerprints, unchanged):
+    """Adds the tiles with the results of compare, returns the hashes that
+    inherited the scores of the previous tile and need no scoring"""
+    database.add_tile_hashes(cursor, tiles)
+    for tile_hash, f in fingerprints.items():
+        database.write_fingerprint(cursor, tile_hash, f.dhash, f.thumbnail)
+    for previous_hash, tile_hash in unchanged:
+        database.inherit_scores(cursor, previous_hash, tile_hash)
+    return set(tile_hash for _, tile_hash in unchanged)
@@ -1,47 +1,92 @@
 import argparse
+import concurrent.futures
 import datetime
-import json
+import logging
 import pathlib
-import requests
 import sqlite3
 import time
 
+import numpy as np
+import requests
 import tqdm
 
 import feature
 import database
+import fingerprint
+import osm_extract
+import overpass
 import util
 
 
-def run_overpass_query(query):
-    overpass_url = "https://overpass-api.de/api/interpreter"
-    params = {'data': query}
-    headers = {'User-Agent': 'zidel'}
-    request = requests.get(overpass_url,
-                           params=params,
-                           headers=headers)
-    request.raise_for_status()
-    return request.text
-
-
-def get_points_from_overpass(feature_name):
-    result = run_overpass_query(feature.overpass_query(feature_name))
-    data = json.loads(result)
+def get_points(feature_name, extract=None):
+    if extract is not None:
+        osm = osm_extract.load(extract, feature_name)
+    else:
+        osm = overpass.Client().load(feature.overpass_query(feature_name))
+    return osm.points()
+
+
+def unique_tiles(lat, lon, zoom):
+    """Tile positions covering the points, without duplicates"""
+    x, y = util.deg2tile_array(lat, lon, zoom)
+    x, y = util.unpack_positions(np.unique(util.pack_positions(x, y)))
+    return list(zip(x.tolist(), y.tolist()))
+
+
+def write_osm_scores(db, image_dir, feature_name, tile_hashes, tiles=()):
+    """Registers downloaded (z, x, y, tile_hash) tiles, then gives them and
+    tile_hashes a score of 1.0 from OSM"""
+    tiles, fingerprints, unchanged = fingerprint.compare(db, image_dir, tiles)
+    tile_hashes = list(tile_hashes) \
+        + [tile_hash for _, _, _, tile_hash in tiles]
+    while True:
+        try:
+            with db.transaction('write_fake_scores_from_osm') as c:
+                fingerprint.register(c, tiles, fingerprints, unchanged)
+                timestamp = datetime.datetime.now().isoformat()
+                database.write_scores(c, [(tile_hash, feature_name, 1.0,
+                                           'OSM', timestamp)
+                                          for tile_hash in tile_hashes])
+        except sqlite3.OperationalError as e:
+            if database.temporary_error(e):
+                time.sleep(1)
+                continue
+            else:
+                raise
+        break
+
+
+def download_tiles(db, image_dir, nib_api_key, feature_name, z, positions,
+                   workers, batch_size=64):
+    """Downloads the tiles at positions concurrently, registering them in
+    batches as they finish so that a failure doesn't leave unregistered
+    files behind. Returns the number of failed downloads"""
+    batch = []
+    failed = 0
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        futures = {executor.submit(util.download_single_tile,
+                                   image_dir, nib_api_key, z, x, y,
+                                   retry=False): (x, y)
+                   for x, y in positions}
+        for future in tqdm.tqdm(concurrent.futures.as_completed(futures),
+                                total=len(futures)):
+            x, y = futures[future]
+            try:
+                _, tile_hash = future.result()
+            except (requests.exceptions.RequestException, OSError) as e:
+                # Left for the next run
+                logging.debug(f'Failed to download {z}/{x}/{y}', exc_info=e)
+                failed += 1
+                continue
 
-    points = []
-    for element in data['elements']:
-        if 'center' in element:
-            # {'type': 'way', 'id': 1023439043,
-            #  'center': {'lat': 59.9195945, 'lon': 10.632018}}
-            points.append(element['center'])
-        elif 'lat' in element and 'lon' in element:
-            # {'type': 'node', 'id': 9439577222,
-            #  'lat': 59.9362591, 'lon': 10.9199213}
-            points.append({'lat': element['lat'], 'lon': element['lon']})
-        else:
-            raise RuntimeError(str(element))
+            batch.append((z, x, y, tile_hash))
+            if len(batch) >= batch_size:
+                write_osm_scores(db, image_dir, feature_name, [], batch)
+                batch = []
 
-    return points
+    if batch:
+        write_osm_scores(db, image_dir, feature_name, [], batch)
+    return failed
 
 
 def main():
@@ -51,42 +96,34 @@ def main():
     parser.add_argument('--zoom', type=int, default=18)
     parser.add_argument('--tile-path', type=str, default='data/images')
     parser.add_argument('--feature', type=str, required=True)
+    parser.add_argument('--extract', type=str,
+                        help='Read a local .osm.pbf or .osm file instead of '
+                             'querying Overpass')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='Concurrent tile downloads')
     args = parser.parse_args()
 
     db = database.Database(args.database)
     nib_api_key = util.load_key(args.NiB_key)
     image_dir = pathlib.Path(args.tile_path)
 
-    for point in tqdm.tqdm(get_points_from_overpass(args.feature)):
-        xtile, ytile = util.deg2tile(point['lat'], point['lon'], args.zoom)
-
-        have_tiles = False
-        with db.transaction('check_for_existing_tiles') as c:
-            if database.get_tile_hash(c, args.zoom, xtile, ytile):
-                have_tiles = True
-
-        if not have_tiles:
-            _, tile_hash = util.download_single_tile(
-                    image_dir, nib_api_key, args.zoom, xtile, ytile)
-            with db.transaction('add_osm_tile') as c:
-                database.add_tile_hash(c, args.zoom, xtile, ytile, tile_hash)
-
-        while True:
-            try:
-                with db.transaction('write_fake_score_from_osm') as c:
-                    now = datetime.datetime.now()
-                    timestamp = now.isoformat()
-                    for tile_hash in database.get_tile_hash(
-                            c, args.zoom, xtile, ytile):
-                        database.write_score(c, tile_hash, args.feature, 1.0,
-                                             'OSM', timestamp)
-            except sqlite3.OperationalError as e:
-                if database.temporary_error(e):
-                    time.sleep(1)
-                    continue
-                else:
-                    raise
-            break
+    lat, lon = get_points(args.feature, args.extract)
+    positions = unique_tiles(lat, lon, args.zoom)
+
+    with db.transaction('check_for_existing_tiles') as c:
+        existing = database.tile_hashes_at(c, args.zoom, positions)
+    have_tiles = {(x, y) for x, y, _ in existing}
+    missing = [position for position in positions
+               if position not in have_tiles]
+    print(f'{len(lat)} points in {len(positions)} tiles, '
+          f'{len(missing)} to download')
+
+    write_osm_scores(db, image_dir, args.feature,
+                     [tile_hash for _, _, tile_hash in existing])
+    failed = download_tiles(db, image_dir, nib_api_key, args.feature,
+                            args.zoom, missing, args.workers)
+    if failed:
+        print(f'{failed} tiles failed to download, run again to retry them')
 
 
 if __name__ == '__main__':
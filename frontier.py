@@ -0,0 +1,75 @@
+import heapq
+import itertools
+
+import database
+
+
+class Frontier(object):
+    """Priority queue of positions to download, highest priority first and
+    newest first among equal priorities.
+
+    Positions are packed into one integer each. Changing the priority of a
+    queued position pushes a new heap entry and leaves the old one to be
+    skipped when popped, so push and pop are both O(log n). Changes since the
+    last sync() are written to the download_frontier table, so an
+    interrupted run can pick up where it stopped.
+    """
+
+    def __init__(self, entries=()):
+        self._heap = []
+        self._priority = {}
+        self._counter = itertools.count()
+        self._dirty = set()
+
+        for position_id, priority in entries:
+            self._push_id(position_id, priority)
+        self._dirty.clear()
+
+    @classmethod
+    def load(cls, cursor):
+        return cls(database.download_frontier(cursor))
+
+    def __len__(self):
+        return len(self._priority)
+
+    def __contains__(self, position):
+        return database.position_id(*position) in self._priority
+
+    def push(self, z, x, y, priority):
+        """Adds the position, or raises its priority if already queued"""
+        self._push_id(database.position_id(z, x, y), priority)
+
+    def _push_id(self, position_id, priority):
+        old_priority = self._priority.get(position_id)
+        if old_priority is not None and old_priority >= priority:
+            return
+
+        self._priority[position_id] = priority
+        heapq.heappush(self._heap,
+                       (-priority, -next(self._counter), position_id))
+        self._dirty.add(position_id)
+
+    def pop(self):
+        """Removes and returns the (z, x, y) with the highest priority"""
+        while self._heap:
+            priority, _, position_id = heapq.heappop(self._heap)
+            if self._priority.get(position_id) != -priority:
+                # Stale entry from before a priority change
+                continue
+
+            del self._priority[position_id]
+            self._dirty.add(position_id)
+            return database.position_from_id(position_id)
+
+        raise IndexError('pop from empty frontier')
+
+    def sync(self, cursor):
+        """Writes changes since the last sync to the database"""
+        database.update_download_frontier(
+                cursor,
+                [(position_id, self._priority[position_id])
+                 for position_id in self._dirty
+                 if position_id in self._priority],
+                [position_id for position_id in self._dirty
+                 if position_id not in self._priority])
+        self._dirty.clear()
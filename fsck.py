@@ -1,72 +1,239 @@
 import argparse
-import pathlib
+import concurrent.futures
+import hashlib
+import json
 import os
+import pathlib
+import re
+import time
 
-import sqlite3
+import numpy as np
+import tqdm
 
 import database
 import util
 
 
+suffix_pattern = re.compile('^[0-9a-f]{62}$')
+verify_chunk_size = 64
+# Downloaded tiles are written before their hashes are registered, which the
+# downloader does in batches every couple of seconds or later if the database
+# is busy. Orphans younger than this may be on their way in
+orphan_grace_seconds = 10 * 60
+
+
 def check_variants_of_validation_tiles_not_in_training_set(db):
-    print('Checking for tiles that should be in the validation set')
+    print('Checking for positions in both the training and validation set')
 
-    failure_count = 0
     with db.transaction('fsck_check_train_validate_overlap') as c:
-        c.execute('''select count(*)
-                     from tile_positions
-                     where (z, x, y) not in (
-                         select z, x, y
-                         from tile_positions
-                         natural inner join validation_set
-                         )
+        c.execute('''select feature_name, count(*)
+                     from training_set
+                     join validation_set
+                         using (feature_name, z, x, y)
+                     group by feature_name
                   ''')
-        failure_count = c.fetchone()[0]
-
-    if failure_count > 0:
-        print(f'Found {failure_count} tiles that should be in validation')
-
-
-def tile_hash_not_in_database(db, tile_path):
-    print('Checking for tiles on disk that are not in the database')
-    for prefix in os.listdir(tile_path):
-        for file_name in os.listdir(tile_path / prefix):
-            suffix = file_name.split('.')[0]
-            tile_hash = prefix + suffix
-
-            while True:
-                try:
-                    with db.transaction('fsck_check_for_tile_not_in_db') as c:
-                        database.get_tile_pos(c, tile_hash)
-                    break
-                except sqlite3.OperationalError:
-                    pass
-
-
-def tile_hash_not_on_disk(db, tile_path):
-    print('Checking for tiles in the database that are not on disk')
-    failure_count = 0
-    with db.transaction('fsck_check_for_missing_tile_file') as c:
-        for tile_hash in database.all_tile_hashes(c):
-            image_path = util.tile_to_paths(tile_path, tile_hash)
-            if not image_path.exists():
-                failure_count += 1
-
-    if failure_count > 0:
-        print(f'Found {failure_count} hashes without a file')
+        overlaps = c.fetchall()
+
+    for feature_name, failure_count in overlaps:
+        print(f'Found {failure_count} {feature_name} positions in both sets')
+
+
+def scan_prefix(directory):
+    """Returns ([(tile_hash, mtime)], [stray paths]) for one prefix
+    directory of the tile store"""
+    tiles = []
+    stray = []
+    prefix = os.path.basename(directory)
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            suffix, _, extension = entry.name.partition('.')
+            if extension == 'jpeg' and suffix_pattern.match(suffix) \
+                    and entry.is_file():
+                tiles.append((prefix + suffix, entry.stat().st_mtime))
+            else:
+                stray.append(entry.path)
+    return tiles, stray
+
+
+def scan_tile_store(tile_path, workers):
+    """Lists every tile in the store, as (tile_hash, mtime) pairs, and any
+    file that isn't named like a tile"""
+    prefixes = []
+    stray = []
+    with os.scandir(tile_path) as entries:
+        for entry in entries:
+            if entry.is_dir() and re.match('^[0-9a-f]{2}$', entry.name):
+                prefixes.append(entry.path)
+            else:
+                stray.append(entry.path)
+
+    tiles = []
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        for prefix_tiles, prefix_stray in executor.map(scan_prefix, prefixes):
+            tiles.extend(prefix_tiles)
+            stray.extend(prefix_stray)
+    return tiles, stray
+
+
+def pack_hashes(tile_hashes):
+    """Hex hashes as a sorted array of 32 byte strings"""
+    return np.unique(np.array([bytes.fromhex(str(tile_hash))
+                               for tile_hash in tile_hashes],
+                              dtype='S32'))
+
+
+def unpack_hashes(packed):
+    data = packed.tobytes().hex()
+    return [data[i:i + 64] for i in range(0, len(data), 64)]
+
+
+def in_sorted(values, sorted_values):
+    """Which of values are in the sorted array sorted_values"""
+    if len(sorted_values) == 0:
+        return np.zeros(len(values), dtype=bool)
+    index = np.minimum(np.searchsorted(sorted_values, values),
+                       len(sorted_values) - 1)
+    return sorted_values[index] == values
+
+
+def set_differences(on_disk, in_database):
+    """Returns (on disk only, in database only) for two packed hash arrays"""
+    return (on_disk[~in_sorted(on_disk, in_database)],
+            in_database[~in_sorted(in_database, on_disk)])
+
+
+def verify_file(tile_path, tile_hash):
+    h = hashlib.sha256()
+    try:
+        with open(util.tile_to_paths(tile_path, tile_hash), 'rb') as f:
+            h.update(f.read())
+    except OSError:
+        return False
+    return h.hexdigest() == tile_hash
+
+
+def verify_files(tile_path, tile_hashes, workers):
+    """Returns the hashes whose file content doesn't match"""
+    corrupt = []
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        results = executor.map(verify_file,
+                               [tile_path] * len(tile_hashes),
+                               tile_hashes,
+                               chunksize=verify_chunk_size)
+        for tile_hash, ok in tqdm.tqdm(zip(tile_hashes, results),
+                                       total=len(tile_hashes)):
+            if not ok:
+                corrupt.append(tile_hash)
+    return corrupt
+
+
+def load_state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_state(path, state):
+    partial_path = path.with_suffix('.partial')
+    with open(partial_path, 'w') as f:
+        json.dump(state, f)
+    partial_path.rename(path)
+
+
+def quarantine(paths, tile_path, quarantine_path):
+    for path in paths:
+        destination = quarantine_path / pathlib.Path(path).relative_to(
+                tile_path)
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(path, destination)
+
+
+def check_tile_store(db, tile_path, state_path, incremental, repair,
+                     quarantine_path, workers, quarantine_stray=False):
+    print('Checking tile files against the database')
+    started = time.time()
+    state = load_state(state_path)
+
+    tiles, stray = scan_tile_store(tile_path, workers)
+    with db.transaction('fsck_get_all_tile_hashes') as c:
+        in_database = pack_hashes(tile_hash
+                                  for tile_hash, in
+                                  database.all_tile_hashes(c))
+    on_disk = pack_hashes(tile_hash for tile_hash, _ in tiles)
+    orphans, missing = set_differences(on_disk, in_database)
+    print(f'{len(on_disk)} files, {len(in_database)} hashes in the database')
+    print(f'Found {len(orphans)} files that are not in the database')
+    print(f'Found {len(missing)} hashes without a file')
+    print(f'Found {len(stray)} files that are not tiles')
+    for path in sorted(stray)[:10]:
+        print(f'  {path}')
+
+    last_run = state.get('last_run', 0.0) if incremental else 0.0
+    orphan_set = set(unpack_hashes(orphans))
+    to_verify = [tile_hash for tile_hash, mtime in tiles
+                 if mtime >= last_run and tile_hash not in orphan_set]
+    print(f'Verifying {len(to_verify)} files')
+    corrupt = verify_files(tile_path, to_verify, workers)
+    print(f'Found {len(corrupt)} files with the wrong content')
+
+    if repair:
+        recent = set(tile_hash for tile_hash, mtime in tiles
+                     if mtime > started - orphan_grace_seconds)
+        orphan_paths = [util.tile_to_paths(tile_path, tile_hash)
+                        for tile_hash in sorted(orphan_set - recent)]
+        if orphan_set & recent:
+            print(f'Leaving {len(orphan_set & recent)} recent files that '
+                  f'may still be registered by a running download')
+        corrupt_paths = [util.tile_to_paths(tile_path, tile_hash)
+                         for tile_hash in corrupt]
+        # Other files may well have been put there on purpose
+        moved = orphan_paths + corrupt_paths
+        if quarantine_stray:
+            moved += stray
+        quarantine(moved, tile_path, quarantine_path)
+        print(f'Moved {len(moved)} files to {quarantine_path}')
+
+        refetch = corrupt + unpack_hashes(missing)
+        with db.transaction('fsck_reset_last_checked') as c:
+            database.reset_last_checked(c, refetch)
+        print(f'Marked {len(refetch)} positions for download')
+
+    if not corrupt or repair:
+        state['last_run'] = started
+        save_state(state_path, state)
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--database', default='data/tiles.db')
     parser.add_argument('--tile-path', type=str, default='data/images')
+    parser.add_argument('--state', type=str, default='data/fsck.json')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only verify the content of files modified '
+                             'since the last clean run')
+    parser.add_argument('--repair', action='store_true',
+                        help='Quarantine bad files and mark positions with '
+                             'missing or corrupt tiles for download')
+    parser.add_argument('--quarantine', type=str, default='data/quarantine')
+    parser.add_argument('--quarantine-stray', action='store_true',
+                        help='With --repair, also quarantine files that '
+                             'are not named like tiles')
+    parser.add_argument('--workers', type=int)
     args = parser.parse_args()
 
     db = database.Database(args.database)
 
     check_variants_of_validation_tiles_not_in_training_set(db)
-    tile_hash_not_in_database(db, pathlib.Path(args.tile_path))
-    tile_hash_not_on_disk(db, pathlib.Path(args.tile_path))
+    check_tile_store(db,
+                     pathlib.Path(args.tile_path),
+                     pathlib.Path(args.state),
+                     args.incremental,
+                     args.repair,
+                     pathlib.Path(args.quarantine),
+                     args.workers,
+                     args.quarantine_stray)
 
 
 if __name__ == '__main__':
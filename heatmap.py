@@ -0,0 +1,204 @@
+import argparse
+import datetime
+import pathlib
+import sys
+
+import numpy as np
+import PIL.Image
+
+import database
+import util
+
+
+base_zoom = 18
+tile_size = 256
+# Each output tile is 256 pixels wide, i.e. 2^8 cells of the zoom 8 levels
+# further in
+pixels_zoom_offset = 8
+statistics = ['max', 'mean']
+
+
+class Level(object):
+    """Aggregated scores for every non-empty cell at one zoom level"""
+
+    def __init__(self, x, y, maximum, total, count):
+        self.x = x
+        self.y = y
+        self.maximum = maximum
+        self.total = total
+        self.count = count
+
+    def value(self, statistic):
+        if statistic == 'max':
+            return self.maximum
+        elif statistic == 'mean':
+            return self.total / self.count
+        raise ValueError(statistic)
+
+    def parent(self):
+        keys = util.pack_positions(self.x >> 1, self.y >> 1)
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+
+        starts = np.flatnonzero(np.r_[len(keys) > 0, keys[1:] != keys[:-1]])
+        parent_x, parent_y = util.unpack_positions(keys[starts])
+        return Level(parent_x,
+                     parent_y,
+                     np.maximum.reduceat(self.maximum[order], starts),
+                     np.add.reduceat(self.total[order], starts),
+                     np.add.reduceat(self.count[order], starts))
+
+
+def build_levels(x, y, scores, min_zoom):
+    """Aggregates zoom 18 scores bottom-up into every zoom down to min_zoom"""
+    scores = np.asarray(scores, dtype=np.float64)
+    levels = {base_zoom: Level(np.asarray(x, dtype=np.int64),
+                               np.asarray(y, dtype=np.int64),
+                               scores,
+                               scores,
+                               np.ones(len(scores)))}
+    for zoom in range(base_zoom - 1, min_zoom - 1, -1):
+        levels[zoom] = levels[zoom + 1].parent()
+    return levels
+
+
+def colourize(values):
+    """Maps values in [0, 1] to yellow-to-red RGBA, NaN is transparent"""
+    missing = np.isnan(values)
+    values = np.clip(np.nan_to_num(values), 0.0, 1.0)
+
+    rgba = np.zeros(values.shape + (4,), dtype=np.uint8)
+    rgba[..., 0] = 255
+    rgba[..., 1] = (255 * (1.0 - values)).astype(np.uint8)
+    rgba[..., 3] = np.where(missing, 0, 64 + 191 * values).astype(np.uint8)
+    return rgba
+
+
+def render_zoom(level, cell_zoom, zoom, statistic, scale, only_tiles,
+                output_dir):
+    """Renders the tiles at zoom from cells at cell_zoom, only the tiles in
+    only_tiles if it isn't None. Tiles in only_tiles that have no cells left
+    are deleted. Returns the number of tiles written."""
+    shift = cell_zoom - zoom
+    cells_per_side = 1 << shift
+    cell_pixels = tile_size // cells_per_side
+
+    tile_keys = util.pack_positions(level.x >> shift, level.y >> shift)
+    order = np.argsort(tile_keys, kind='stable')
+    tile_keys = tile_keys[order]
+    cell_x = level.x[order]
+    cell_y = level.y[order]
+    values = level.value(statistic)[order] / scale
+
+    starts = np.flatnonzero(np.r_[len(tile_keys) > 0,
+                                  tile_keys[1:] != tile_keys[:-1]])
+    ends = np.r_[starts[1:], len(tile_keys)][:len(starts)]
+    if only_tiles is not None:
+        # Tiles that lost all their scores
+        for key in np.setdiff1d(only_tiles, tile_keys[starts]):
+            tile_x, tile_y = util.unpack_positions(key)
+            path = output_dir / f'{zoom}/{tile_x}/{tile_y}.png'
+            path.unlink(missing_ok=True)
+
+        wanted = np.isin(tile_keys[starts], only_tiles)
+        starts = starts[wanted]
+        ends = ends[wanted]
+
+    for start, end in zip(starts, ends):
+        tile_x, tile_y = util.unpack_positions(tile_keys[start])
+        grid = np.full((cells_per_side, cells_per_side), np.nan)
+        grid[cell_y[start:end] - (tile_y << shift),
+             cell_x[start:end] - (tile_x << shift)] = values[start:end]
+        pixels = np.repeat(np.repeat(grid, cell_pixels, axis=0),
+                           cell_pixels, axis=1)
+
+        path = output_dir / f'{zoom}/{tile_x}/{tile_y}.png'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        PIL.Image.fromarray(colourize(pixels), 'RGBA').save(path)
+
+    return len(starts)
+
+
+def render(db, feature_name, output_dir, min_zoom, max_zoom, scale, full):
+    started = datetime.datetime.now().isoformat()
+
+    with db.transaction('get_heatmap_scores') as c:
+        rows = database.position_scores(c, feature_name, base_zoom)
+        changed = {}
+        for statistic in statistics:
+            last = None if full else database.last_heatmap_render(
+                    c, feature_name, statistic)
+            if last is not None:
+                changed[statistic] = database.positions_scored_since(
+                        c, feature_name, base_zoom, last)
+
+    # Without any scores left the changed tiles still need deleting
+    x, y, scores = zip(*rows) if rows else ([], [], [])
+    if not rows:
+        print(f'No scores for {feature_name}')
+    levels = build_levels(x, y, scores,
+                          min(min_zoom + pixels_zoom_offset, base_zoom))
+
+    for statistic in statistics:
+        only_base = None
+        if statistic in changed:
+            positions = changed[statistic]
+            if not positions:
+                print(f'{statistic}: nothing changed')
+                continue
+            only_base = np.array(positions, dtype=np.int64)
+
+        tile_count = 0
+        for zoom in range(min_zoom, max_zoom + 1):
+            cell_zoom = min(zoom + pixels_zoom_offset, base_zoom)
+            only_tiles = None
+            if only_base is not None:
+                shift = base_zoom - zoom
+                only_tiles = np.unique(util.pack_positions(
+                    only_base[:, 0] >> shift,
+                    only_base[:, 1] >> shift))
+
+            tile_count += render_zoom(levels[cell_zoom],
+                                      cell_zoom,
+                                      zoom,
+                                      statistic,
+                                      scale,
+                                      only_tiles,
+                                      output_dir / feature_name / statistic)
+
+        with db.transaction('mark_heatmap_rendered') as c:
+            database.mark_heatmap_rendered(c, feature_name, statistic,
+                                           started)
+        print(f'{statistic}: rendered {tile_count} tiles')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--database', default='data/tiles.db')
+    parser.add_argument('--output', type=str, default='data/heatmap')
+    parser.add_argument('--feature', type=str, required=True)
+    parser.add_argument('--min-zoom', type=int, default=5)
+    parser.add_argument('--max-zoom', type=int, default=16)
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='Scores are divided by this and clipped to '
+                             '[0, 1] before colouring')
+    parser.add_argument('--full', action='store_true',
+                        help='Render every tile, not just the ones with '
+                             'new scores since the last run')
+    args = parser.parse_args()
+
+    assert 0 <= args.min_zoom <= args.max_zoom <= base_zoom
+
+    db = database.Database(args.database)
+    render(db,
+           args.feature,
+           pathlib.Path(args.output),
+           args.min_zoom,
+           args.max_zoom,
+           args.scale,
+           args.full)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
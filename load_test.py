@@ -0,0 +1,178 @@
+import argparse
+import concurrent.futures
+import datetime
+import io
+import logging
+import pathlib
+import random
+import sys
+import tempfile
+import threading
+import time
+
+import PIL.Image
+import requests
+import werkzeug.serving
+
+import database
+import util
+import web
+
+
+feature_name = 'solar'
+
+
+def build_synthetic_database(data_dir, size):
+    """Creates a size x size grid of random tiles, all with scores"""
+    db_path = data_dir / 'tiles.db'
+    tile_path = data_dir / 'images'
+    db = database.Database(db_path)
+
+    timestamp = datetime.datetime.now().isoformat()
+    base_x, base_y = util.deg2tile(59.91, 10.75, 18)
+    with db.transaction('build_synthetic_database') as c:
+        for x in range(base_x, base_x + size):
+            for y in range(base_y, base_y + size):
+                image = PIL.Image.new('RGB', (256, 256), (
+                    random.randrange(256),
+                    random.randrange(256),
+                    random.randrange(256)))
+                image.putpixel((0, 0), (x % 256, y % 256, 0))
+                data = io.BytesIO()
+                image.save(data, format='JPEG')
+
+                path = tile_path / 'tmp.jpeg'
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_bytes(data.getvalue())
+                tile_hash = util.hash_file(path)
+                final_path = util.tile_to_paths(tile_path, tile_hash)
+                final_path.parent.mkdir(parents=True, exist_ok=True)
+                path.rename(final_path)
+
+                database.add_tile_hash(c, 18, x, y, tile_hash)
+                database.write_score(c, tile_hash, feature_name,
+                                     random.random(), 'synthetic', timestamp)
+
+    return db_path, tile_path
+
+
+def review_one_tile(session, url, timings):
+    start = time.monotonic()
+    r = session.get(f'{url}/api/review/next_tile')
+    timings.append(('next_tile', time.monotonic() - start))
+    if r.status_code != 200:
+        return False
+    tile = r.json()
+
+    start = time.monotonic()
+    session.get(f'{url}{tile["mosaic"]}').raise_for_status()
+    timings.append(('mosaic', time.monotonic() - start))
+
+    start = time.monotonic()
+    session.post(f'{url}/api/review/response',
+                 json={'tile_hash': tile['tile_hash'],
+                       'response': 'false'}).raise_for_status()
+    timings.append(('response', time.monotonic() - start))
+    return True
+
+
+def run_clients(url, request_count, concurrency):
+    timings = []
+    remaining = [request_count]
+    lock = threading.Lock()
+
+    def client():
+        session = requests.Session()
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+
+            if not review_one_tile(session, url, timings):
+                return
+
+    start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        for future in [executor.submit(client) for _ in range(concurrency)]:
+            future.result()
+    duration = time.monotonic() - start
+
+    return timings, duration
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    index = min(int(len(values) * fraction), len(values) - 1)
+    return values[index]
+
+
+def print_report(timings, duration):
+    print(f'{len(timings)} requests in {duration:.1f}s, '
+          f'{len(timings) / duration:.1f} requests/s')
+    print('Endpoint       count    p50 ms    p99 ms')
+    for endpoint in ['next_tile', 'mosaic', 'response']:
+        values = [t for name, t in timings if name == endpoint]
+        if not values:
+            continue
+        print('{:12s} {: 7d} {: 9.1f} {: 9.1f}'.format(
+            endpoint,
+            len(values),
+            1000 * percentile(values, 0.50),
+            1000 * percentile(values, 0.99)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', type=str,
+                        help='Test a running server instead of starting one, '
+                             'it must use the database from --data-dir')
+    parser.add_argument('--data-dir', type=str,
+                        help='Where to put the synthetic database, a '
+                             'temporary directory by default')
+    parser.add_argument('--build-only', action='store_true')
+    parser.add_argument('--grid-size', type=int, default=60)
+    parser.add_argument('--reviews', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=8)
+    args = parser.parse_args()
+
+    # Don't print every request
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        data_dir = pathlib.Path(args.data_dir or tmp)
+        if not (data_dir / 'tiles.db').exists():
+            print(f'Building {args.grid_size}x{args.grid_size} synthetic '
+                  f'database in {data_dir}')
+            build_synthetic_database(data_dir, args.grid_size)
+        if args.build_only:
+            return 0
+
+        server = None
+        url = args.url
+        if url is None:
+            app = web.create_app({
+                'DATABASE': str(data_dir / 'tiles.db'),
+                'TILE_PATH': str(data_dir / 'images'),
+                'FEATURES': [feature_name],
+                'DOWNLOAD_MISSING': False,
+                })
+            server = werkzeug.serving.make_server('127.0.0.1', 0, app,
+                                                  threaded=True)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            url = f'http://127.0.0.1:{server.port}'
+
+        try:
+            timings, duration = run_clients(url,
+                                            args.reviews,
+                                            args.concurrency)
+        finally:
+            if server is not None:
+                server.shutdown()
+
+    print_report(timings, duration)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,15 @@
+import datetime
+import json
+import pathlib
+
 import tensorflow as tf
 import tensorflow.keras as keras
 
+import util
+
+
+metadata_name = 'metadata.json'
+
 
 class BinaryIoU(keras.metrics.MeanIoU):
     def __init__(self):
@@ -26,7 +35,7 @@ def pool(input_layer):
     return keras.layers.MaxPooling2D()(input_layer)
 
 
-def custom(input_layer, _):
+def custom(input_layer, _, __):
     processed = input_layer / 255.0
 
     conv_1 = conv_layer(64, 3)(processed)
@@ -65,59 +74,95 @@ def custom(input_layer, _):
     return Model(pool_5)
 
 
-def vgg19(input_layer, input_shape):
+def custom_small(input_layer, _, __):
+    """A trimmed down custom model, for screening tiles cheaply"""
+    processed = input_layer / 255.0
+
+    conv_1 = conv_layer(32, 3)(processed)
+    pool_1 = pool(conv_1)
+
+    conv_2 = conv_layer(64, 3)(pool_1)
+    pool_2 = pool(conv_2)
+
+    conv_3 = conv_layer(128, 3)(pool_2)
+    conv_4 = conv_layer(128, 3)(conv_3)
+    pool_3 = pool(conv_4)
+
+    class Model(object):
+        def __init__(self, output):
+            self.output = output
+            self.trainable = True
+    return Model(pool_3)
+
+
+def vgg19(input_layer, input_shape, weights):
     processed = tf.keras.applications.vgg19.preprocess_input(input_layer)
     return keras.applications.vgg19.VGG19(
             include_top=False,
             input_tensor=processed,
             input_shape=input_shape,
+            weights=weights,
             )
 
 
-def vgg16(input_layer, input_shape):
+def vgg16(input_layer, input_shape, weights):
     processed = tf.keras.applications.vgg16.preprocess_input(input_layer)
     return keras.applications.vgg16.VGG16(
             include_top=False,
             input_tensor=processed,
             input_shape=input_shape,
+            weights=weights,
             )
 
 
-def mobile_v2(input_layer, input_shape):
+def mobile_v2(input_layer, input_shape, weights):
     processed = tf.keras.applications.mobilenet_v2.preprocess_input(
             input_layer)
     return keras.applications.mobilenet_v2.MobileNetV2(
             include_top=False,
             input_tensor=processed,
             input_shape=input_shape,
+            weights=weights,
             )
 
 
-def resnet_152_v2(input_layer, input_shape):
+def resnet_152_v2(input_layer, input_shape, weights):
     processed = tf.keras.applications.resnet_v2.preprocess_input(input_layer)
     return keras.applications.resnet_v2.ResNet152V2(
             include_top=False,
             input_tensor=processed,
             input_shape=input_shape,
+            weights=weights,
             )
 
 
-def inception_resnet_v2(input_layer, input_shape):
+def inception_resnet_v2(input_layer, input_shape, weights):
     processed = tf.keras.applications.inception_resnet_v2.preprocess_input(
             input_layer)
     return keras.applications.inception_resnet_v2.InceptionResNetV2(
             include_top=False,
             input_tensor=processed,
             input_shape=input_shape,
+            weights=weights,
             )
 
 
-def get(model_type, result_type, weights_from=None, learning_rate=1e-4):
-    input_shape = (256, 256, 3)
-    inputs = keras.layers.Input(input_shape)
+def get(model_type, result_type, weights_from=None, learning_rate=1e-4,
+        input_size=256):
+    """Tiles are always 256x256, with a smaller input_size they are scaled
+    down inside the model. The ImageNet weights are only fetched when there
+    are no weights to load"""
+    tile_shape = (256, 256, 3)
+    inputs = keras.layers.Input(tile_shape)
+
+    input_shape = (input_size, input_size, 3)
+    resized = inputs
+    if input_size != tile_shape[0]:
+        resized = keras.layers.Resizing(input_size, input_size)(inputs)
 
     factory, dense_width = {
             'custom': (custom, 1024),
+            'custom_small': (custom_small, 256),
             'VGG19': (vgg19, 1024),
             'VGG19_reduced': (vgg19, 512),
             'VGG16': (vgg16, 1024),
@@ -125,7 +170,8 @@ def get(model_type, result_type, weights_from=None, learning_rate=1e-4):
             'ResNetV2': (resnet_152_v2, 512),
             'InceptionResNetV2': (inception_resnet_v2, 1024),
             }[model_type]
-    feature_extraction = factory(inputs, input_shape)
+    feature_extraction = factory(resized, input_shape,
+                                 None if weights_from else 'imagenet')
     feature_extraction.trainable = False
 
     flatten = keras.layers.Flatten()(feature_extraction.output)
@@ -162,3 +208,51 @@ def get(model_type, result_type, weights_from=None, learning_rate=1e-4):
         model.load_weights(weights_from)
 
     return model
+
+
+def is_artifact(path):
+    return (pathlib.Path(path) / metadata_name).is_file()
+
+
+def read_metadata(path):
+    with open(pathlib.Path(path) / metadata_name) as f:
+        return json.load(f)
+
+
+def export(m, path, model_type, feature_name, input_size, version):
+    """Saves m as a SavedModel with everything needed to score tiles
+    without rebuilding it. The metadata is written last, so a directory
+    without it is an interrupted export"""
+    path = pathlib.Path(path)
+    m.save(str(path), include_optimizer=False, save_format='tf')
+
+    metadata = {
+            'version': version,
+            'model_type': model_type,
+            'feature': feature_name,
+            'input_size': input_size,
+            'exported': datetime.datetime.now().isoformat(),
+            }
+    with open(path / (metadata_name + '.partial'), 'w') as f:
+        json.dump(metadata, f, indent=2)
+    (path / (metadata_name + '.partial')).rename(path / metadata_name)
+
+
+def load(path):
+    """Loads an exported model for inference, returns (model, metadata)"""
+    # A published model is a symlink that may be swapped while loading, so
+    # the model and its metadata are read through the same target
+    path = pathlib.Path(path).resolve()
+    m = keras.models.load_model(str(path), compile=False)
+    return m, read_metadata(path)
+
+
+def load_for_scoring(model_type, result_type, path, input_size=256):
+    """Returns (model, version) from an exported model, or from an hdf5
+    weights file by building model_type around it"""
+    if is_artifact(path):
+        m, metadata = load(path)
+        return m, metadata['version']
+
+    m = get(model_type, result_type, path, input_size=input_size)
+    return m, util.hash_file(path)
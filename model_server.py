@@ -0,0 +1,384 @@
+import argparse
+import concurrent.futures
+import datetime
+import http.server
+import json
+import logging
+import pathlib
+import queue
+import sys
+import threading
+import time
+
+import numpy as np
+import PIL.Image
+import requests
+import sqlite3
+
+import database
+import feature
+import util
+
+
+log = logging.getLogger('model_server')
+
+default_url = 'http://127.0.0.1:5001'
+request_timeout = 60.0
+idle_interval = 0.5
+
+
+class ScoreWriter(object):
+    """Collects scores and writes them in bulk. Only used from the thread of
+    one Batcher, which owns the database connection"""
+
+    def __init__(self, db_path, feature_name, model_version, batch_size=256,
+                 flush_interval=2.0):
+        self._db_path = db_path
+        self._db = None
+        self._feature_name = feature_name
+        self._model_version = model_version
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._pending = []
+        self._last_flush = time.monotonic()
+
+    def add(self, scores):
+        timestamp = datetime.datetime.now().isoformat()
+        self._pending.extend(
+                (tile_hash, self._feature_name, score, self._model_version,
+                 timestamp)
+                for tile_hash, score in scores)
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        if not self._pending:
+            return
+        if len(self._pending) >= self._batch_size \
+                or time.monotonic() - self._last_flush >= self._flush_interval:
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        if not self._pending:
+            return
+
+        try:
+            if self._db is None:
+                self._db = database.Database(self._db_path)
+            with self._db.transaction('write_served_scores') as c:
+                # Hashes clients made up, or of tiles not registered yet,
+                # can't have scores
+                known = database.known_tile_hashes(
+                        c, set(row[0] for row in self._pending))
+                rows = [row for row in self._pending if row[0] in known]
+                database.write_scores(c, rows)
+            unknown = len(self._pending) - len(rows)
+        except sqlite3.OperationalError as e:
+            if database.temporary_error(e):
+                # Keep them and try again with the next flush
+                log.debug('Failed to write scores', exc_info=e)
+                return
+            log.exception(f'Dropping {len(self._pending)} scores')
+        except sqlite3.Error:
+            log.exception(f'Dropping {len(self._pending)} scores')
+        else:
+            if unknown:
+                log.info(f'Dropped {unknown} scores of unknown tiles')
+        self._pending = []
+
+
+class Batcher(object):
+    """Merges concurrent score requests for one model into batches.
+
+    A batch is started by the first request and run when it is full or when
+    max_delay seconds have passed since that request, whichever comes first.
+    predict takes a list of tile hashes and returns a score, or None for
+    tiles that couldn't be read, for each.
+    """
+
+    def __init__(self, predict, writer, max_batch_size=32, max_delay=0.05):
+        self._predict = predict
+        self._writer = writer
+        self._max_batch_size = max_batch_size
+        self._max_delay = max_delay
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run,
+                                        name='batcher',
+                                        daemon=True)
+        self._thread.start()
+
+    def submit(self, tile_hash):
+        """Returns a future with the score of the tile"""
+        future = concurrent.futures.Future()
+        self._queue.put((tile_hash, future))
+        return future
+
+    def close(self):
+        """Scores what is queued, writes all scores and stops"""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _next_batch(self):
+        """Returns (batch, stop)"""
+        try:
+            # Wake up now and then so the writer can flush when idle
+            first = self._queue.get(timeout=idle_interval)
+        except queue.Empty:
+            return [], False
+        if first is None:
+            return [], True
+
+        batch = [first]
+        deadline = time.monotonic() + self._max_delay
+        while len(batch) < self._max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+
+        return batch, False
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch, stop = self._next_batch()
+            try:
+                if batch:
+                    self._score(batch)
+                self._writer.maybe_flush()
+            except Exception as e:
+                # Keep serving, one bad batch shouldn't take the model down
+                log.exception('Failed to handle batch')
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+        self._writer.flush()
+
+    def _score(self, batch):
+        futures = {}
+        for tile_hash, future in batch:
+            futures.setdefault(tile_hash, []).append(future)
+        tile_hashes = list(futures)
+
+        try:
+            scores = self._predict(tile_hashes)
+        except Exception as e:
+            log.exception('Failed to score batch')
+            for future in (f for fs in futures.values() for f in fs):
+                future.set_exception(e)
+            return
+
+        # Answer before writing, a failed write must not leave requests
+        # hanging
+        for tile_hash, score in zip(tile_hashes, scores):
+            for future in futures[tile_hash]:
+                future.set_result(score)
+        self._writer.add([(tile_hash, score)
+                          for tile_hash, score in zip(tile_hashes, scores)
+                          if score is not None])
+
+
+class ModelPredictor(object):
+    """Scores tiles from the tile store with a Keras model"""
+
+    def __init__(self, m, image_dir):
+        self._model = m
+        self._image_dir = image_dir
+
+    def _read(self, tile_hash):
+        try:
+            with PIL.Image.open(util.tile_to_paths(self._image_dir,
+                                                   tile_hash)) as image:
+                return np.asarray(image.convert('RGB'), dtype=np.float32)
+        except OSError as e:
+            log.debug(f'Failed to read {tile_hash}', exc_info=e)
+            return None
+
+    def __call__(self, tile_hashes):
+        images = [self._read(tile_hash) for tile_hash in tile_hashes]
+        readable = [image for image in images if image is not None]
+        if not readable:
+            return [None] * len(tile_hashes)
+
+        predicted = iter(np.asarray(
+            self._model.predict_on_batch(np.stack(readable))).reshape(-1))
+        return [None if image is None else float(next(predicted))
+                for image in images]
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """POST /score with {"tile_hashes": [...]} and optionally "features"
+    and "wait". With wait the response has the scores, otherwise the tiles
+    are only queued"""
+
+    def do_GET(self):
+        if self.path != '/health':
+            self.send_error(404)
+            return
+
+        self._send_json(200, {'features': sorted(self.server.batchers)})
+
+    def do_POST(self):
+        if self.path != '/score':
+            self.send_error(404)
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length))
+            tile_hashes = [str(tile_hash)
+                           for tile_hash in body['tile_hashes']]
+            features = body.get('features') or sorted(self.server.batchers)
+            wait = bool(body.get('wait', True))
+        except (ValueError, KeyError, TypeError):
+            self.send_error(400)
+            return
+
+        unknown = [name for name in features
+                   if name not in self.server.batchers]
+        if unknown:
+            self.send_error(404, f'No model for {", ".join(unknown)}')
+            return
+
+        futures = {name: [(tile_hash,
+                           self.server.batchers[name].submit(tile_hash))
+                          for tile_hash in tile_hashes]
+                   for name in features}
+        if not wait:
+            self._send_json(202, {})
+            return
+
+        try:
+            scores = {name: {tile_hash: future.result(request_timeout)
+                             for tile_hash, future in pending}
+                      for name, pending in futures.items()}
+        except Exception:
+            self.send_error(500)
+            return
+
+        self._send_json(200, {'scores': scores})
+
+    def _send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        log.debug(fmt, *args)
+
+
+class Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, batchers):
+        super().__init__(address, Handler)
+        self.batchers = batchers
+
+    def server_close(self):
+        super().server_close()
+        for batcher in self.batchers.values():
+            batcher.close()
+
+
+class Client(object):
+    """Talks to a running model server"""
+
+    def __init__(self, url=default_url, timeout=request_timeout):
+        self._url = url.rstrip('/')
+        self._timeout = timeout
+
+    def score(self, tile_hashes, features=None):
+        """{feature: {tile_hash: score}}, scores are None for unreadable
+        tiles"""
+        response = requests.post(f'{self._url}/score',
+                                 json={'tile_hashes': list(tile_hashes),
+                                       'features': features,
+                                       'wait': True},
+                                 timeout=self._timeout)
+        response.raise_for_status()
+        return response.json()['scores']
+
+    def submit(self, tile_hashes, features=None):
+        """Queues tiles for scoring without waiting. Failures are logged and
+        ignored, the tiles are scored by the next batch run instead"""
+        if not tile_hashes:
+            return
+
+        try:
+            response = requests.post(f'{self._url}/score',
+                                     json={'tile_hashes': list(tile_hashes),
+                                           'features': features,
+                                           'wait': False},
+                                     timeout=5.0)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            log.debug('Failed to queue tiles for scoring', exc_info=e)
+
+
+def parse_model_spec(spec):
+    """feature=path"""
+    feature_name, sep, path = spec.partition('=')
+    if not sep or not path:
+        raise argparse.ArgumentTypeError(f'Expected feature=path, got {spec}')
+    feature.result_type(feature_name)
+    return feature_name, path
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--database', default='data/tiles.db')
+    parser.add_argument('--tile-path', type=str, default='data/images')
+    parser.add_argument('--serve', type=parse_model_spec, action='append',
+                        required=True, metavar='FEATURE=MODEL',
+                        help='Weights file or model from export_model.py')
+    parser.add_argument('--model', default='VGG19',
+                        help='Model type, for weights files')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-delay', type=float, default=0.05,
+                        help='Seconds to wait for a batch to fill up')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    # Only the server needs TensorFlow
+    import model
+
+    db_path = pathlib.Path(args.database)
+    image_dir = pathlib.Path(args.tile_path)
+    batchers = {}
+    for feature_name, path in args.serve:
+        m, model_version = model.load_for_scoring(
+                args.model, feature.result_type(feature_name), path)
+        print(f'Serving {feature_name} from {path}, version {model_version}')
+        batchers[feature_name] = Batcher(
+                ModelPredictor(m, image_dir),
+                ScoreWriter(db_path, feature_name, model_version),
+                args.max_batch_size,
+                args.max_delay)
+
+    server = Server((args.host, args.port), batchers)
+    print(f'Listening on {args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,126 @@
+import collections
+import concurrent.futures
+import io
+import logging
+import threading
+
+import PIL.Image
+import PIL.ImageDraw
+
+import util
+
+
+log = logging.getLogger('mosaic')
+
+tile_size = 256
+missing_colour = (128, 128, 128)
+outline_colour = (255, 0, 0)
+
+
+def render(tile_path, neighbours):
+    """Stitches a 3x3 list of tile hashes into one JPEG, missing tiles are
+    grey and the centre tile is outlined"""
+    image = PIL.Image.new('RGB', (3 * tile_size, 3 * tile_size),
+                          missing_colour)
+    for row, hashes in enumerate(neighbours):
+        for column, tile_hash in enumerate(hashes):
+            if tile_hash is None:
+                continue
+
+            try:
+                with PIL.Image.open(util.tile_to_paths(tile_path,
+                                                       tile_hash)) as tile:
+                    image.paste(tile.convert('RGB'),
+                                (column * tile_size, row * tile_size))
+            except (OSError, ValueError) as e:
+                log.debug(f'Failed to read tile {tile_hash}', exc_info=e)
+
+    draw = PIL.ImageDraw.Draw(image)
+    draw.rectangle([tile_size - 1, tile_size - 1,
+                    2 * tile_size, 2 * tile_size],
+                   outline=outline_colour)
+
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=90)
+    return output.getvalue()
+
+
+class MosaicCache(object):
+    """LRU cache of rendered mosaics keyed by the nine tile hashes, bounded by
+    the total size of the encoded images. Each mosaic is only rendered once
+    at a time, however many requests for it arrive while it is rendering"""
+
+    def __init__(self, tile_path, max_bytes=64 * 1024 * 1024, workers=2):
+        self._tile_path = tile_path
+        self._max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._mosaics = collections.OrderedDict()
+        self._size = 0
+        # key -> future of a mosaic that is being rendered
+        self._rendering = {}
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+                workers, thread_name_prefix='mosaic')
+        self.hits = 0
+        self.renders = 0
+
+    @staticmethod
+    def key(neighbours):
+        return tuple(tile_hash for row in neighbours for tile_hash in row)
+
+    def get(self, neighbours):
+        key = self.key(neighbours)
+        with self._lock:
+            if key in self._mosaics:
+                self._mosaics.move_to_end(key)
+                self.hits += 1
+                return self._mosaics[key]
+
+            future = self._rendering.get(key)
+            render_here = future is None
+            if render_here:
+                future = self._start(key)
+            else:
+                self.hits += 1
+
+        if render_here:
+            self._render(key, neighbours, future)
+        return future.result()
+
+    def prerender(self, neighbourhoods):
+        for neighbours in neighbourhoods:
+            key = self.key(neighbours)
+            with self._lock:
+                if key in self._mosaics or key in self._rendering:
+                    continue
+
+                future = self._start(key)
+            self._executor.submit(self._render, key, neighbours, future)
+
+    def _start(self, key):
+        """Marks key as rendering, the lock must be held"""
+        future = concurrent.futures.Future()
+        self._rendering[key] = future
+        self.renders += 1
+        return future
+
+    def _render(self, key, neighbours, future):
+        try:
+            data = render(self._tile_path, neighbours)
+        except Exception as e:
+            with self._lock:
+                self._rendering.pop(key, None)
+            future.set_exception(e)
+            return
+
+        with self._lock:
+            self._rendering.pop(key, None)
+            if key not in self._mosaics:
+                self._mosaics[key] = data
+                self._size += len(data)
+
+            while self._size > self._max_bytes and len(self._mosaics) > 1:
+                _, evicted = self._mosaics.popitem(last=False)
+                self._size -= len(evicted)
+
+        future.set_result(data)
@@ -0,0 +1,154 @@
+import array
+import logging
+import pathlib
+import xml.etree.ElementTree
+
+import numpy as np
+
+try:
+    import osmium
+except ImportError:
+    osmium = None
+
+import feature
+import overpass
+
+
+def build_osm_data(ways, centres):
+    """Builds OsmData from a list of (way_id, node_ids, lat, lon), with the
+    bbox centre of every way as its centre if centres is set"""
+    if not ways:
+        empty = np.empty(0)
+        return overpass.OsmData(empty.astype(np.int64), empty, empty,
+                                empty.astype(np.int64),
+                                np.zeros(1, dtype=np.int64),
+                                empty.astype(np.int64),
+                                np.empty((0, 2)))
+
+    way_ids = np.array([way_id for way_id, _, _, _ in ways], dtype=np.int64)
+    lengths = [len(node_ids) for _, node_ids, _, _ in ways]
+    node_ids = np.concatenate([node_ids for _, node_ids, _, _ in ways])
+    lat = np.concatenate([lat for _, _, lat, _ in ways])
+    lon = np.concatenate([lon for _, _, _, lon in ways])
+
+    unique_ids, first, way_nodes = np.unique(node_ids,
+                                             return_index=True,
+                                             return_inverse=True)
+
+    way_centres = np.empty((0, 2))
+    if centres:
+        way_centres = np.array([((lat.min() + lat.max()) / 2,
+                                 (lon.min() + lon.max()) / 2)
+                                for _, _, lat, lon in ways])
+
+    return overpass.OsmData(unique_ids,
+                            lat[first],
+                            lon[first],
+                            way_ids,
+                            np.r_[0, np.cumsum(lengths)].astype(np.int64),
+                            way_nodes.astype(np.int64),
+                            way_centres)
+
+
+def matches(tags, wanted):
+    return all(tags.get(key) == value for key, value in wanted.items())
+
+
+def read_xml(path, wanted):
+    """Matching ways from an OSM XML extract as (way_id, node_ids, lat,
+    lon). Nodes are kept as flat arrays since they come before the ways."""
+    node_ids = array.array('q')
+    node_lat = array.array('d')
+    node_lon = array.array('d')
+    ways = []
+
+    tags = {}
+    refs = []
+    root = None
+    for event, element in xml.etree.ElementTree.iterparse(
+            str(path), events=('start', 'end')):
+        if root is None:
+            root = element
+        if event == 'start':
+            continue
+
+        if element.tag == 'tag':
+            tags[element.get('k')] = element.get('v')
+        elif element.tag == 'nd':
+            refs.append(int(element.get('ref')))
+        elif element.tag == 'node':
+            node_ids.append(int(element.get('id')))
+            node_lat.append(float(element.get('lat')))
+            node_lon.append(float(element.get('lon')))
+            tags = {}
+            root.clear()
+        elif element.tag == 'way':
+            if matches(tags, wanted):
+                ways.append((int(element.get('id')),
+                             np.array(refs, dtype=np.int64)))
+            tags = {}
+            refs = []
+            root.clear()
+        elif element.tag == 'relation':
+            tags = {}
+            refs = []
+            root.clear()
+
+    node_ids = np.frombuffer(node_ids, dtype=np.int64)
+    order = np.argsort(node_ids, kind='stable')
+    node_ids = node_ids[order]
+    node_lat = np.frombuffer(node_lat, dtype=np.float64)[order]
+    node_lon = np.frombuffer(node_lon, dtype=np.float64)[order]
+
+    result = []
+    for way_id, refs in ways:
+        index = np.minimum(np.searchsorted(node_ids, refs),
+                           max(len(node_ids) - 1, 0))
+        if len(node_ids) == 0 or np.any(node_ids[index] != refs):
+            logging.warning(f'Way {way_id} has nodes outside the extract')
+            continue
+        result.append((way_id, refs, node_lat[index], node_lon[index]))
+    return result
+
+
+def read_pbf(path, wanted):
+    """Matching ways from an .osm.pbf extract as (way_id, node_ids, lat,
+    lon), with node locations resolved by osmium"""
+    if osmium is None:
+        raise RuntimeError('Reading .osm.pbf extracts needs the osmium '
+                           'package')
+
+    class Handler(osmium.SimpleHandler):
+        def __init__(self):
+            super().__init__()
+            self.ways = []
+
+        def way(self, way):
+            if not matches(way.tags, wanted):
+                return
+
+            if not all(node.location.valid() for node in way.nodes):
+                logging.warning(f'Way {way.id} has nodes outside the extract')
+                return
+
+            self.ways.append((way.id,
+                              np.array([node.ref for node in way.nodes],
+                                       dtype=np.int64),
+                              np.array([node.lat for node in way.nodes]),
+                              np.array([node.lon for node in way.nodes])))
+
+    handler = Handler()
+    handler.apply_file(str(path), locations=True)
+    return handler.ways
+
+
+def load(path, feature_name):
+    """Reads the ways for feature_name from a local .osm.pbf or .osm
+    extract into the same OsmData the Overpass client returns"""
+    path = pathlib.Path(path)
+    wanted = feature.osm_tags(feature_name)
+    if path.name.endswith('.pbf'):
+        ways = read_pbf(path, wanted)
+    else:
+        ways = read_xml(path, wanted)
+    return build_osm_data(ways, feature.osm_centres(feature_name))
@@ -0,0 +1,209 @@
+import array
+import datetime
+import email.utils
+import hashlib
+import json
+import logging
+import pathlib
+import time
+
+import numpy as np
+import requests
+
+
+default_url = 'https://overpass-api.de/api/interpreter'
+default_cache_dir = pathlib.Path('data/overpass')
+default_ttl = datetime.timedelta(days=7)
+read_size = 1 << 16
+
+
+class OsmData(object):
+    """Nodes and ways from an Overpass reply as flat arrays.
+
+    Node coordinates are sorted by node id. The nodes of way i are
+    way_nodes[way_offsets[i]:way_offsets[i + 1]], as indices into the node
+    arrays. Ways with a centre (`out center`) have it in centres.
+    """
+
+    def __init__(self, node_ids, lat, lon, way_ids, way_offsets, way_nodes,
+                 centres):
+        self.node_ids = node_ids
+        self.lat = lat
+        self.lon = lon
+        self.way_ids = way_ids
+        self.way_offsets = way_offsets
+        self.way_nodes = way_nodes
+        self.centres = centres
+
+    def way_coordinates(self, i):
+        index = self.way_nodes[self.way_offsets[i]:self.way_offsets[i + 1]]
+        return self.lat[index], self.lon[index]
+
+    def ways(self):
+        for i in range(len(self.way_ids)):
+            yield self.way_coordinates(i)
+
+    def points(self):
+        """Way centres and every node, as (lat, lon) arrays"""
+        lat = np.concatenate([self.centres[:, 0], self.lat])
+        lon = np.concatenate([self.centres[:, 1], self.lon])
+        return lat, lon
+
+
+def iter_elements(f):
+    """Yields the members of the top level "elements" list of an Overpass
+    JSON reply one by one, reading the text file f in fixed size chunks"""
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    eof = False
+
+    def fill():
+        nonlocal buffer, position, eof
+        data = f.read(read_size)
+        if not data:
+            eof = True
+        buffer = buffer[position:] + data
+        position = 0
+
+    while True:
+        key = buffer.find('"elements"')
+        if key >= 0:
+            bracket = buffer.find('[', key)
+            if bracket >= 0:
+                position = bracket + 1
+                break
+            position = key
+        else:
+            # Keep enough to match a key split across chunks
+            position = max(0, len(buffer) - len('"elements"'))
+        if eof:
+            raise ValueError('No elements in Overpass reply')
+        fill()
+
+    while True:
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        if position == len(buffer):
+            if eof:
+                raise ValueError('Truncated Overpass reply')
+            fill()
+            continue
+        if buffer[position] == ']':
+            return
+
+        try:
+            element, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            fill()
+            continue
+        position = end
+        yield element
+
+
+def parse(f):
+    node_ids = array.array('q')
+    lat = array.array('d')
+    lon = array.array('d')
+    way_ids = array.array('q')
+    way_offsets = array.array('q', [0])
+    way_node_ids = array.array('q')
+    centres = array.array('d')
+
+    for element in iter_elements(f):
+        if element['type'] == 'node':
+            node_ids.append(element['id'])
+            lat.append(element['lat'])
+            lon.append(element['lon'])
+        elif element['type'] == 'way':
+            if 'center' in element:
+                centres.append(element['center']['lat'])
+                centres.append(element['center']['lon'])
+            if 'nodes' in element:
+                way_ids.append(element['id'])
+                way_node_ids.extend(element['nodes'])
+                way_offsets.append(len(way_node_ids))
+        else:
+            raise ValueError('Unhandled element type {}'.format(
+                element['type']))
+
+    node_ids = np.frombuffer(node_ids, dtype=np.int64)
+    order = np.argsort(node_ids, kind='stable')
+    node_ids = node_ids[order]
+    way_node_ids = np.frombuffer(way_node_ids, dtype=np.int64)
+    way_nodes = np.searchsorted(node_ids, way_node_ids)
+    missing = way_nodes >= len(node_ids)
+    missing[~missing] = node_ids[way_nodes[~missing]] != way_node_ids[~missing]
+    if missing.any():
+        raise ValueError('Way refers to a node missing from the reply')
+
+    return OsmData(node_ids,
+                   np.frombuffer(lat, dtype=np.float64)[order],
+                   np.frombuffer(lon, dtype=np.float64)[order],
+                   np.frombuffer(way_ids, dtype=np.int64),
+                   np.frombuffer(way_offsets, dtype=np.int64),
+                   way_nodes,
+                   np.frombuffer(centres, dtype=np.float64).reshape(-1, 2))
+
+
+class Client(object):
+    """Runs Overpass queries through an on-disk cache keyed by the query.
+
+    Replies younger than ttl are used as is. Older ones are revalidated with
+    a conditional request, and used anyway if the server can't be reached.
+    """
+
+    def __init__(self, url=default_url, cache_dir=default_cache_dir,
+                 ttl=default_ttl):
+        self._url = url
+        self._cache_dir = pathlib.Path(cache_dir)
+        self._ttl = ttl
+
+    def cache_path(self, query):
+        key = hashlib.sha256(query.encode()).hexdigest()
+        return self._cache_dir / f'{key[:2]}/{key[2:]}.json'
+
+    def fetch(self, query):
+        """Returns the path of the cached reply to query, refreshing it
+        first if it is too old"""
+        path = self.cache_path(query)
+        headers = {'User-Agent': 'zidel'}
+        if path.exists():
+            age = time.time() - path.stat().st_mtime
+            if age < self._ttl.total_seconds():
+                return path
+            headers['If-Modified-Since'] = email.utils.formatdate(
+                    path.stat().st_mtime, usegmt=True)
+
+        try:
+            with requests.post(self._url,
+                               data={'data': query},
+                               headers=headers,
+                               stream=True) as r:
+                if r.status_code == 304:
+                    path.touch()
+                    return path
+                r.raise_for_status()
+
+                path.parent.mkdir(parents=True, exist_ok=True)
+                partial_path = path.with_suffix('.partial')
+                with open(partial_path, 'wb') as f:
+                    for chunk in r.iter_content(read_size):
+                        f.write(chunk)
+                partial_path.rename(path)
+        except requests.RequestException as e:
+            if not path.exists():
+                raise
+            logging.warning(f'Using stale Overpass reply {path}: {e}')
+
+        return path
+
+    def elements(self, query):
+        with open(self.fetch(query), encoding='utf-8') as f:
+            yield from iter_elements(f)
+
+    def load(self, query):
+        with open(self.fetch(query), encoding='utf-8') as f:
+            return parse(f)
@@ -0,0 +1,343 @@
+import argparse
+import datetime
+import logging
+import os
+import pathlib
+import queue
+import sys
+import threading
+import time
+
+import requests
+
+import database
+import download_tiles
+import feature
+import model_server
+import util
+
+
+log = logging.getLogger('pipeline')
+
+# Downloads block when this many new tiles are waiting to be scored
+score_queue_size = 1024
+refresh_queue_size = 64
+# Seconds between looking for due rechecks when the frontier is empty
+idle_interval = 60.0
+
+
+def take_batch(source, max_size, max_delay, timeout):
+    """Up to max_size items from source, waiting at most max_delay seconds
+    after the first one. Returns an empty list if nothing arrives within
+    timeout seconds"""
+    try:
+        batch = [source.get(timeout=timeout)]
+    except queue.Empty:
+        return []
+
+    deadline = time.monotonic() + max_delay
+    while len(batch) < max_size:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(source.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return batch
+
+
+def modified_time(path):
+    """Modification time of a weights file, or of the metadata of an
+    exported model since that is written last. A published model is a
+    symlink to the current export, which stat follows"""
+    path = pathlib.Path(path)
+    if path.is_dir():
+        path = path / 'metadata.json'
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def load_model(model_type, feature_name, path):
+    # Imported here so TensorFlow is only loaded by the scoring stage
+    import model
+
+    return model.load_for_scoring(model_type,
+                                  feature.result_type(feature_name),
+                                  path)
+
+
+class WarmModel(object):
+    """A feature model that is kept loaded and reloaded when its file
+    changes. Only used from the scoring thread"""
+
+    def __init__(self, feature_name, path, model_type, image_dir, db_path,
+                 load=load_model):
+        self.feature_name = feature_name
+        self.version = None
+        self._path = path
+        self._model_type = model_type
+        self._image_dir = image_dir
+        self._db_path = db_path
+        self._load = load
+        self._mtime = None
+        self._predict = None
+        self._writer = None
+
+    def check(self):
+        """Reloads the model if its file changed, returns True if it did"""
+        mtime = modified_time(self._path)
+        if mtime is None or mtime == self._mtime:
+            return False
+
+        try:
+            m, version = self._load(self._model_type, self.feature_name,
+                                    self._path)
+        except Exception:
+            # Probably still being written, try again with the next batch
+            log.exception(f'Failed to load {self._path}')
+            return False
+
+        if self._writer is not None:
+            self._writer.flush()
+        self._mtime = mtime
+        self.version = version
+        self._predict = model_server.ModelPredictor(m, self._image_dir)
+        self._writer = model_server.ScoreWriter(self._db_path,
+                                                self.feature_name,
+                                                version)
+        log.info(f'Loaded {self.feature_name} model {version}')
+        return True
+
+    def score(self, tile_hashes):
+        """Scores the tiles and queues the scores for writing, returns the
+        number scored"""
+        self.check()
+        if self._predict is None:
+            return 0
+
+        scores = [(tile_hash, score)
+                  for tile_hash, score
+                  in zip(tile_hashes, self._predict(tile_hashes))
+                  if score is not None]
+        self._writer.add(scores)
+        return len(scores)
+
+    def flush(self):
+        if self._writer is not None:
+            self._writer.maybe_flush()
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.flush()
+
+
+class Pipeline(object):
+    """Downloads, scores and refreshes the review queues in one process.
+
+    Each stage is a thread, and new tiles are handed from one stage to the
+    next in bounded queues. A slow stage makes the ones before it wait
+    instead of piling up work.
+    """
+
+    def __init__(self, db_path, image_dir, nib_api_key, models,
+                 recheck_feature, web_url=None, batch_size=32,
+                 max_delay=1.0, refresh_interval=30.0):
+        self._db_path = db_path
+        self._image_dir = image_dir
+        self._nib_api_key = nib_api_key
+        self._models = models
+        self._recheck_feature = recheck_feature
+        self._web_url = web_url
+        self._batch_size = batch_size
+        self._max_delay = max_delay
+        self._refresh_interval = refresh_interval
+
+        self.stop = threading.Event()
+        self._to_score = queue.Queue(score_queue_size)
+        self._to_refresh = queue.Queue(refresh_queue_size)
+        self._threads = []
+
+    def start(self, download=True):
+        stages = [self._score_stage]
+        if download:
+            stages.append(self._download_stage)
+        if self._web_url:
+            stages.append(self._refresh_stage)
+
+        for stage in stages:
+            thread = threading.Thread(target=self._run_stage,
+                                      args=(stage,),
+                                      name=stage.__name__.strip('_'),
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _run_stage(self, stage):
+        try:
+            stage()
+        except Exception:
+            log.exception(f'{stage.__name__} failed, stopping')
+            self.stop.set()
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+    def add_tiles(self, tile_hashes):
+        """Queues tiles for scoring, blocking while the queue is full"""
+        for tile_hash in tile_hashes:
+            while not self.stop.is_set():
+                try:
+                    self._to_score.put(tile_hash, timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+
+    def _download_stage(self):
+        db = database.Database(self._db_path)
+        already_downloaded = set()
+        # Checked positions are rescheduled one by one, so the whole
+        # schedule only needs to be rebuilt at startup
+        update_schedule = True
+        while not self.stop.is_set():
+            positions, resumed, due, _ = download_tiles.load_frontier(
+                    db, self._recheck_feature, datetime.datetime.now(),
+                    update_schedule)
+            update_schedule = False
+            log.info(f'{due} positions due for a recheck, {resumed} left '
+                     f'in the frontier')
+
+            while positions and not self.stop.is_set():
+                start = time.monotonic()
+                new_tile, _ = download_tiles.check_next(
+                        db, self._image_dir, self._nib_api_key, positions,
+                        already_downloaded)
+                if new_tile:
+                    self.add_tiles([new_tile])
+
+                duration = time.monotonic() - start
+                self.stop.wait(max(download_tiles.minimum_image_duration
+                                   - duration, 0))
+
+            already_downloaded.clear()
+            self.stop.wait(idle_interval)
+
+    def _score_stage(self):
+        try:
+            while not self.stop.is_set():
+                tile_hashes = take_batch(self._to_score, self._batch_size,
+                                         self._max_delay, 1.0)
+                for m in self._models:
+                    if tile_hashes:
+                        count = m.score(tile_hashes)
+                        if count:
+                            self._put_refresh(m.feature_name)
+                    elif m.check():
+                        # A new model changes the whole review order
+                        self._put_refresh(m.feature_name)
+                    m.flush()
+        finally:
+            for m in self._models:
+                m.close()
+
+    def _put_refresh(self, feature_name):
+        try:
+            self._to_refresh.put_nowait(feature_name)
+        except queue.Full:
+            # Refreshes are coalesced anyway
+            pass
+
+    def _refresh_stage(self):
+        last_refresh = {}
+        pending = set()
+        while not self.stop.is_set():
+            try:
+                pending.add(self._to_refresh.get(timeout=1.0))
+            except queue.Empty:
+                pass
+
+            now = time.monotonic()
+            for feature_name in sorted(pending):
+                last = last_refresh.get(feature_name)
+                if last is not None and now - last < self._refresh_interval:
+                    continue
+
+                refresh_review_queue(self._web_url, feature_name)
+                last_refresh[feature_name] = now
+                pending.discard(feature_name)
+
+
+def refresh_review_queue(web_url, feature_name):
+    url = f'{web_url.rstrip("/")}/features/{feature_name}/api/review/refresh'
+    try:
+        requests.post(url, timeout=10.0).raise_for_status()
+    except requests.exceptions.RequestException as e:
+        log.debug(f'Failed to refresh the {feature_name} review queue',
+                  exc_info=e)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--database', default='data/tiles.db')
+    parser.add_argument('--NiB-key', type=str, default='secret/NiB_key.json')
+    parser.add_argument('--tile-path', type=str, default='data/images')
+    parser.add_argument('--serve', type=model_server.parse_model_spec,
+                        action='append', required=True,
+                        metavar='FEATURE=MODEL',
+                        help='Weights file or model from export_model.py, '
+                             'reloaded when it changes')
+    parser.add_argument('--model', default='VGG19',
+                        help='Model type, for weights files')
+    parser.add_argument('--recheck-feature', default='solar',
+                        help='Positions likely to have this feature are '
+                             'rechecked first')
+    parser.add_argument('--web', type=str,
+                        help='URL of the web app whose review queues to '
+                             'refresh')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--refresh-interval', type=float, default=30.0)
+    parser.add_argument('--log', type=str)
+    args = parser.parse_args()
+
+    if args.log:
+        logging.basicConfig(
+                filename=args.log,
+                format='%(asctime)s %(name)s %(levelname)s %(message)s',
+                datefmt='%Y-%m-%dT%H:%M:%S',
+                level=logging.DEBUG,
+                )
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    db_path = pathlib.Path(args.database)
+    image_dir = pathlib.Path(args.tile_path)
+    models = [WarmModel(feature_name, path, args.model, image_dir, db_path)
+              for feature_name, path in args.serve]
+    for m in models:
+        if not m.check():
+            raise RuntimeError(f'Failed to load the {m.feature_name} model')
+
+    pipeline = Pipeline(db_path,
+                        image_dir,
+                        util.load_key(args.NiB_key),
+                        models,
+                        args.recheck_feature,
+                        web_url=args.web,
+                        batch_size=args.batch_size,
+                        refresh_interval=args.refresh_interval)
+    pipeline.start()
+    try:
+        while not pipeline.stop.wait(1.0):
+            pass
+    except KeyboardInterrupt:
+        pipeline.stop.set()
+    pipeline.join()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,163 @@
+import argparse
+import concurrent.futures
+import functools
+import pathlib
+import sys
+
+import numpy as np
+import PIL.Image
+import tqdm
+
+import database
+import feature
+import util
+
+
+stats_size = 32
+write_batch_size = 1000
+
+# A 256x256 JPEG this small has next to no detail in it
+max_blank_file_size = 2000
+# Grey level variance of the 32x32 thumbnail
+max_uniform_variance = 25.0
+max_water_variance = 150.0
+min_water_fraction = 0.95
+# Tiles labelled positive or scored at least this are never prefiltered
+min_protected_score = 0.5
+
+all_rules = ('blank', 'uniform', 'water')
+# Dark blue solar arrays and flat PV roofs look like open water
+feature_rules = {
+        'large_solar': ('blank', 'uniform'),
+        'solar': ('blank', 'uniform'),
+        'solar_area': ('blank', 'uniform'),
+        }
+
+
+def tile_stats(tile_path, tile_hash):
+    """(file size, grey variance, water fraction, green fraction) of the
+    tile, or None if it can't be read"""
+    path = util.tile_to_paths(tile_path, tile_hash)
+    try:
+        file_size = path.stat().st_size
+        with PIL.Image.open(path) as image:
+            small = image.convert('RGB').resize((stats_size, stats_size),
+                                                PIL.Image.BILINEAR)
+    except OSError:
+        return None
+
+    rgb = np.asarray(small, dtype=np.float64)
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    grey = 0.299 * r + 0.587 * g + 0.114 * b
+    water = (b > r) & (b >= g)
+    green = (g > r) & (g > b)
+    return (file_size, float(grey.var()), float(water.mean()),
+            float(green.mean()))
+
+
+def negative_reason(file_size, variance, water_fraction, green_fraction,
+                    rules=all_rules):
+    """Why a tile can't contain any feature, or None if it might. Only the
+    named rules are applied"""
+    if 'blank' in rules and file_size <= max_blank_file_size:
+        return 'blank'
+    if 'uniform' in rules and variance <= max_uniform_variance:
+        return 'uniform'
+    if 'water' in rules and water_fraction >= min_water_fraction \
+            and variance <= max_water_variance:
+        return 'water'
+    return None
+
+
+def compute_stats(db, tile_path, workers):
+    with db.transaction('get_tiles_without_stats') as c:
+        tile_hashes = database.tiles_without_stats(c)
+    print(f'Computing stats for {len(tile_hashes)} tiles')
+
+    batch = []
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        results = executor.map(functools.partial(tile_stats, tile_path),
+                               tile_hashes,
+                               chunksize=64)
+        for tile_hash, stats in tqdm.tqdm(zip(tile_hashes, results),
+                                          total=len(tile_hashes)):
+            if stats is None:
+                continue
+
+            batch.append((tile_hash,) + stats)
+            if len(batch) >= write_batch_size:
+                with db.transaction('write_tile_stats') as c:
+                    database.write_tile_stats(c, batch)
+                batch = []
+
+    if batch:
+        with db.transaction('write_tile_stats') as c:
+            database.write_tile_stats(c, batch)
+
+
+def mark_negatives(db, feature_name):
+    rules = feature_rules.get(feature_name, all_rules)
+    with db.transaction('get_tiles_to_prefilter') as c:
+        stats = {tile_hash: tuple(tile_stats)
+                 for tile_hash, *tile_stats in database.all_tile_stats(c)}
+        protected = database.likely_positive_tiles(c, feature_name,
+                                                   min_protected_score)
+        validation_positives = [
+                tile_hash
+                for tile_hash, label, _
+                in database.validation_tiles(c, feature_name)
+                if label and tile_hash in stats]
+
+    # How many known positives each rule would throw away on its own
+    for rule in rules:
+        dropped = sum(1 for tile_hash in validation_positives
+                      if negative_reason(*stats[tile_hash], rules=(rule,)))
+        print(f'{feature_name}: {rule} matches {dropped} of '
+              f'{len(validation_positives)} validation positives')
+
+    negatives = []
+    kept = 0
+    for tile_hash, tile_stats in stats.items():
+        reason = negative_reason(*tile_stats, rules=rules)
+        if reason is None:
+            continue
+        if tile_hash in protected:
+            kept += 1
+            continue
+        negatives.append((tile_hash, reason))
+
+    with db.transaction('mark_trivially_negative') as c:
+        database.write_trivially_negative(c, feature_name, negatives)
+        saved = database.count_trivially_negative(c, feature_name)
+
+    for reason in rules:
+        count = sum(1 for _, r in negatives if r == reason)
+        print(f'{feature_name}: {count} {reason} tiles')
+    print(f'{feature_name}: {len(negatives)} tiles will not be scored, '
+          f'{saved} of them have no score yet')
+    print(f'{feature_name}: kept {kept} matching tiles that are labelled '
+          f'or scored as positive')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--database', default='data/tiles.db')
+    parser.add_argument('--tile-path', type=str, default='data/images')
+    parser.add_argument('--feature', type=str, action='append',
+                        required=True)
+    parser.add_argument('--workers', type=int)
+    args = parser.parse_args()
+
+    for feature_name in args.feature:
+        feature.result_type(feature_name)
+
+    db = database.Database(args.database)
+    compute_stats(db, pathlib.Path(args.tile_path), args.workers)
+    for feature_name in args.feature:
+        mark_negatives(db, feature_name)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,131 @@
+import datetime
+
+import numpy as np
+
+import database
+
+
+# Rates are changes per day
+min_interval = datetime.timedelta(days=14)
+max_interval = datetime.timedelta(days=365)
+# A position is due when it has changed with this probability since the last
+# check
+target_change_probability = 0.5
+# Weight of the regional prior, in days of observation
+prior_days = 365.0
+# Used as the prior for everything when nothing has changed anywhere yet
+default_rate = 1 / (3 * 365.0)
+# Regions are 2^region_shift tiles wide
+region_shift = 6
+# Positions without a score still get rechecked, just less eagerly
+score_floor = 0.1
+# Above any recheck priority, which is at most 1 + score_floor
+new_position_priority = 1.5
+
+
+def estimate_rates(changes, exposure, regions):
+    """Change rate per position, shrunk towards the rate of its region,
+    which is in turn shrunk towards the global rate"""
+    changes = np.asarray(changes, dtype=np.float64)
+    exposure = np.asarray(exposure, dtype=np.float64)
+    _, region_index = np.unique(regions, return_inverse=True)
+
+    global_rate = (changes.sum() + default_rate * prior_days) \
+        / (exposure.sum() + prior_days)
+    region_rate = (np.bincount(region_index, weights=changes)
+                   + global_rate * prior_days) \
+        / (np.bincount(region_index, weights=exposure) + prior_days)
+
+    return (changes + region_rate[region_index] * prior_days) \
+        / (exposure + prior_days)
+
+
+def change_probability(rate, days):
+    """Probability of at least one change in days, for Poisson changes"""
+    return 1.0 - np.exp(-rate * np.maximum(days, 0.0))
+
+
+def interval_days(rate):
+    days = -np.log(1.0 - target_change_probability) / rate
+    return np.clip(days,
+                   min_interval.total_seconds() / 86400,
+                   max_interval.total_seconds() / 86400)
+
+
+def to_days(timestamps):
+    """ISO timestamps as days since the epoch"""
+    return np.array(timestamps, dtype='datetime64[s]').astype(np.float64) \
+        / 86400
+
+
+def from_days(days):
+    return datetime.datetime(1970, 1, 1) + datetime.timedelta(days=days)
+
+
+def build_schedule(history, scores, now):
+    """Schedule rows (z, x, y, due, priority, rate) from tile_history rows
+    and a {(z, x, y): score} dict"""
+    if not history:
+        return []
+
+    z, x, y, count, first_added, last_checked = zip(*history)
+    z = np.array(z, dtype=np.int64)
+    x = np.array(x, dtype=np.int64)
+    y = np.array(y, dtype=np.int64)
+    count = np.array(count, dtype=np.float64)
+    # Imported positions without any tile yet have nothing to learn from
+    never_downloaded = count == 0
+    last_checked = to_days(last_checked)
+    first_added = np.where(never_downloaded,
+                           last_checked,
+                           to_days([added or '1970-01-01T00:00:00'
+                                    for added in first_added]))
+    now_days = to_days([now.isoformat()])[0]
+
+    changes = np.maximum(count - 1, 0.0)
+    exposure = np.maximum(last_checked - first_added, 0.0)
+    regions = (z << 58) | ((x >> region_shift) << 29) | (y >> region_shift)
+    rate = estimate_rates(changes, exposure, regions)
+
+    since_check = now_days - last_checked
+    score = np.array([scores.get(position, 0.0)
+                      for position in zip(z.tolist(), x.tolist(),
+                                          y.tolist())])
+    priority = change_probability(rate, since_check) * (score_floor + score)
+    due = last_checked + interval_days(rate)
+
+    # Never downloaded positions are due right away, ahead of rechecks
+    priority = np.where(never_downloaded, new_position_priority, priority)
+    due = np.where(never_downloaded, np.minimum(due, now_days), due)
+
+    return [(z_, x_, y_, from_days(due_).isoformat(timespec='seconds'),
+             priority_, rate_)
+            for z_, x_, y_, due_, priority_, rate_
+            in zip(z.tolist(), x.tolist(), y.tolist(), due.tolist(),
+                   priority.tolist(), rate.tolist())]
+
+
+def update(db, feature_name, now):
+    """Recomputes the whole schedule from the tile history"""
+    with db.transaction('get_recheck_history') as c:
+        history = database.tile_history(c)
+        scores = {}
+        for zoom in sorted(set(row[0] for row in history)):
+            for x, y, score in database.position_scores(c, feature_name,
+                                                        zoom):
+                scores[(zoom, x, y)] = score
+
+    schedule = build_schedule(history, scores, now)
+    with db.transaction('write_recheck_schedule') as c:
+        database.write_recheck_schedule(c, schedule)
+    return len(schedule)
+
+
+def reschedule(cursor, z, x, y, now):
+    """Moves a just checked position to its next due time"""
+    rate = database.recheck_rate(cursor, z, x, y)
+    if rate is None:
+        rate = default_rate
+    due = now + datetime.timedelta(days=float(interval_days(rate)))
+    database.reschedule(cursor, z, x, y, due.isoformat(timespec='seconds'),
+                        rate)
@@ -0,0 +1,193 @@
+import collections
+import logging
+import threading
+import time
+
+import sqlite3
+
+import database
+
+
+log = logging.getLogger('review_queue')
+
+
+class ReviewQueue(object):
+    """In-memory queue of the best unlabelled tiles for one feature.
+
+    The queue is filled in bulk from Database.tiles_for_review in a background
+    thread, so handing out the next tile is a deque pop. Tiles that have been
+    handed out are leased to that reviewer for a while so parallel reviewers
+    don't get the same tile.
+    """
+
+    def __init__(self, db_path, feature_name, size=200, low_water=50,
+                 max_age=300, lease_time=600, version_check_interval=5):
+        self._db_path = db_path
+        self._feature_name = feature_name
+        self._size = size
+        self._low_water = low_water
+        self._max_age = max_age
+        self._lease_time = lease_time
+        self._version_check_interval = version_check_interval
+
+        self._lock = threading.Lock()
+        self._refill_done = threading.Condition(self._lock)
+        self._tiles = collections.deque()
+        self._model_version = None
+        self._refilled_at = None
+        self._refilling = False
+        self._generation = 0
+        self._version_checked_at = None
+        self._latest_version = None
+
+        # tile_hash -> time the lease expires
+        self._leased = {}
+        # Hashes answered since the last refill started, the refill result may
+        # still contain them
+        self._answered = set()
+
+    def next_tile(self):
+        if self._new_model_version():
+            # The whole order changes, so don't serve from the old one
+            self.invalidate()
+
+        with self._lock:
+            tile = self._pop()
+            needs_refill = self._needs_refill()
+
+        if tile is None:
+            self.refill()
+            with self._lock:
+                tile = self._pop()
+        elif needs_refill:
+            self._refill_in_background()
+
+        return tile
+
+    def peek(self, count):
+        with self._lock:
+            return list(self._tiles)[:count]
+
+    def answered(self, tile_hash):
+        with self._lock:
+            self._answered.add(tile_hash)
+            self._leased.pop(tile_hash, None)
+
+    def invalidate(self):
+        with self._lock:
+            self._tiles.clear()
+            self._generation += 1
+        self._refill_in_background()
+
+    def refill(self):
+        with self._lock:
+            if self._refilling:
+                # Someone else is already querying, wait for their result
+                self._refill_done.wait_for(lambda: not self._refilling,
+                                           timeout=60)
+                return
+            self._refilling = True
+            generation = self._generation
+            self._answered.clear()
+
+        try:
+            db = database.Database(self._db_path)
+            tiles = db.tiles_for_review(self._feature_name, limit=self._size)
+        except sqlite3.OperationalError as e:
+            log.debug('Failed to refill review queue', exc_info=e)
+            tiles = None
+
+        with self._lock:
+            self._refilling = False
+            self._refill_done.notify_all()
+
+            # If we were invalidated while querying the result is stale
+            stale = generation != self._generation
+            if tiles is not None and not stale:
+                self._replace(tiles)
+
+        if stale:
+            self._refill_in_background()
+
+    def _replace(self, tiles):
+        model_version = tiles[0][5] if tiles else None
+        if model_version != self._model_version:
+            log.info(f'Model version for {self._feature_name} is now '
+                     f'{model_version}')
+            self._model_version = model_version
+
+        now = time.monotonic()
+        self._expire_leases(now)
+        self._tiles = collections.deque(
+                tile for tile in tiles
+                if tile[0] not in self._answered
+                and tile[0] not in self._leased)
+        self._refilled_at = now
+
+    def _pop(self):
+        now = time.monotonic()
+        while self._tiles:
+            tile = self._tiles.popleft()
+            tile_hash = tile[0]
+            if tile_hash in self._answered:
+                continue
+
+            lease = self._leased.get(tile_hash)
+            if lease is not None and lease > now:
+                continue
+
+            self._leased[tile_hash] = now + self._lease_time
+            return tile
+
+        return None
+
+    def _new_model_version(self):
+        """Whether another model version has written scores since the last
+        check. Checks at most every version_check_interval seconds"""
+        now = time.monotonic()
+        with self._lock:
+            checked_at = self._version_checked_at
+            if checked_at is not None \
+                    and now - checked_at < self._version_check_interval:
+                return False
+            self._version_checked_at = now
+
+        try:
+            db = database.Database(self._db_path)
+            with db.transaction('get_latest_score_version') as c:
+                version = database.latest_score_version(c,
+                                                        self._feature_name)
+        except sqlite3.OperationalError as e:
+            log.debug('Failed to check the model version', exc_info=e)
+            return False
+
+        with self._lock:
+            changed = version != self._latest_version
+            self._latest_version = version
+        # The first check only tells us where we are
+        return changed and checked_at is not None
+
+    def _needs_refill(self):
+        if self._refilled_at is None:
+            return True
+
+        if len(self._tiles) < self._low_water:
+            return True
+
+        # Catches changes a new model version doesn't explain
+        return time.monotonic() - self._refilled_at > self._max_age
+
+    def _expire_leases(self, now):
+        expired = [tile_hash
+                   for tile_hash, expires in self._leased.items()
+                   if expires <= now]
+        for tile_hash in expired:
+            del self._leased[tile_hash]
+
+    def _refill_in_background(self):
+        with self._lock:
+            if self._refilling:
+                return
+
+        thread = threading.Thread(target=self.refill, daemon=True)
+        thread.start()
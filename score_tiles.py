@@ -7,6 +7,7 @@ import time
 import sqlite3
 import tensorflow
 
+import cascade
 import database
 import feature
 import model
@@ -128,27 +129,70 @@ def score_tiles(db, image_dir, nib_api_key, feature_name, progress, m,
             break
 
 
+def score_cascade(db, image_dir, args, m, model_version):
+    screen_model, screen_version = model.load_for_scoring(
+            args.screen_model,
+            feature.result_type(args.feature),
+            args.load_screen_model,
+            args.screen_input_size)
+    threshold = cascade.get_threshold(db, image_dir, args.feature,
+                                      screen_model, screen_version,
+                                      args.max_recall_loss, args.batch_size)
+    cascade_version = cascade.version(model_version, screen_version)
+
+    screened = 0
+    passed = 0
+    while True:
+        tiles, count = db.tiles_for_scoring(cascade_version, args.feature,
+                                            args.limit or 1000000)
+        if not tiles:
+            break
+
+        print('Screening {} of {} tiles'.format(len(tiles), count))
+        s, p = cascade.score(db, image_dir, args.feature, screen_model,
+                             screen_version, m, model_version, threshold,
+                             args.batch_size, tiles)
+        screened += s
+        passed += p
+        if args.limit:
+            break
+
+    print('Screened {} tiles, {} went to the full model'.format(
+        screened, passed))
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--database', default='data/tiles.db')
     parser.add_argument('--NiB-key', type=str, default="secret/NiB_key.json")
     parser.add_argument('--tile-path', type=str, default="data/images")
     parser.add_argument('--model', default='VGG19')
-    parser.add_argument('--load-model', default='data/model.hdf5')
+    parser.add_argument('--load-model', default='data/model.hdf5',
+                        help='Weights file or model from export_model.py')
     parser.add_argument('--limit', type=int)
     parser.add_argument('--feature', type=str, required=True)
 
     parser.add_argument('--batch-size', default=10, type=int)
+
+    parser.add_argument('--screen-model', default='MobileNetV2')
+    parser.add_argument('--load-screen-model', type=str,
+                        help='Screen tiles with this model first and only '
+                             'run the full model on the ones that pass')
+    parser.add_argument('--screen-input-size', default=128, type=int)
+    parser.add_argument('--max-recall-loss', default=0.02, type=float)
     args = parser.parse_args()
 
     db = database.Database(args.database)
-    model_version = util.hash_file(args.load_model)
     nib_api_key = util.load_key(args.NiB_key)
     image_dir = pathlib.Path(args.tile_path)
 
-    m = model.get(args.model,
-                  feature.result_type(args.feature),
-                  args.load_model)
+    m, model_version = model.load_for_scoring(
+            args.model,
+            feature.result_type(args.feature),
+            args.load_model)
+
+    if args.load_screen_model:
+        return score_cascade(db, image_dir, args, m, model_version)
 
     progress = Progress()
     try:
@@ -165,6 +209,11 @@ def main():
         progress.clear()
         print('Scored {} tiles'.format(progress.done))
 
+    with db.transaction('count_trivially_negative') as c:
+        skipped = database.count_trivially_negative(c, args.feature,
+                                                    model_version)
+    print('Skipped {} trivially negative tiles'.format(skipped))
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,45 @@
+import math
+import unittest
+
+import numpy as np
+
+import area_from_osm
+import util
+
+
+def way_from_corners(corners):
+    lat, lon = zip(*(corners + corners[:1]))
+    return np.array(lat), np.array(lon)
+
+
+class AreaFromOsmTests(unittest.TestCase):
+    def test_whole_tile_has_tile_area(self):
+        x, y = util.deg2tile(59.91, 10.75, 18)
+        north, west = util.tile2deg(x, y, 18)
+        south, east = util.tile2deg(x + 1, y + 1, 18)
+        way = way_from_corners([(north, west), (north, east),
+                                (south, east), (south, west)])
+
+        tile_x, tile_y, areas = area_from_osm.way_tile_areas(way)
+
+        # Spherical area of the tile in m^2
+        radius = area_from_osm.earth_radius
+        expected = (radius ** 2 * math.radians(east - west)
+                    * (math.sin(math.radians(north))
+                       - math.sin(math.radians(south))))
+        self.assertEqual([x], tile_x[areas > 1].tolist())
+        self.assertEqual([y], tile_y[areas > 1].tolist())
+        self.assertAlmostEqual(expected, areas.max(), delta=1e-3 * expected)
+
+    def test_area_is_split_between_tiles(self):
+        x, y = util.deg2tile(59.91, 10.75, 18)
+        north, west = util.tile2deg(x, y, 18)
+        south, east = util.tile2deg(x + 2, y + 1, 18)
+        centre = (north + south) / 2
+        way = way_from_corners([(north, west), (north, east),
+                                (centre, east), (centre, west)])
+
+        tile_x, tile_y, areas = area_from_osm.way_tile_areas(way)
+        areas = dict(zip(zip(tile_x.tolist(), tile_y.tolist()),
+                         areas.tolist()))
+        self.assertAlmostEqual(areas[(x, y)], areas[(x + 1, y)])
@@ -0,0 +1,63 @@
+import concurrent.futures
+import pathlib
+import tempfile
+import unittest
+
+import PIL.Image
+
+import build_overviews
+import database
+import util
+
+
+class BuildOverviewsTests(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        tmp = pathlib.Path(self._tmp.name)
+        self.tile_path = tmp / 'images'
+        self.output_dir = tmp / 'overviews'
+        self.db = database.Database(tmp / 'tiles.db')
+        self.executor = concurrent.futures.ThreadPoolExecutor()
+
+        with self.db.transaction('populate') as c:
+            for x in range(4):
+                for y in range(2):
+                    self.add_tile(c, x, y, (x * 60, y * 60, 0))
+
+    def tearDown(self):
+        self.executor.shutdown()
+        self._tmp.cleanup()
+
+    def add_tile(self, cursor, x, y, colour):
+        tile_hash = f'{x}{y}{colour[2]}'.rjust(64, 'a')
+        path = util.tile_to_paths(self.tile_path, tile_hash)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        PIL.Image.new('RGB', (256, 256), colour).save(path, format='JPEG')
+        database.add_tile_hash(cursor, 18, x, y, tile_hash)
+
+    def build(self, z):
+        build_overviews.build_level(self.db, self.executor, z,
+                                    self.tile_path, self.output_dir)
+        with self.db.transaction('get_overviews') as c:
+            return database.overview_tiles(c, z)
+
+    def test_overview_is_downsampled_from_children(self):
+        tiles = self.build(17)
+        self.assertEqual({(0, 0), (1, 0)}, set(tiles))
+
+        tile_hash, _ = tiles[(1, 0)]
+        path = util.tile_to_paths(self.output_dir, tile_hash)
+        with PIL.Image.open(path) as image:
+            self.assertEqual((256, 256), image.size)
+            red, green, _ = image.getpixel((64, 192))
+            self.assertAlmostEqual(120, red, delta=4)
+            self.assertAlmostEqual(60, green, delta=4)
+
+    def test_only_changed_parents_are_rebuilt(self):
+        before = self.build(17)
+        with self.db.transaction('change_tile') as c:
+            self.add_tile(c, 3, 1, (0, 0, 255))
+        after = self.build(17)
+
+        self.assertEqual(before[(0, 0)], after[(0, 0)])
+        self.assertNotEqual(before[(1, 0)], after[(1, 0)])
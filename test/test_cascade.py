@@ -0,0 +1,91 @@
+import pathlib
+import tempfile
+import unittest
+import unittest.mock
+
+import numpy as np
+
+import cascade
+import database
+
+
+class CalibrateThresholdTests(unittest.TestCase):
+    def test_keeps_requested_recall(self):
+        labels = [True] * 50 + [False] * 50
+        scores = [0.5 + i / 100 for i in range(50)] \
+            + [i / 100 for i in range(50)]
+
+        threshold, recall, pass_rate = cascade.calibrate_threshold(
+                labels, scores, 0.1)
+
+        self.assertAlmostEqual(0.55, threshold)
+        self.assertAlmostEqual(0.9, recall)
+        self.assertAlmostEqual(0.45, pass_rate)
+
+    def test_zero_loss_passes_every_positive(self):
+        labels = [True, False, True, False]
+        scores = [0.2, 0.1, 0.9, 0.3]
+
+        threshold, recall, pass_rate = cascade.calibrate_threshold(
+                labels, scores, 0.0)
+
+        self.assertAlmostEqual(0.2, threshold)
+        self.assertEqual(1.0, recall)
+        self.assertEqual(0.75, pass_rate)
+
+    def test_recall_loss_must_leave_a_positive(self):
+        for max_recall_loss in [1.0, -0.1]:
+            with self.assertRaises(ValueError):
+                cascade.calibrate_threshold([True, False], [0.9, 0.1],
+                                            max_recall_loss)
+
+    def test_needs_positives(self):
+        with self.assertRaises(ValueError):
+            cascade.calibrate_threshold([False, False], [0.1, 0.2], 0.02)
+
+
+class CascadeThresholdTests(unittest.TestCase):
+    def test_threshold_is_per_calibration(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db = database.Database(pathlib.Path(tmp) / 'tiles.db')
+            with db.transaction('test') as c:
+                database.write_cascade_threshold(c, 'solar', 'a', 0.02, 'x',
+                                                 0.3, 0.98, 0.2,
+                                                 '2026-01-01T00:00:00')
+                self.assertEqual((0.3, 0.98, 0.2),
+                                 database.get_cascade_threshold(
+                                         c, 'solar', 'a', 0.02, 'x'))
+                for key in [('b', 0.02, 'x'),
+                            ('a', 0.05, 'x'),
+                            ('a', 0.02, 'y')]:
+                    self.assertIsNone(database.get_cascade_threshold(
+                            c, 'solar', *key))
+
+
+class ScoreTests(unittest.TestCase):
+    def test_rejected_tiles_get_the_floor_score(self):
+        tile_hashes = [f'{i:x}'.rjust(64, 'f') for i in range(3)]
+        screen = {tile_hash: s
+                  for tile_hash, s in zip(tile_hashes, [0.1, 0.6, 0.9])}
+
+        def predict(m, image_dir, hashes, batch_size):
+            if m == 'screen':
+                return np.array([screen[h] for h in hashes])
+            return np.full(len(hashes), 0.7)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            db = database.Database(pathlib.Path(tmp) / 'tiles.db')
+            with db.transaction('populate') as c:
+                for i, tile_hash in enumerate(tile_hashes):
+                    database.add_tile_hash(c, 18, i, 0, tile_hash)
+
+            with unittest.mock.patch('cascade.predict', predict):
+                self.assertEqual((3, 2), cascade.score(
+                        db, None, 'solar', 'screen', 's1', 'full', 'f1',
+                        0.5, 16, [(tile_hash, None)
+                                  for tile_hash in tile_hashes]))
+
+            with db.transaction('check') as c:
+                self.assertEqual([cascade.rejected_score, 0.7, 0.7],
+                                 [database.get_score(c, tile_hash, 'solar')
+                                  for tile_hash in tile_hashes])
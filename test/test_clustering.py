@@ -0,0 +1,60 @@
+import unittest
+
+import numpy as np
+
+import clustering
+import util
+
+
+class ClusteringTests(unittest.TestCase):
+    def test_diagonal_tiles_are_connected(self):
+        sites = clustering.find_sites(18, [0, 1, 2, 10], [2, 1, 0, 10])
+        self.assertEqual([3, 1], [site.tile_count for site in sites])
+        self.assertEqual((0, 0, 2, 2), (sites[0].min_x,
+                                        sites[0].min_y,
+                                        sites[0].max_x,
+                                        sites[0].max_y))
+
+    def test_u_shape_is_one_component(self):
+        # Needs more than one hooking round to merge
+        x = [0, 0, 0, 1, 2, 2, 2]
+        y = [0, 1, 2, 2, 2, 1, 0]
+        sites = clustering.find_sites(18, x, y)
+        self.assertEqual([7], [site.tile_count for site in sites])
+
+    def test_area_is_summed_per_site(self):
+        area_keys = util.pack_positions([0, 1, 5], [0, 0, 5])
+        sites = clustering.find_sites(18, [0, 1, 5], [0, 0, 5],
+                                      area_keys, [1.0, 2.0, 4.0])
+        self.assertEqual([3.0, 4.0], [site.area for site in sites])
+
+    def test_components_match_flood_fill(self):
+        rng = np.random.default_rng(0)
+        grid = rng.random((60, 60)) < 0.4
+        y, x = np.nonzero(grid)
+
+        keys, labels = clustering.connected_components(x, y)
+        label_of = dict(zip(keys.tolist(), labels.tolist()))
+
+        seen = set()
+        component_count = 0
+        for start in zip(x.tolist(), y.tolist()):
+            if start in seen:
+                continue
+            component_count += 1
+            stack = [start]
+            seen.add(start)
+            start_label = label_of[int(util.pack_positions(*start))]
+            while stack:
+                cx, cy = stack.pop()
+                self.assertEqual(start_label,
+                                 label_of[int(util.pack_positions(cx, cy))])
+                for dx in [-1, 0, 1]:
+                    for dy in [-1, 0, 1]:
+                        n = (cx + dx, cy + dy)
+                        if (0 <= n[0] < 60 and 0 <= n[1] < 60
+                                and grid[n[1], n[0]] and n not in seen):
+                            seen.add(n)
+                            stack.append(n)
+
+        self.assertEqual(component_count, len(set(labels.tolist())))
@@ -0,0 +1,164 @@
+import pathlib
+import tempfile
+import unittest
+
+import database
+import util
+
+
+def fake_hash(i):
+    return f'{i:x}'.rjust(64, 'f')
+
+
+class TileBoundsTests(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.db = database.Database(pathlib.Path(self._tmp.name) / 'tiles.db')
+        self.base_x, self.base_y = util.deg2tile(59.91, 10.75, 18)
+
+        with self.db.transaction('populate') as c:
+            database.add_tile_hashes(
+                    c,
+                    [(18, self.base_x + dx, self.base_y + dy,
+                      fake_hash(dx * 10 + dy))
+                     for dx in range(5) for dy in range(5)])
+            database.write_score(c, fake_hash(22), 'solar', 0.75, 'test',
+                                 '2020-01-01T00:00:00')
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def centre(self, dx, dy):
+        north, west = util.tile2deg(self.base_x + dx, self.base_y + dy, 18)
+        south, east = util.tile2deg(self.base_x + dx + 1,
+                                    self.base_y + dy + 1, 18)
+        return (north + south) / 2, (west + east) / 2
+
+    def test_bbox_returns_latest_hash_and_score(self):
+        with self.db.transaction('test') as c:
+            database.add_tile_hash(c, 18, self.base_x + 2, self.base_y + 3,
+                                   fake_hash(1000))
+            lat, lon = self.centre(2, 2)
+            rows = database.tiles_in_bbox(c, 'solar', lat, lon, lat, lon)
+            self.assertEqual([(18, self.base_x + 2, self.base_y + 2,
+                               fake_hash(22), 0.75)], rows)
+
+            lat, lon = self.centre(2, 3)
+            rows = database.tiles_in_bbox(c, 'solar', lat, lon, lat, lon)
+            self.assertEqual([(18, self.base_x + 2, self.base_y + 3,
+                               fake_hash(1000), None)], rows)
+
+    def test_near_is_sorted_by_distance(self):
+        lat, lon = self.centre(2, 2)
+        with self.db.transaction('test') as c:
+            rows = database.tiles_near(c, 'solar', lat, lon, 100.0)
+        # Tiles are roughly 76 m wide at this latitude, so this is the tile
+        # itself and its 8 neighbours
+        self.assertEqual(9, len(rows))
+        self.assertEqual(fake_hash(22), rows[0][3])
+
+    def test_neighbourhood_is_the_surrounding_block(self):
+        with self.db.transaction('test') as c:
+            database.add_tile(c, 18, self.base_x + 1, self.base_y + 5)
+            database.add_tile_hash(c, 18, self.base_x + 2, self.base_y + 2,
+                                   fake_hash(1000))
+            rows = database.neighbourhood_tiles(c, 18, self.base_x + 2,
+                                                self.base_y + 4)
+            self.assertEqual(
+                    sorted([(self.base_x + 1, self.base_y + 5, None, None)]
+                           + [(self.base_x + dx, self.base_y + dy,
+                               fake_hash(dx * 10 + dy))
+                              for dx in range(1, 4) for dy in range(3, 5)]),
+                    sorted(row if row[2] is None else row[:3]
+                           for row in rows))
+
+            rows = database.neighbourhood_tiles(c, 18, self.base_x + 2,
+                                                self.base_y + 2)
+            self.assertEqual(10, len(rows))
+
+    def test_existing_database_is_backfilled(self):
+        with self.db.transaction('test') as c:
+            c.execute('drop table tile_bounds')
+
+        db = database.Database(pathlib.Path(self._tmp.name) / 'tiles.db')
+        with db.transaction('test') as c:
+            rows = database.tiles_in_bbox(c, 'solar', -90, -180, 90, 180)
+        self.assertEqual(25, len(rows))
+
+
+class BulkTests(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.db = database.Database(pathlib.Path(self._tmp.name) / 'tiles.db')
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_tile_hashes_at_positions(self):
+        with self.db.transaction('test') as c:
+            database.add_tile_hashes(c, [(18, 1, 1, fake_hash(1)),
+                                         (18, 1, 1, fake_hash(2)),
+                                         (18, 2, 2, fake_hash(3)),
+                                         (17, 3, 3, fake_hash(4))])
+            rows = database.tile_hashes_at(c, 18, [(1, 1), (3, 3), (1, 1)])
+            self.assertEqual([(1, 1, fake_hash(1)), (1, 1, fake_hash(2))],
+                             sorted(rows))
+
+            self.assertEqual([], database.tile_hashes_at(c, 18, []))
+
+    def test_write_scores_updates_existing(self):
+        with self.db.transaction('test') as c:
+            database.add_tile_hashes(c, [(18, 1, 1, fake_hash(1)),
+                                         (18, 1, 2, fake_hash(2))])
+            database.write_score(c, fake_hash(1), 'solar', 0.5, 'model',
+                                 '2020-01-01T00:00:00')
+            database.write_scores(c, [
+                (fake_hash(1), 'solar', 1.0, 'OSM', '2020-01-02T00:00:00'),
+                (fake_hash(2), 'solar', 1.0, 'OSM', '2020-01-02T00:00:00'),
+                ])
+            self.assertEqual(1.0, database.get_score(c, fake_hash(1),
+                                                     'solar'))
+            self.assertEqual(1.0, database.get_score(c, fake_hash(2),
+                                                     'solar'))
+
+    def test_distillation_tiles_skip_labelled_positions(self):
+        with self.db.transaction('test') as c:
+            database.add_tile_hashes(c, [(18, 1, 1, fake_hash(1)),
+                                         (18, 1, 2, fake_hash(2)),
+                                         (18, 1, 3, fake_hash(3)),
+                                         (18, 1, 4, fake_hash(4))])
+            database.write_scores(c, [
+                (fake_hash(i), 'solar', i / 10, 'teacher',
+                 '2020-01-01T00:00:00')
+                for i in range(1, 4)])
+            database.write_score(c, fake_hash(4), 'solar', 0.4, 'other',
+                                 '2020-01-01T00:00:00')
+            c.execute('''insert into training_set (feature_name, z, x, y)
+                         values ('solar', 18, 1, 1)''')
+            c.execute('''insert into validation_set (feature_name, z, x, y)
+                         values ('solar', 18, 1, 2)''')
+
+            self.assertEqual(
+                    [(fake_hash(3), 0.3)],
+                    database.distillation_tiles(c, 'solar', 'teacher', 10))
+
+    def test_new_labels_since_last_fine_tune(self):
+        with self.db.transaction('test') as c:
+            database.add_tile_hashes(c, [(18, 1, i, fake_hash(i))
+                                         for i in range(4)])
+            c.execute('''insert into validation_set (feature_name, z, x, y)
+                         values ('solar', 18, 1, 3)''')
+            database.set_has_feature(c, fake_hash(0), 'solar', True)
+            database.write_fine_tune_state(c, 'solar', 1, 'v1',
+                                           '2020-01-01T00:00:00')
+            database.set_has_feature(c, fake_hash(1), 'solar', False)
+            database.set_has_feature(c, fake_hash(2), 'solar', True)
+            database.set_has_feature(c, fake_hash(3), 'solar', True)
+
+            after = database.last_fine_tuned_label(c, 'solar')
+            self.assertEqual(1, after)
+            self.assertEqual(
+                    [(fake_hash(1), 0, 2), (fake_hash(2), 1, 3)],
+                    sorted(database.new_labels(c, 'solar', after)))
+            self.assertEqual(0, database.last_fine_tuned_label(c,
+                                                               'playground'))
@@ -0,0 +1,93 @@
+import pathlib
+import tempfile
+import unittest
+
+import numpy as np
+
+import database
+import evaluation
+
+
+def fake_hash(i):
+    return f'{i:x}'.rjust(64, 'f')
+
+
+class ReportTests(unittest.TestCase):
+    def test_matches_brute_force(self):
+        rng = np.random.default_rng(1)
+        labels = rng.integers(0, 2, 200).astype(np.float64)
+        labels[rng.random(200) < 0.1] = np.nan
+        scores = np.round(rng.random(200), 2)
+
+        report = evaluation.report(labels, scores)
+
+        known = ~np.isnan(labels)
+        curve = report['curve']
+        for threshold, precision, recall in zip(curve['threshold'],
+                                                curve['precision'],
+                                                curve['recall']):
+            predicted = known & (scores >= threshold)
+            true_positives = (predicted & (labels == 1)).sum()
+            self.assertAlmostEqual(true_positives / predicted.sum(),
+                                   precision)
+            self.assertAlmostEqual(
+                    true_positives / (known & (labels == 1)).sum(), recall)
+
+        self.assertEqual(len(np.unique(scores)), len(curve['threshold']))
+        self.assertEqual(200, np.sum(report['matrix']))
+
+        top = np.argsort(-scores, kind='stable')[:100]
+        self.assertEqual(int(np.isnan(labels[top]).sum()),
+                         report['top']['100']['unknown'])
+        self.assertEqual(int((labels[top] == 1).sum()),
+                         report['top']['100']['positive'])
+
+    def test_perfect_ranking(self):
+        report = evaluation.report([0, 0, 1, 1], [0.05, 0.5, 0.8, 0.95])
+
+        self.assertEqual(1.0, report['roc_auc'])
+        self.assertEqual(1.0, report['average_precision'])
+        self.assertEqual(0.8, report['best_threshold'])
+        self.assertEqual([[1, 1, 0], [0, 0, 0], [0, 1, 1]], report['matrix'])
+
+    def test_empty(self):
+        report = evaluation.report([], [])
+
+        self.assertEqual(0, report['tiles'])
+        self.assertIsNone(report['best_threshold'])
+        self.assertEqual([], report['curve']['threshold'])
+        self.assertEqual([[0] * 3] * 3, report['matrix'])
+
+
+class EvaluateTests(unittest.TestCase):
+    def test_report_is_cached_until_labels_change(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db = database.Database(pathlib.Path(tmp) / 'tiles.db')
+            with db.transaction('populate') as c:
+                database.add_tile_hashes(c, [(18, 1, i, fake_hash(i))
+                                             for i in range(3)])
+                for i in range(3):
+                    c.execute('''insert into validation_set
+                                 (feature_name, z, x, y)
+                                 values ('solar', 18, 1, ?)''', [i])
+                database.set_has_feature(c, fake_hash(0), 'solar', True)
+                database.write_validation_predictions(
+                        c, 'solar', 'v1', [(fake_hash(0), 0.9),
+                                           (fake_hash(1), 0.2)])
+
+            self.assertEqual([fake_hash(2)], evaluation.missing_predictions(
+                db, 'solar', 'v1'))
+
+            report = evaluation.evaluate(db, 'solar', 'v1')
+            self.assertEqual(2, report['tiles'])
+            self.assertEqual(1, report['top']['100']['unknown'])
+            with db.transaction('test') as c:
+                c.execute('select count(*) from evaluation_reports')
+                self.assertEqual(1, c.fetchone()[0])
+            self.assertEqual(report, evaluation.evaluate(db, 'solar', 'v1'))
+
+            with db.transaction('label') as c:
+                database.set_has_feature(c, fake_hash(1), 'solar', False)
+            report = evaluation.evaluate(db, 'solar', 'v1')
+            self.assertEqual(0, report['top']['100']['unknown'])
+            self.assertEqual(1, report['negatives'])
@@ -0,0 +1,97 @@
+import io
+import pathlib
+import tempfile
+import unittest
+
+import numpy as np
+import PIL.Image
+
+import database
+import fingerprint
+import util
+
+
+def jpeg(pixels, quality):
+    output = io.BytesIO()
+    PIL.Image.fromarray(pixels).save(output, format='JPEG', quality=quality)
+    return output.getvalue()
+
+
+def fake_hash(i):
+    return f'{i:x}'.rjust(64, 'f')
+
+
+class FingerprintTests(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        # Smooth blobs, random noise doesn't survive downscaling
+        small = rng.integers(0, 256, (8, 8, 3), dtype=np.uint8)
+        self.pixels = np.asarray(PIL.Image.fromarray(small).resize(
+            (256, 256), PIL.Image.BICUBIC))
+
+    def test_reencoded_tile_is_equivalent(self):
+        a = fingerprint.compute(jpeg(self.pixels, 95))
+        b = fingerprint.compute(jpeg(self.pixels, 60))
+        self.assertTrue(a.equivalent(b))
+
+    def test_changed_tile_is_not_equivalent(self):
+        changed = self.pixels.copy()
+        changed[64:192, 64:192] = 255
+        a = fingerprint.compute(jpeg(self.pixels, 95))
+        b = fingerprint.compute(jpeg(changed, 95))
+        self.assertFalse(a.equivalent(b))
+
+    def test_small_local_change_is_not_equivalent(self):
+        # A few solar panels on one roof
+        changed = self.pixels.copy()
+        changed[100:120, 120:140] = (20, 30, 60)
+        a = fingerprint.compute(jpeg(self.pixels, 95))
+        b = fingerprint.compute(jpeg(changed, 95))
+        self.assertFalse(a.equivalent(b))
+
+    def test_only_scores_are_inherited(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db = database.Database(pathlib.Path(tmp) / 'tiles.db')
+            with db.transaction('test') as c:
+                database.add_tile_hashes(c, [(18, 1, 1, fake_hash(1)),
+                                             (18, 1, 1, fake_hash(2))])
+                database.write_score(c, fake_hash(1), 'solar', 0.9, 'model',
+                                     '2020-01-01T00:00:00')
+                database.set_has_feature(c, fake_hash(1), 'solar', True)
+
+                database.inherit_scores(c, fake_hash(1), fake_hash(2))
+                self.assertEqual(0.9, database.get_score(c, fake_hash(2),
+                                                         'solar'))
+                c.execute('select has_feature from has_feature '
+                          'where tile_hash = ?', (fake_hash(2),))
+                self.assertEqual([], c.fetchall())
+
+    def test_reencoded_download_inherits_scores(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            image_dir = pathlib.Path(tmp) / 'images'
+            for i, quality in [(1, 95), (2, 60)]:
+                path = util.tile_to_paths(image_dir, fake_hash(i))
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_bytes(jpeg(self.pixels, quality))
+
+            db = database.Database(pathlib.Path(tmp) / 'tiles.db')
+            with db.transaction('test') as c:
+                database.add_tile_hash(c, 18, 1, 1, fake_hash(1))
+                database.write_score(c, fake_hash(1), 'solar', 0.9, 'model',
+                                     '2020-01-01T00:00:00')
+
+            tiles = [(18, 1, 1, fake_hash(2))]
+            tiles, fingerprints, unchanged = fingerprint.compare(
+                    db, image_dir, tiles)
+            self.assertEqual([(18, 1, 1, fake_hash(2))], tiles)
+            # The previous tile had no fingerprint yet
+            self.assertEqual({fake_hash(1), fake_hash(2)}, set(fingerprints))
+            self.assertEqual([(fake_hash(1), fake_hash(2))], unchanged)
+
+            with db.transaction('test') as c:
+                self.assertEqual({fake_hash(2)}, fingerprint.register(
+                        c, tiles, fingerprints, unchanged))
+                self.assertEqual(0.9, database.get_score(c, fake_hash(2),
+                                                         'solar'))
+                self.assertIsNotNone(database.get_fingerprint(c,
+                                                              fake_hash(1)))
@@ -0,0 +1,53 @@
+import pathlib
+import tempfile
+import unittest
+
+import database
+import frontier
+
+
+class FrontierTests(unittest.TestCase):
+    def test_pops_by_priority_then_newest(self):
+        positions = frontier.Frontier()
+        positions.push(18, 1, 1, 0.5)
+        positions.push(18, 2, 2, 0.9)
+        positions.push(18, 3, 3, 0.5)
+        positions.push(18, 1, 1, 0.2)
+
+        self.assertEqual(3, len(positions))
+        self.assertEqual([(18, 2, 2), (18, 3, 3), (18, 1, 1)],
+                         [positions.pop() for _ in range(3)])
+        with self.assertRaises(IndexError):
+            positions.pop()
+
+    def test_raising_priority_moves_position_forward(self):
+        positions = frontier.Frontier()
+        positions.push(18, 1, 1, 0.5)
+        positions.push(18, 2, 2, 0.9)
+        positions.push(18, 1, 1, 2.0)
+
+        self.assertEqual(2, len(positions))
+        self.assertIn((18, 1, 1), positions)
+        self.assertEqual((18, 1, 1), positions.pop())
+        self.assertNotIn((18, 1, 1), positions)
+        self.assertEqual((18, 2, 2), positions.pop())
+        self.assertEqual(0, len(positions))
+
+    def test_resumes_from_database(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db = database.Database(pathlib.Path(tmp) / 'tiles.db')
+            positions = frontier.Frontier()
+            positions.push(18, 1, 1, 0.5)
+            positions.push(18, 2, 2, 0.9)
+            positions.push(18, 3, 3, 0.1)
+            positions.pop()
+            with db.transaction('test') as c:
+                positions.sync(c)
+            positions.pop()
+            with db.transaction('test') as c:
+                positions.sync(c)
+
+            with db.transaction('test') as c:
+                resumed = frontier.Frontier.load(c)
+            self.assertEqual(1, len(resumed))
+            self.assertEqual((18, 3, 3), resumed.pop())
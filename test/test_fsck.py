@@ -0,0 +1,104 @@
+import hashlib
+import os
+import pathlib
+import tempfile
+import time
+import unittest
+import unittest.mock
+
+import database
+import fsck
+import util
+
+
+class FsckTests(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        tmp = pathlib.Path(self._tmp.name)
+        self.tile_path = tmp / 'images'
+        self.quarantine_path = tmp / 'quarantine'
+        self.state_path = tmp / 'fsck.json'
+        self.db = database.Database(tmp / 'tiles.db')
+
+        self.hashes = [self.write_tile(f'tile {i}'.encode())
+                       for i in range(4)]
+        with self.db.transaction('populate') as c:
+            database.add_tile_hashes(c, [(18, i, 0, tile_hash)
+                                         for i, tile_hash
+                                         in enumerate(self.hashes)])
+            database.add_tile_hash(c, 18, 10, 0, 'f' * 64)
+            c.execute('update last_update set timestamp = ?',
+                      ['2020-01-01T00:00:00'])
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def write_tile(self, data):
+        tile_hash = hashlib.sha256(data).hexdigest()
+        path = util.tile_to_paths(self.tile_path, tile_hash)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+        return tile_hash
+
+    def check(self, incremental=False, repair=False, quarantine_stray=False):
+        fsck.check_tile_store(self.db, self.tile_path, self.state_path,
+                              incremental, repair, self.quarantine_path, 1,
+                              quarantine_stray)
+
+    def last_checked(self, x):
+        with self.db.transaction('test') as c:
+            return database.last_checked(c, 18, x, 0).year
+
+    def test_set_differences(self):
+        on_disk = fsck.pack_hashes(['00' * 32, 'ab' * 32, 'cd' * 32])
+        in_database = fsck.pack_hashes(['cd' * 32, 'ab' * 32, 'ef' * 32])
+        orphans, missing = fsck.set_differences(on_disk, in_database)
+        self.assertEqual(['00' * 32], fsck.unpack_hashes(orphans))
+        self.assertEqual(['ef' * 32], fsck.unpack_hashes(missing))
+
+    def write_old_tile(self, data):
+        tile_hash = self.write_tile(data)
+        old = time.time() - 2 * fsck.orphan_grace_seconds
+        os.utime(util.tile_to_paths(self.tile_path, tile_hash), (old, old))
+        return tile_hash
+
+    def test_repair(self):
+        orphan = self.write_old_tile(b'not in the database')
+        util.tile_to_paths(self.tile_path,
+                           self.hashes[1]).write_bytes(b'corrupt')
+
+        self.check(repair=True)
+
+        self.assertFalse(util.tile_to_paths(self.tile_path, orphan).exists())
+        self.assertTrue(util.tile_to_paths(self.quarantine_path,
+                                           orphan).exists())
+        self.assertFalse(util.tile_to_paths(self.tile_path,
+                                            self.hashes[1]).exists())
+        self.assertEqual([2020, 1970, 2020, 2020, 1970],
+                         [self.last_checked(x) for x in [0, 1, 2, 3, 10]])
+
+    def test_recent_orphans_are_left_for_the_downloader(self):
+        orphan = self.write_tile(b'not registered yet')
+
+        self.check(repair=True)
+        self.assertTrue(util.tile_to_paths(self.tile_path, orphan).exists())
+
+    def test_stray_files_need_their_own_flag(self):
+        stray = self.tile_path / 'README'
+        stray.write_text('Tiles from NiB')
+
+        self.check(repair=True)
+        self.assertTrue(stray.exists())
+
+        self.check(repair=True, quarantine_stray=True)
+        self.assertFalse(stray.exists())
+        self.assertTrue((self.quarantine_path / 'README').exists())
+
+    def test_incremental_only_verifies_new_files(self):
+        self.check()
+        self.assertTrue(self.state_path.exists())
+
+        with unittest.mock.patch('fsck.verify_files',
+                                 return_value=[]) as verify_files:
+            self.check(incremental=True)
+        self.assertEqual([], verify_files.call_args[0][1])
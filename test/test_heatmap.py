@@ -0,0 +1,115 @@
+import pathlib
+import tempfile
+import unittest
+
+import database
+import heatmap
+
+
+class HeatmapTests(unittest.TestCase):
+    def test_levels_are_aggregated_bottom_up(self):
+        levels = heatmap.build_levels([0, 1, 2, 3],
+                                      [0, 1, 0, 0],
+                                      [0.2, 0.6, 1.0, 0.0],
+                                      16)
+
+        self.assertEqual([0, 1], list(levels[17].x))
+        self.assertEqual([0.6, 1.0], list(levels[17].value('max')))
+        self.assertEqual([0.4, 0.5], list(levels[17].value('mean')))
+
+        self.assertEqual([0], list(levels[16].x))
+        self.assertEqual([1.0], list(levels[16].value('max')))
+        self.assertEqual([0.45], list(levels[16].value('mean')))
+
+    def test_only_changed_tiles_are_rendered_again(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = pathlib.Path(tmp)
+            db = database.Database(tmp / 'tiles.db')
+            with db.transaction('populate') as c:
+                for x in [0, 1000]:
+                    tile_hash = f'{x}'.rjust(64, 'a')
+                    database.add_tile_hash(c, 18, x, 0, tile_hash)
+                    database.write_score(c, tile_hash, 'solar', 0.5, 'm1',
+                                         '2000-01-01T00:00:00')
+
+            heatmap.render(db, 'solar', tmp / 'out', 15, 16, 1.0, False)
+            self.assertTrue((tmp / 'out/solar/max/16/0/0.png').exists())
+            self.assertTrue((tmp / 'out/solar/max/16/250/0.png').exists())
+
+            (tmp / 'out/solar/max/16/0/0.png').unlink()
+            (tmp / 'out/solar/max/16/250/0.png').unlink()
+            with db.transaction('rescore') as c:
+                database.write_score(c, '1000'.rjust(64, 'a'), 'solar', 0.9,
+                                     'm2', '2999-01-01T00:00:00')
+
+            heatmap.render(db, 'solar', tmp / 'out', 15, 16, 1.0, False)
+            self.assertFalse((tmp / 'out/solar/max/16/0/0.png').exists())
+            self.assertTrue((tmp / 'out/solar/max/16/250/0.png').exists())
+
+    def test_removed_scores_are_rendered_again(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = pathlib.Path(tmp)
+            db = database.Database(tmp / 'tiles.db')
+            with db.transaction('populate') as c:
+                for x in [0, 1, 1000]:
+                    tile_hash = f'{x}'.rjust(64, 'a')
+                    database.add_tile_hash(c, 18, x, 0, tile_hash)
+                    database.write_score(c, tile_hash, 'solar', 0.5, 'm1',
+                                         '2000-01-01T00:00:00')
+
+            heatmap.render(db, 'solar', tmp / 'out', 15, 16, 1.0, False)
+            first_tile = tmp / 'out/solar/max/16/0/0.png'
+            before = first_tile.read_bytes()
+
+            with db.transaction('skip') as c:
+                database.remove_score(c, 'solar', '1'.rjust(64, 'a'))
+                database.remove_score(c, 'solar', '1000'.rjust(64, 'a'))
+
+            heatmap.render(db, 'solar', tmp / 'out', 15, 16, 1.0, False)
+            self.assertNotEqual(before, first_tile.read_bytes())
+            self.assertFalse((tmp / 'out/solar/max/16/250/0.png').exists())
+
+    def test_last_removed_score_deletes_its_tiles(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = pathlib.Path(tmp)
+            db = database.Database(tmp / 'tiles.db')
+            tile_hash = '0'.rjust(64, 'a')
+            with db.transaction('populate') as c:
+                database.add_tile_hash(c, 18, 0, 0, tile_hash)
+                database.write_score(c, tile_hash, 'solar', 0.5, 'm1',
+                                     '2000-01-01T00:00:00')
+
+            heatmap.render(db, 'solar', tmp / 'out', 15, 16, 1.0, False)
+            self.assertTrue((tmp / 'out/solar/max/16/0/0.png').exists())
+
+            with db.transaction('skip') as c:
+                database.remove_score(c, 'solar', tile_hash)
+
+            heatmap.render(db, 'solar', tmp / 'out', 15, 16, 1.0, False)
+            self.assertFalse((tmp / 'out/solar/max/16/0/0.png').exists())
+            with db.transaction('check') as c:
+                self.assertIsNotNone(database.last_heatmap_render(
+                    c, 'solar', 'max'))
+
+    def test_inherited_scores_are_rendered(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = pathlib.Path(tmp)
+            db = database.Database(tmp / 'tiles.db')
+            old_hash = '0'.rjust(64, 'a')
+            with db.transaction('populate') as c:
+                database.add_tile_hash(c, 18, 0, 0, old_hash)
+                database.write_score(c, old_hash, 'solar', 0.5, 'm1',
+                                     '2000-01-01T00:00:00')
+
+            heatmap.render(db, 'solar', tmp / 'out', 15, 16, 1.0, False)
+            (tmp / 'out/solar/max/16/0/0.png').unlink()
+
+            # Imagery of a new position that looks like an old tile
+            new_hash = '1000'.rjust(64, 'a')
+            with db.transaction('reuse') as c:
+                database.add_tile_hash(c, 18, 1000, 0, new_hash)
+                database.inherit_scores(c, old_hash, new_hash)
+
+            heatmap.render(db, 'solar', tmp / 'out', 15, 16, 1.0, False)
+            self.assertFalse((tmp / 'out/solar/max/16/0/0.png').exists())
+            self.assertTrue((tmp / 'out/solar/max/16/250/0.png').exists())
@@ -0,0 +1,95 @@
+import pathlib
+import tempfile
+import threading
+import unittest
+
+import database
+import model_server
+
+
+def fake_hash(i):
+    return f'{i:x}'.rjust(64, 'f')
+
+
+class FakePredictor(object):
+    def __init__(self):
+        self.batches = []
+
+    def __call__(self, tile_hashes):
+        self.batches.append(list(tile_hashes))
+        return [None if tile_hash == fake_hash(0) else 0.5
+                for tile_hash in tile_hashes]
+
+
+class ModelServerTests(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.db_path = pathlib.Path(self._tmp.name) / 'tiles.db'
+        self.db = database.Database(self.db_path)
+        with self.db.transaction('populate') as c:
+            database.add_tile_hashes(c, [(18, 1, i, fake_hash(i))
+                                         for i in range(10)])
+
+        self.predict = FakePredictor()
+        self.batcher = model_server.Batcher(
+                self.predict,
+                model_server.ScoreWriter(self.db_path, 'solar', 'v1'),
+                max_batch_size=8,
+                max_delay=0.2)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_requests_are_batched_and_written(self):
+        # The same tile twice in one batch is only scored once
+        futures = [self.batcher.submit(fake_hash(i))
+                   for i in [0, 1, 1] + list(range(2, 10))]
+        results = [future.result(5) for future in futures]
+        self.batcher.close()
+
+        self.assertEqual([None] + [0.5] * 10, results)
+        self.assertEqual([7, 3],
+                         [len(batch) for batch in self.predict.batches])
+
+        with self.db.transaction('test') as c:
+            self.assertIsNone(database.get_score(c, fake_hash(0), 'solar'))
+            self.assertEqual(0.5, database.get_score(c, fake_hash(9),
+                                                     'solar'))
+
+    def test_unknown_hash_does_not_stop_the_batcher(self):
+        batcher = model_server.Batcher(
+                self.predict,
+                model_server.ScoreWriter(self.db_path, 'solar', 'v1',
+                                         batch_size=1),
+                max_batch_size=8,
+                max_delay=0.05)
+        unknown = 'e' * 64
+        self.assertEqual([0.5, 0.5],
+                         [batcher.submit(tile_hash).result(5)
+                          for tile_hash in [unknown, fake_hash(1)]])
+        # Served after the failed write
+        self.assertEqual(0.5, batcher.submit(fake_hash(2)).result(5))
+        batcher.close()
+
+        with self.db.transaction('test') as c:
+            self.assertIsNone(database.get_score(c, unknown, 'solar'))
+            self.assertEqual(0.5, database.get_score(c, fake_hash(1),
+                                                     'solar'))
+            self.assertEqual(0.5, database.get_score(c, fake_hash(2),
+                                                     'solar'))
+
+    def test_http_round_trip(self):
+        server = model_server.Server(('127.0.0.1', 0),
+                                     {'solar': self.batcher})
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            client = model_server.Client(
+                    'http://127.0.0.1:{}'.format(server.server_address[1]))
+            scores = client.score([fake_hash(2), fake_hash(3)])
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual({'solar': {fake_hash(2): 0.5, fake_hash(3): 0.5}},
+                         scores)
@@ -0,0 +1,88 @@
+import io
+import pathlib
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+import PIL.Image
+
+import mosaic
+import util
+
+
+class MosaicTests(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.tile_path = pathlib.Path(self._tmp.name)
+        self.hashes = []
+        for i in range(3):
+            tile_hash = f'{i}'.rjust(64, 'a')
+            path = util.tile_to_paths(self.tile_path, tile_hash)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            PIL.Image.new('RGB', (256, 256), (i * 100, 0, 0)).save(path)
+            self.hashes.append(tile_hash)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def neighbourhood(self, centre):
+        return [[None, None, None],
+                [None, centre, None],
+                [None, None, None]]
+
+    def test_render_size(self):
+        data = mosaic.render(self.tile_path,
+                             self.neighbourhood(self.hashes[0]))
+        with PIL.Image.open(io.BytesIO(data)) as image:
+            self.assertEqual((768, 768), image.size)
+
+    def test_cache_is_bounded_by_bytes(self):
+        sizes = [len(mosaic.render(self.tile_path,
+                                   self.neighbourhood(tile_hash)))
+                 for tile_hash in self.hashes]
+        cache = mosaic.MosaicCache(self.tile_path,
+                                   max_bytes=sizes[1] + sizes[2])
+        for tile_hash in self.hashes:
+            cache.get(self.neighbourhood(tile_hash))
+        self.assertEqual(3, cache.renders)
+
+        # The two newest are kept, the oldest has to be rendered again
+        cache.get(self.neighbourhood(self.hashes[2]))
+        cache.get(self.neighbourhood(self.hashes[1]))
+        self.assertEqual((2, 3), (cache.hits, cache.renders))
+        cache.get(self.neighbourhood(self.hashes[0]))
+        self.assertEqual((2, 4), (cache.hits, cache.renders))
+
+    def test_concurrent_misses_render_once(self):
+        cache = mosaic.MosaicCache(self.tile_path)
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_render(tile_path, neighbours):
+            started.set()
+            release.wait(5)
+            return b'mosaic'
+
+        neighbours = self.neighbourhood(self.hashes[0])
+        results = []
+        with unittest.mock.patch('mosaic.render', slow_render):
+            first = threading.Thread(
+                    target=lambda: results.append(cache.get(neighbours)))
+            first.start()
+            started.wait(5)
+            second = threading.Thread(
+                    target=lambda: results.append(cache.get(neighbours)))
+            second.start()
+            # Wait for the second request to find the first one rendering
+            deadline = time.monotonic() + 5
+            while cache.hits == 0 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            release.set()
+            first.join(5)
+            second.join(5)
+
+        self.assertEqual([b'mosaic', b'mosaic'], results)
+        self.assertIs(results[0], results[1])
+        self.assertEqual((1, 1), (cache.hits, cache.renders))
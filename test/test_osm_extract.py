@@ -0,0 +1,66 @@
+import pathlib
+import tempfile
+import unittest
+
+import osm_extract
+
+
+extract = '''<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+  <node id="3" lat="59.1" lon="10.1"/>
+  <node id="1" lat="59.0" lon="10.0">
+    <tag k="power" v="generator"/>
+  </node>
+  <node id="2" lat="59.1" lon="10.0"/>
+  <node id="4" lat="60.0" lon="11.0"/>
+  <way id="10">
+    <nd ref="1"/>
+    <nd ref="2"/>
+    <nd ref="3"/>
+    <nd ref="1"/>
+    <tag k="power" v="generator"/>
+    <tag k="generator:source" v="solar"/>
+  </way>
+  <way id="11">
+    <nd ref="2"/>
+    <nd ref="4"/>
+    <tag k="leisure" v="playground"/>
+  </way>
+  <way id="12">
+    <nd ref="1"/>
+    <nd ref="99"/>
+    <tag k="leisure" v="playground"/>
+  </way>
+  <way id="13">
+    <nd ref="1"/>
+    <nd ref="4"/>
+    <tag k="power" v="generator"/>
+  </way>
+</osm>
+'''
+
+
+class OsmExtractTests(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self._tmp.name) / 'extract.osm'
+        self.path.write_text(extract)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_solar_ways(self):
+        osm = osm_extract.load(self.path, 'solar')
+        self.assertEqual([10], osm.way_ids.tolist())
+
+        lat, lon = osm.way_coordinates(0)
+        self.assertEqual([59.0, 59.1, 59.1, 59.0], lat.tolist())
+        self.assertEqual([10.0, 10.0, 10.1, 10.0], lon.tolist())
+        self.assertEqual(0, len(osm.centres))
+
+    def test_playground_centres(self):
+        with self.assertLogs(level='WARNING'):
+            osm = osm_extract.load(self.path, 'playground')
+        # Way 12 refers to a node outside the extract
+        self.assertEqual([11], osm.way_ids.tolist())
+        self.assertEqual([[59.55, 10.5]], osm.centres.tolist())
@@ -0,0 +1,109 @@
+import datetime
+import http.server
+import io
+import json
+import tempfile
+import threading
+import unittest
+import unittest.mock
+
+import overpass
+
+
+reply = {
+        'version': 0.6,
+        'elements': [
+            {'type': 'way', 'id': 10, 'nodes': [3, 1, 2, 3]},
+            {'type': 'way', 'id': 11, 'center': {'lat': 59.5, 'lon': 10.5}},
+            {'type': 'node', 'id': 1, 'lat': 59.0, 'lon': 10.0},
+            {'type': 'node', 'id': 2, 'lat': 59.1, 'lon': 10.0},
+            {'type': 'node', 'id': 3, 'lat': 59.1, 'lon': 10.1},
+            ],
+        }
+
+
+class OverpassStandIn(http.server.BaseHTTPRequestHandler):
+    status = 200
+    requests = []
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        self.rfile.read(length)
+        OverpassStandIn.requests.append(dict(self.headers))
+
+        self.send_response(self.status)
+        self.end_headers()
+        if self.status == 200:
+            self.wfile.write(json.dumps(reply).encode())
+
+    def log_message(self, *args):
+        pass
+
+
+class ParserTests(unittest.TestCase):
+    def test_elements_are_streamed_across_chunks(self):
+        with unittest.mock.patch('overpass.read_size', 7):
+            elements = list(overpass.iter_elements(
+                io.StringIO(json.dumps(reply, indent=2))))
+        self.assertEqual(reply['elements'], elements)
+
+    def test_parse_ways_and_centres(self):
+        osm = overpass.parse(io.StringIO(json.dumps(reply)))
+        self.assertEqual([10], osm.way_ids.tolist())
+
+        lat, lon = osm.way_coordinates(0)
+        self.assertEqual([59.1, 59.0, 59.1, 59.1], lat.tolist())
+        self.assertEqual([10.1, 10.0, 10.0, 10.1], lon.tolist())
+
+        lat, lon = osm.points()
+        self.assertEqual([59.5, 59.0, 59.1, 59.1], lat.tolist())
+
+    def test_missing_node_is_an_error(self):
+        broken = {'elements': [{'type': 'way', 'id': 1, 'nodes': [5]}]}
+        with self.assertRaises(ValueError):
+            overpass.parse(io.StringIO(json.dumps(broken)))
+
+
+class ClientTests(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        OverpassStandIn.status = 200
+        OverpassStandIn.requests = []
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                      OverpassStandIn)
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}/'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self._tmp.cleanup()
+
+    def client(self, ttl=overpass.default_ttl):
+        return overpass.Client(self.url, self._tmp.name, ttl)
+
+    def test_fresh_reply_is_served_from_cache(self):
+        self.assertEqual([10], self.client().load('q').way_ids.tolist())
+        self.assertEqual([10], self.client().load('q').way_ids.tolist())
+        self.assertEqual(1, len(OverpassStandIn.requests))
+
+        self.client().load('other query')
+        self.assertEqual(2, len(OverpassStandIn.requests))
+
+    def test_stale_reply_is_revalidated(self):
+        client = self.client(datetime.timedelta(0))
+        client.load('q')
+
+        OverpassStandIn.status = 304
+        self.assertEqual([10], client.load('q').way_ids.tolist())
+        self.assertEqual(2, len(OverpassStandIn.requests))
+        self.assertIn('If-Modified-Since', OverpassStandIn.requests[1])
+
+    def test_stale_reply_is_used_when_offline(self):
+        self.client().load('q')
+        self.server.shutdown()
+        self.server.server_close()
+
+        client = self.client(datetime.timedelta(0))
+        self.assertEqual([10], client.load('q').way_ids.tolist())
@@ -0,0 +1,109 @@
+import os
+import pathlib
+import queue
+import tempfile
+import time
+import unittest
+
+import numpy as np
+import PIL.Image
+
+import database
+import pipeline
+import util
+
+
+def fake_hash(i):
+    return f'{i:x}'.rjust(64, 'f')
+
+
+class ConstantModel(object):
+    def __init__(self, score):
+        self.score = score
+
+    def predict_on_batch(self, images):
+        return np.full((len(images), 1), self.score)
+
+
+class TakeBatchTests(unittest.TestCase):
+    def test_batches_up_to_max_size(self):
+        source = queue.Queue()
+        for i in range(5):
+            source.put(i)
+
+        self.assertEqual([0, 1, 2], pipeline.take_batch(source, 3, 0.1, 0.1))
+        self.assertEqual([3, 4], pipeline.take_batch(source, 3, 0.1, 0.1))
+        self.assertEqual([], pipeline.take_batch(source, 3, 0.1, 0.1))
+
+
+class PipelineTests(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        tmp = pathlib.Path(self._tmp.name)
+        self.db_path = tmp / 'tiles.db'
+        self.image_dir = tmp / 'images'
+        self.weights = tmp / 'solar.hdf5'
+        self.weights.write_bytes(b'v1')
+
+        self.db = database.Database(self.db_path)
+        with self.db.transaction('populate') as c:
+            database.add_tile_hashes(c, [(18, 1, i, fake_hash(i))
+                                         for i in range(3)])
+        for i in range(3):
+            path = util.tile_to_paths(self.image_dir, fake_hash(i))
+            path.parent.mkdir(parents=True, exist_ok=True)
+            PIL.Image.new('RGB', (256, 256)).save(path)
+
+        self.loads = 0
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def load(self, model_type, feature_name, path):
+        self.loads += 1
+        version = path.read_bytes().decode()
+        return ConstantModel(0.25 * self.loads), version
+
+    def warm_model(self):
+        return pipeline.WarmModel('solar', self.weights, 'VGG19',
+                                  self.image_dir, self.db_path,
+                                  load=self.load)
+
+    def score(self, tile_hash):
+        with self.db.transaction('test') as c:
+            return database.get_score(c, tile_hash, 'solar')
+
+    def test_model_is_reloaded_when_changed(self):
+        m = self.warm_model()
+        self.assertTrue(m.check())
+        self.assertFalse(m.check())
+        self.assertEqual('v1', m.version)
+
+        self.weights.write_bytes(b'v2')
+        stat = self.weights.stat()
+        os.utime(self.weights, ns=(stat.st_atime_ns,
+                                   stat.st_mtime_ns + 10 ** 9))
+        self.assertEqual(3, m.score([fake_hash(i) for i in range(3)]))
+        m.close()
+
+        self.assertEqual('v2', m.version)
+        self.assertEqual(2, self.loads)
+        self.assertEqual(0.5, self.score(fake_hash(0)))
+
+    def test_new_tiles_flow_to_scoring(self):
+        m = self.warm_model()
+        m.check()
+        p = pipeline.Pipeline(self.db_path, self.image_dir, None, [m],
+                              'solar', max_delay=0.05)
+        p.start(download=False)
+        p.add_tiles([fake_hash(1), fake_hash(2)])
+
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline and p._to_score.qsize():
+            time.sleep(0.05)
+        p.stop.set()
+        p.join()
+
+        self.assertEqual(0.25, self.score(fake_hash(1)))
+        self.assertEqual(0.25, self.score(fake_hash(2)))
+        self.assertIsNone(self.score(fake_hash(0)))
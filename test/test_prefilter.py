@@ -0,0 +1,108 @@
+import concurrent.futures
+import io
+import pathlib
+import tempfile
+import unittest
+import unittest.mock
+
+import numpy as np
+import PIL.Image
+
+import database
+import prefilter
+import util
+
+
+def smooth(rng, cells, channels):
+    """Blocky random pattern in [0, 1) of cells x cells blocks"""
+    blocks = rng.random((cells, cells, channels))
+    return np.repeat(np.repeat(blocks, 256 // cells, axis=0), 256 // cells,
+                     axis=1).squeeze()
+
+
+class PrefilterTests(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        tmp = pathlib.Path(self._tmp.name)
+        self.tile_path = tmp / 'images'
+        self.db = database.Database(tmp / 'tiles.db')
+
+        rng = np.random.default_rng(0)
+        # Blue with gentle large scale variation plus fine noise
+        waves = smooth(rng, 8, 1)
+        sea = np.zeros((256, 256, 3))
+        sea[..., 1] = 40 + waves * 40
+        sea[..., 2] = 100 + waves * 80
+        sea += rng.integers(0, 30, sea.shape)
+        city = smooth(rng, 16, 3) * 255 + rng.integers(-20, 20, (256, 256, 3))
+        self.tiles = {
+            'blank': np.full((256, 256, 3), 200, dtype=np.uint8),
+            'water': np.clip(sea, 0, 255).astype(np.uint8),
+            'city': np.clip(city, 0, 255).astype(np.uint8),
+            }
+        self.hashes = {}
+        with self.db.transaction('populate') as c:
+            for x, (name, pixels) in enumerate(self.tiles.items()):
+                tile_hash = self.write_tile(pixels)
+                self.hashes[name] = tile_hash
+                database.add_tile_hash(c, 18, x, 0, tile_hash)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def write_tile(self, pixels):
+        data = io.BytesIO()
+        PIL.Image.fromarray(pixels).save(data, format='JPEG')
+        path = self.tile_path / 'tmp.jpeg'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data.getvalue())
+        tile_hash = util.hash_file(path)
+        final_path = util.tile_to_paths(self.tile_path, tile_hash)
+        final_path.parent.mkdir(parents=True, exist_ok=True)
+        path.rename(final_path)
+        return tile_hash
+
+    def test_reasons(self):
+        reasons = {name: prefilter.negative_reason(
+                       *prefilter.tile_stats(self.tile_path, tile_hash))
+                   for name, tile_hash in self.hashes.items()}
+        self.assertEqual({'blank': 'blank', 'water': 'water', 'city': None},
+                         reasons)
+
+    def compute_stats(self):
+        with unittest.mock.patch('concurrent.futures.ProcessPoolExecutor',
+                                 concurrent.futures.ThreadPoolExecutor):
+            prefilter.compute_stats(self.db, self.tile_path, 1)
+
+    def test_negatives_are_not_scored(self):
+        self.compute_stats()
+        prefilter.mark_negatives(self.db, 'playground')
+
+        tiles, count = self.db.tiles_for_scoring('model', 'playground', 10)
+        self.assertEqual(1, count)
+        self.assertEqual([self.hashes['city']],
+                         [tile_hash for tile_hash, _ in tiles])
+
+        with self.db.transaction('test') as c:
+            self.assertEqual(2, database.count_trivially_negative(
+                c, 'playground', 'model'))
+            self.assertEqual([], database.tiles_without_stats(c))
+
+    def test_water_is_scored_for_solar(self):
+        self.compute_stats()
+        prefilter.mark_negatives(self.db, 'solar')
+
+        tiles, _ = self.db.tiles_for_scoring('model', 'solar', 10)
+        self.assertEqual({self.hashes['water'], self.hashes['city']},
+                         set(tile_hash for tile_hash, _ in tiles))
+
+    def test_positives_are_never_filtered(self):
+        self.compute_stats()
+        with self.db.transaction('label') as c:
+            database.set_has_feature(c, self.hashes['blank'], 'playground',
+                                     True)
+        prefilter.mark_negatives(self.db, 'playground')
+
+        with self.db.transaction('test') as c:
+            self.assertEqual(1, database.count_trivially_negative(
+                c, 'playground'))
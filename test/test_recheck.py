@@ -0,0 +1,79 @@
+import datetime
+import pathlib
+import tempfile
+import unittest
+
+import database
+import recheck
+
+
+def fake_hash(i):
+    return f'{i:x}'.rjust(64, 'f')
+
+
+class RecheckTests(unittest.TestCase):
+    def test_rates_are_shrunk_towards_region(self):
+        # Two regions, one where things change a lot
+        rates = recheck.estimate_rates([4, 0, 0, 0],
+                                       [365, 365, 365, 365],
+                                       [0, 0, 1, 1])
+        self.assertGreater(rates[0], rates[1])
+        self.assertGreater(rates[1], rates[2])
+        self.assertAlmostEqual(rates[2], rates[3])
+
+    def test_changing_position_is_due_first(self):
+        now = datetime.datetime(2024, 1, 1)
+        history = [
+                (18, 0, 0, 5, '2020-01-01T00:00:00', '2023-06-01T00:00:00'),
+                (18, 1000, 0, 1, '2020-01-01T00:00:00',
+                 '2023-06-01T00:00:00'),
+                ]
+        schedule = recheck.build_schedule(history, {}, now)
+        (_, _, _, due_busy, priority_busy, _), \
+            (_, _, _, due_quiet, priority_quiet, _) = schedule
+        self.assertLess(due_busy, due_quiet)
+        self.assertGreater(priority_busy, priority_quiet)
+
+    def test_score_raises_priority(self):
+        now = datetime.datetime(2024, 1, 1)
+        history = [
+                (18, 0, 0, 1, '2020-01-01T00:00:00', '2023-06-01T00:00:00'),
+                (18, 1, 0, 1, '2020-01-01T00:00:00', '2023-06-01T00:00:00'),
+                ]
+        schedule = recheck.build_schedule(history, {(18, 1, 0): 0.9}, now)
+        self.assertLess(schedule[0][4], schedule[1][4])
+
+    def test_due_rechecks(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db = database.Database(pathlib.Path(tmp) / 'tiles.db')
+            with db.transaction('test') as c:
+                database.add_tile_hashes(c, [(18, 0, 0, fake_hash(1)),
+                                             (18, 1, 0, fake_hash(2))])
+                database.write_score(c, fake_hash(2), 'solar', 0.9, 'model',
+                                     '2020-01-01T00:00:00')
+
+            now = datetime.datetime.now()
+            self.assertEqual(2, recheck.update(db, 'solar', now))
+            with db.transaction('test') as c:
+                self.assertEqual([(18, 1, 0), (18, 0, 0)],
+                                 [row[:3] for row in database.due_rechecks(
+                                     c, now.isoformat())])
+
+                recheck.reschedule(c, 18, 1, 0, now)
+                self.assertEqual([(18, 0, 0)],
+                                 [row[:3] for row in database.due_rechecks(
+                                     c, now.isoformat())])
+
+    def test_imported_position_is_due_right_away(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db = database.Database(pathlib.Path(tmp) / 'tiles.db')
+            with db.transaction('test') as c:
+                database.add_tile_hashes(c, [(18, 0, 0, fake_hash(1))])
+                database.mark_checked(c, 18, 0, 0)
+                database.add_tile(c, 18, 5, 5)
+
+            now = datetime.datetime.now()
+            self.assertEqual(2, recheck.update(db, 'solar', now))
+            with db.transaction('test') as c:
+                self.assertEqual([(18, 5, 5, recheck.new_position_priority)],
+                                 database.due_rechecks(c, now.isoformat()))
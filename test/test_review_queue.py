@@ -0,0 +1,76 @@
+import pathlib
+import tempfile
+import unittest
+
+import database
+import review_queue
+
+
+def tile_hash_for(i):
+    return f'{i:x}'.rjust(64, 'f')
+
+
+class ReviewQueueTests(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.db_path = pathlib.Path(self._tmp.name) / 'tiles.db'
+        self.db = database.Database(self.db_path)
+
+        with self.db.transaction('populate') as c:
+            for i in range(10):
+                tile_hash = tile_hash_for(i)
+                database.add_tile_hash(c, 18, i, 0, tile_hash)
+                database.write_score(c, tile_hash, 'solar', i / 10, 'm1',
+                                     '2024-01-01T00:00:00')
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_tiles_are_served_in_score_order(self):
+        queue = review_queue.ReviewQueue(self.db_path, 'solar')
+        first = queue.next_tile()
+        second = queue.next_tile()
+        self.assertEqual(tile_hash_for(9), first[0])
+        self.assertEqual(tile_hash_for(8), second[0])
+
+    def test_leased_tiles_are_not_served_again_after_refill(self):
+        queue = review_queue.ReviewQueue(self.db_path, 'solar')
+        first = queue.next_tile()
+        queue.refill()
+        self.assertNotEqual(first[0], queue.next_tile()[0])
+
+    def test_answered_tiles_are_dropped(self):
+        queue = review_queue.ReviewQueue(self.db_path, 'solar')
+        queue.refill()
+        queue.answered(tile_hash_for(9))
+        self.assertEqual(tile_hash_for(8), queue.next_tile()[0])
+
+    def test_empty_database_gives_no_tile(self):
+        with self.db.transaction('clear') as c:
+            c.execute('delete from scores')
+
+        queue = review_queue.ReviewQueue(self.db_path, 'solar')
+        self.assertIsNone(queue.next_tile())
+
+    def test_new_model_version_is_noticed_when_serving(self):
+        queue = review_queue.ReviewQueue(self.db_path, 'solar',
+                                         version_check_interval=0)
+        self.assertEqual(tile_hash_for(9), queue.next_tile()[0])
+
+        with self.db.transaction('rescore') as c:
+            database.write_score(c, tile_hash_for(0), 'solar', 1.0, 'm2',
+                                 '2024-01-02T00:00:00')
+
+        tile = queue.next_tile()
+        self.assertEqual((tile_hash_for(0), 'm2'), (tile[0], tile[5]))
+
+    def test_neighbour_scores_do_not_invalidate(self):
+        queue = review_queue.ReviewQueue(self.db_path, 'solar',
+                                         version_check_interval=0)
+        self.assertEqual(tile_hash_for(9), queue.next_tile()[0])
+
+        with self.db.transaction('tag_neighbours') as c:
+            database.write_score(c, tile_hash_for(0), 'solar', 1.0,
+                                 'neighbour', '2024-01-02T00:00:00')
+
+        self.assertEqual(tile_hash_for(8), queue.next_tile()[0])
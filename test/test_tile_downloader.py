@@ -0,0 +1,110 @@
+import json
+import pathlib
+import tempfile
+import threading
+import unittest
+import unittest.mock
+
+import PIL.Image
+
+import database
+import tile_downloader
+import util
+
+
+class TileDownloaderTests(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        tmp = pathlib.Path(self._tmp.name)
+        self.db_path = tmp / 'tiles.db'
+        self.key_path = tmp / 'key.json'
+        self.image_dir = tmp / 'images'
+        with open(self.key_path, 'w') as f:
+            json.dump({'key': 'secret'}, f)
+
+        self.release = threading.Event()
+        self.calls = []
+        # Positions whose download is an existing file or not a JPEG
+        self.existing = set()
+        self.broken = set()
+
+        def fake_download(image_dir, key, z, x, y, retry=True):
+            self.calls.append((z, x, y))
+            self.release.wait(5)
+            tile_hash = f'{x}{y}'.rjust(64, 'a')
+            path = util.tile_to_paths(image_dir, tile_hash)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            if (x, y) in self.broken:
+                path.write_bytes(b'truncated')
+            else:
+                PIL.Image.new('RGB', (256, 256), (x, y, 0)).save(path)
+            return (x, y) not in self.existing, tile_hash
+
+        patcher = unittest.mock.patch('util.download_single_tile',
+                                      fake_download)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_same_position_is_downloaded_once(self):
+        downloader = tile_downloader.TileDownloader(
+                self.db_path, self.image_dir, self.key_path)
+        self.assertIsNone(downloader.request(18, 1, 2))
+        self.assertIsNone(downloader.request(18, 1, 2))
+        self.release.set()
+        downloader.wait(5)
+
+        self.assertEqual([(18, 1, 2)], self.calls)
+
+    def test_downloads_are_registered(self):
+        downloader = tile_downloader.TileDownloader(
+                self.db_path, self.image_dir, self.key_path)
+        downloader.request(18, 1, 2)
+        downloader.request(18, 3, 4)
+        self.release.set()
+        downloader.wait(5)
+
+        db = database.Database(self.db_path)
+        with db.transaction('check') as c:
+            self.assertEqual([f'{12}'.rjust(64, 'a')],
+                             database.get_tile_hash(c, 18, 1, 2))
+            self.assertEqual([f'{34}'.rjust(64, 'a')],
+                             database.get_tile_hash(c, 18, 3, 4))
+
+    def test_failed_download_is_retried(self):
+        def failing_download(image_dir, key, z, x, y, retry=True):
+            self.calls.append((z, x, y))
+            raise OSError('disk full')
+
+        downloader = tile_downloader.TileDownloader(
+                self.db_path, self.image_dir, self.key_path)
+        with unittest.mock.patch('util.download_single_tile',
+                                 failing_download), \
+                self.assertLogs('tile_downloader', 'ERROR'):
+            downloader.request(18, 1, 2)
+            downloader.wait(5)
+
+        self.release.set()
+        downloader.request(18, 1, 2)
+        downloader.wait(5)
+        self.assertEqual([(18, 1, 2)] * 2, self.calls)
+
+    def test_broken_and_existing_tiles_are_not_registered(self):
+        self.existing.add((3, 4))
+        self.broken.add((5, 6))
+        downloader = tile_downloader.TileDownloader(
+                self.db_path, self.image_dir, self.key_path)
+        for x, y in [(1, 2), (3, 4), (5, 6)]:
+            downloader.request(18, x, y)
+        self.release.set()
+        with self.assertLogs('fingerprint', 'WARNING'):
+            downloader.wait(5)
+
+        db = database.Database(self.db_path)
+        with db.transaction('check') as c:
+            self.assertEqual([f'{12}'.rjust(64, 'a')],
+                             database.get_tile_hash(c, 18, 1, 2))
+            self.assertEqual([], database.get_tile_hash(c, 18, 3, 4))
+            self.assertEqual([], database.get_tile_hash(c, 18, 5, 6))
@@ -122,3 +122,10 @@ class OverpassTests(unittest.TestCase):
         self.assertEqual(9423996022, first_node['id'])
         self.assertEqual(59.9683487, first_node['lat'])
         self.assertEqual(11.0526654, first_node['lon'])
+
+    def test_deg2tile_array_matches_deg2tile(self):
+        lat = [59.91, -33.86, 0.0, 78.2]
+        lon = [10.75, 151.2, 0.0, -15.6]
+        x, y = util.deg2tile_array(lat, lon, 18)
+        self.assertEqual([util.deg2tile(a, b, 18) for a, b in zip(lat, lon)],
+                         list(zip(x.tolist(), y.tolist())))
@@ -0,0 +1,66 @@
+import pathlib
+import tempfile
+import unittest
+
+import database
+import web
+
+
+class WebTests(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        db_path = pathlib.Path(self._tmp.name) / 'tiles.db'
+        self.tile_hash = 'a' * 64
+
+        db = database.Database(db_path)
+        with db.transaction('populate') as c:
+            database.add_tile_hash(c, 18, 1, 2, self.tile_hash)
+            database.write_score(c, self.tile_hash, 'playground', 0.5, 'm1',
+                                 '2024-01-01T00:00:00')
+
+        app = web.create_app({
+            'DATABASE': str(db_path),
+            'TILE_PATH': self._tmp.name,
+            'FEATURES': ['solar', 'playground'],
+            'DOWNLOAD_MISSING': False,
+            })
+        self.client = app.test_client()
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_first_feature_is_the_default(self):
+        r = self.client.get('/api/review/next_tile')
+        self.assertEqual(204, r.status_code)
+
+    def test_feature_prefix(self):
+        r = self.client.get('/features/playground/api/review/next_tile')
+        self.assertEqual(200, r.status_code)
+        self.assertEqual(self.tile_hash, r.json['tile_hash'])
+
+    def test_unknown_feature(self):
+        r = self.client.get('/features/unknown/api/review/next_tile')
+        self.assertEqual(404, r.status_code)
+
+    def test_missing_tile_without_downloads(self):
+        r = self.client.get('/api/tiles/by-pos/18/5/5.jpeg')
+        self.assertEqual(404, r.status_code)
+
+    def test_positions_must_be_numbers(self):
+        for url in ['/api/tiles/by-pos/18/a/5.jpeg',
+                    '/api/tiles/mosaic/18/5/b.jpeg',
+                    '/api/tiles/overview/z/5/5.jpeg',
+                    '/api/heatmap/solar/max/16/5/x.png']:
+            self.assertEqual(404, self.client.get(url).status_code)
+
+    def test_refresh_review_queue(self):
+        r = self.client.post('/features/playground/api/review/refresh')
+        self.assertEqual(200, r.status_code)
+
+    def test_only_one_worker(self):
+        with self.assertRaises(ValueError):
+            web.create_app({
+                'DATABASE': str(pathlib.Path(self._tmp.name) / 'tiles.db'),
+                'FEATURES': ['solar'],
+                'WORKERS': 4,
+                })
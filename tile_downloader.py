@@ -0,0 +1,151 @@
+import concurrent.futures
+import logging
+import threading
+import time
+
+import requests
+import sqlite3
+
+import database
+import fingerprint
+import util
+
+
+log = logging.getLogger('tile_downloader')
+
+
+class TileDownloader(object):
+    """Downloads missing tiles in the background.
+
+    Only one download is started per position no matter how many times it is
+    requested. Finished downloads are registered in the database in batches,
+    until then they are served from memory.
+    """
+
+    def __init__(self, db_path, image_dir, nib_key_path, workers=4,
+                 batch_size=32, flush_interval=2.0, score_client=None):
+        self._db_path = db_path
+        # Registered tiles are handed to this model_server.Client, if any
+        self._score_client = score_client
+        self._image_dir = image_dir
+        self._nib_api_key = util.load_key(nib_key_path)
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+                workers, thread_name_prefix='tile_downloader')
+        self._lock = threading.Lock()
+        self._in_flight = set()
+        # (z, x, y) -> tile_hash, downloaded but not in the database yet
+        self._pending = {}
+        self._flush_timer = None
+
+    def request(self, z, x, y):
+        """Returns the tile hash if we already have it, otherwise starts a
+        download and returns None"""
+        position = (z, x, y)
+        with self._lock:
+            if position in self._pending:
+                return self._pending[position]
+
+            if position in self._in_flight:
+                return None
+
+            self._in_flight.add(position)
+
+        self._executor.submit(self._download, z, x, y)
+        return None
+
+    def flush(self):
+        with self._lock:
+            tiles = [(z, x, y, tile_hash)
+                     for (z, x, y), tile_hash in self._pending.items()]
+            self._flush_timer = None
+
+        if not tiles:
+            return
+
+        try:
+            db = database.Database(self._db_path)
+            registered, fingerprints, unchanged = fingerprint.compare(
+                    db, self._image_dir, tiles)
+            with db.transaction('add_downloaded_tiles_web') as c:
+                inherited = fingerprint.register(c, registered, fingerprints,
+                                                 unchanged)
+        except sqlite3.OperationalError as e:
+            log.debug('Failed to register downloaded tiles', exc_info=e)
+            self._schedule_flush()
+            return
+        except Exception:
+            # Retrying would fail the same way every time
+            log.exception(f'Failed to register {len(tiles)} downloaded '
+                          f'tiles, dropping them')
+            registered = []
+            inherited = set()
+
+        with self._lock:
+            for z, x, y, tile_hash in tiles:
+                if self._pending.get((z, x, y)) == tile_hash:
+                    del self._pending[(z, x, y)]
+
+        if self._score_client is not None and registered:
+            self._score_client.submit([tile_hash
+                                       for _, _, _, tile_hash in registered
+                                       if tile_hash not in inherited])
+
+    def _download(self, z, x, y):
+        position = (z, x, y)
+        tile_hash = None
+        try:
+            written, tile_hash = util.download_single_tile(
+                    self._image_dir, self._nib_api_key, z, x, y, retry=False)
+            if not written:
+                # Like download_tiles, a file we already have is not a new
+                # tile
+                log.debug(f'No new image at {z}/{x}/{y}')
+                tile_hash = None
+        except (requests.exceptions.ConnectionError, requests.HTTPError) as e:
+            log.debug(f'Failed to download {z}/{x}/{y}', exc_info=e)
+        except Exception:
+            log.exception(f'Failed to download {z}/{x}/{y}')
+        finally:
+            with self._lock:
+                # Failed downloads are forgotten so the next request tries
+                # again
+                self._in_flight.discard(position)
+                if tile_hash is not None:
+                    self._pending[position] = tile_hash
+                pending_count = len(self._pending)
+
+        if tile_hash is None:
+            return
+
+        if pending_count >= self._batch_size:
+            self.flush()
+        else:
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        with self._lock:
+            if self._flush_timer is not None:
+                return
+
+            self._flush_timer = threading.Timer(self._flush_interval,
+                                                self.flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def wait(self, timeout=None):
+        """Waits for outstanding downloads and registers them, for tests and
+        shutdown"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                if not self._in_flight:
+                    break
+
+            if deadline is not None and time.monotonic() > deadline:
+                break
+            time.sleep(0.05)
+
+        self.flush()
@@ -1,5 +1,9 @@
 import argparse
+import sys
 
+import numpy as np
+
+import clustering
 import database
 import util
 
@@ -7,20 +11,39 @@ import util
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--database', default='/mnt/NiB/tiles.db')
+    parser.add_argument('--feature', type=str, default='solar')
+    parser.add_argument('--threshold', type=float, default=0.9)
+    parser.add_argument('--area-feature', type=str, default='solar_area')
+    parser.add_argument('--zoom', type=int, default=18)
+    parser.add_argument('--format', choices=['gpx', 'geojson'],
+                        default='gpx')
     args = parser.parse_args()
 
     db = database.Database(args.database)
-
-    print('<gpx creator="{}" version="1.0">'.format(
-        'https://github.com/zidel/solar_panels'))
-    for z, x, y in db.tiles_with_solar():
-        lat, lon = util.tile2deg(x * 2 + 1, y * 2 + 1, z + 1)
-        print('<wpt lat="{}" lon="{}"></wpt>'.format(
-            lat,
-            lon,
-            ))
-
-    print('</gpx>')
+    with db.transaction('get_positive_tiles') as c:
+        positive = np.array(database.positive_tiles(c,
+                                                    args.feature,
+                                                    args.zoom,
+                                                    args.threshold),
+                            dtype=np.int64).reshape(-1, 2)
+        areas = database.position_scores(c, args.area_feature, args.zoom)
+
+    area_keys = None
+    area_scores = None
+    if areas:
+        area_x, area_y, area_scores = zip(*areas)
+        area_keys = util.pack_positions(area_x, area_y)
+
+    sites = clustering.find_sites(args.zoom,
+                                  positive[:, 0],
+                                  positive[:, 1],
+                                  area_keys,
+                                  area_scores)
+
+    if args.format == 'gpx':
+        clustering.write_gpx(sites, sys.stdout)
+    else:
+        clustering.write_geojson(sites, sys.stdout)
 
 
 if __name__ == '__main__':
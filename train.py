@@ -3,10 +3,14 @@ import datetime
 import logging
 import math
 import pathlib
+import sys
 
+import numpy as np
 import tensorflow as tf
 
+import cascade
 import database
+import evaluation
 import feature
 import model
 import util
@@ -133,11 +137,61 @@ def format_tile_data(image_dir, tiles):
     return result
 
 
+def distillation_data(training_tiles, teacher_tiles, image_dir,
+                      label_weight):
+    """Labelled tiles with their label as target and label_weight as sample
+    weight, followed by (tile_hash, teacher score) tiles with weight 1"""
+    result = []
+    for path, has_feature, rotations, left_right, up_down in training_tiles:
+        result.append((path,
+                       '1.0' if has_feature == 'true' else '0.0',
+                       rotations,
+                       left_right,
+                       up_down,
+                       str(label_weight)))
+
+    for tile_hash, score in teacher_tiles:
+        result.append((str(util.tile_to_paths(image_dir, tile_hash)),
+                       str(score),
+                       '0',  # Rotate
+                       '0',  # Horizontal flip
+                       '0',  # Vertical flip
+                       '1.0'))
+    return result
+
+
+def load_distillation_data(tile_data):
+    nib_data, _ = load_image_data(tile_data)
+    target = tf.strings.to_number(tile_data[1])
+    weight = tf.strings.to_number(tile_data[5])
+    return (nib_data, target, weight)
+
+
+def compare_to_teacher(db, image_dir, feature_name, m, student_version,
+                       teacher_predictions, batch_size):
+    """Scores the validation tiles with the student, returns the student and
+    teacher evaluation reports over the same tiles"""
+    tile_hashes = [tile_hash for tile_hash, _, _ in teacher_predictions]
+    scores = cascade.predict(m, image_dir, tile_hashes, batch_size)
+    with db.transaction('write_validation_predictions') as c:
+        database.write_validation_predictions(
+                c, feature_name, student_version,
+                list(zip(tile_hashes, scores.tolist())))
+
+    labels = [np.nan if label is None else float(label)
+              for _, label, _ in teacher_predictions]
+    teacher_scores = [prediction for _, _, prediction in teacher_predictions]
+    return (evaluation.report(labels, scores),
+            evaluation.report(labels, teacher_scores))
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--database', default='data/tiles.db')
     parser.add_argument('--tile-path', type=str, default='data/images')
     parser.add_argument('--model', type=str, default='VGG19')
+    parser.add_argument('--input-size', type=int, default=256,
+                        help='Scale tiles down to this inside the model')
     parser.add_argument('--load-model', type=str)
     parser.add_argument('--save-to', type=str, default='data/model.hdf5')
     parser.add_argument('--tensorboard', type=str, default=None)
@@ -148,6 +202,17 @@ def main():
     parser.add_argument('--step-count', default=500000, type=int)
     parser.add_argument('--learning-rate', default=1e-4, type=float)
     parser.add_argument('--background-scale', default=1.0, type=float)
+
+    parser.add_argument('--distill-from', type=str,
+                        help='Weights of a teacher model whose stored scores '
+                             'are used as targets for unlabelled tiles')
+    parser.add_argument('--distill-tiles', default=50000, type=int)
+    parser.add_argument('--label-weight', default=4.0, type=float,
+                        help='Sample weight of labelled tiles relative to '
+                             'teacher scored ones')
+    parser.add_argument('--tolerance', default=0.02, type=float,
+                        help='Fail if the average precision of the student '
+                             'is more than this below the teacher')
     args = parser.parse_args()
 
     if args.log:
@@ -173,6 +238,37 @@ def main():
 
     logging.debug('Augmenting training tiles')
     training_tiles = augment_tiles(training_tiles, args.background_scale)
+
+    load_training_data = load_image_data
+    if args.distill_from:
+        teacher_version = util.model_version(args.distill_from)
+        with db.transaction('get_tiles_for_distillation') as c:
+            teacher_tiles = database.distillation_tiles(c,
+                                                        args.feature,
+                                                        teacher_version,
+                                                        args.distill_tiles)
+            teacher_predictions = database.validation_predictions(
+                    c, args.feature, teacher_version)
+        if not teacher_tiles:
+            raise RuntimeError(
+                    'No tiles scored by {}, run score_tiles with it '
+                    'first'.format(args.distill_from))
+        if any(prediction is None
+               for _, _, prediction in teacher_predictions):
+            raise RuntimeError(
+                    'Validation tiles not scored by {}, run '
+                    'confusion_matrix with it first'.format(
+                        args.distill_from))
+
+        print('Distilling from {} tiles scored by {}'.format(
+            len(teacher_tiles),
+            args.distill_from))
+        training_tiles = distillation_data(training_tiles,
+                                           teacher_tiles,
+                                           image_dir,
+                                           args.label_weight)
+        load_training_data = load_distillation_data
+
     print('Training with {} tiles, validating with {}'.format(
         len(training_tiles),
         len(validation_tiles),
@@ -190,7 +286,8 @@ def main():
 
     dataset = tf.data.Dataset.from_tensor_slices(training_tiles)
     dataset = dataset.shuffle(input_images)
-    dataset = dataset.map(load_image_data, num_parallel_calls=tf.data.AUTOTUNE)
+    dataset = dataset.map(load_training_data,
+                          num_parallel_calls=tf.data.AUTOTUNE)
     dataset = dataset.batch(args.batch_size)
     dataset = dataset.repeat()
 
@@ -205,7 +302,9 @@ def main():
     m = model.get(args.model,
                   feature.result_type(args.feature),
                   args.load_model,
-                  args.learning_rate)
+                  args.learning_rate,
+                  args.input_size)
+    print('{} has {} parameters'.format(args.model, m.count_params()))
 
     if args.tensorboard is None:
         tensorboard_name = '{}'.format(datetime.datetime.now())
@@ -232,6 +331,25 @@ def main():
           )
     m.save(args.save_to, save_format='h5')
 
+    if args.distill_from:
+        student, teacher = compare_to_teacher(db,
+                                              image_dir,
+                                              args.feature,
+                                              m,
+                                              util.hash_file(args.save_to),
+                                              teacher_predictions,
+                                              args.batch_size)
+        print('Average precision {:.3f}, teacher {:.3f}'.format(
+            student['average_precision'],
+            teacher['average_precision']))
+        if student['average_precision'] \
+                < teacher['average_precision'] - args.tolerance:
+            print('Student is more than {} below the teacher'.format(
+                args.tolerance))
+            return 1
+
+    return 0
+
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -2,8 +2,10 @@ import hashlib
 import json
 import logging
 import math
+import pathlib
 import time
 
+import numpy as np
 import requests
 
 
@@ -15,6 +17,16 @@ def deg2tile(lat_deg, lon_deg, zoom):
     return (xtile, ytile)
 
 
+def deg2tile_array(lat_deg, lon_deg, zoom):
+    """deg2tile for arrays of coordinates"""
+    lat_rad = np.radians(lat_deg)
+    n = 2.0 ** zoom
+    xtile = ((np.asarray(lon_deg) + 180.0) / 360.0 * n).astype(np.int64)
+    ytile = ((1.0 - np.arcsinh(np.tan(lat_rad)) / np.pi) / 2.0 * n
+             ).astype(np.int64)
+    return (xtile, ytile)
+
+
 def tile2deg(x, y, z):
     n = 2.0 ** z
     lon_deg = x / n * 360.0 - 180.0
@@ -23,6 +35,16 @@ def tile2deg(x, y, z):
     return (lat_deg, lon_deg)
 
 
+def pack_positions(x, y):
+    """Packs tile coordinates into one int64 per tile, ordered by x then y"""
+    return (np.asarray(x, dtype=np.int64) << 32) | np.asarray(y,
+                                                              dtype=np.int64)
+
+
+def unpack_positions(keys):
+    return keys >> 32, keys & 0xffffffff
+
+
 def decode_geo(raw_geo):
     if raw_geo.startswith('POLYGON'):
         corners = raw_geo.split('(')[2].split(')')[0].split(',')
@@ -39,6 +61,16 @@ def decode_geo(raw_geo):
             }
 
 
+def model_version(path):
+    """Version of a weights file, or of a model from export_model.py as
+    recorded in its metadata"""
+    metadata_path = pathlib.Path(path) / 'metadata.json'
+    if metadata_path.is_file():
+        with open(metadata_path) as f:
+            return json.load(f)['version']
+    return hash_file(path)
+
+
 def hash_file(path):
     h = hashlib.sha256()
     with open(path, 'rb') as f:
@@ -1,47 +1,196 @@
 import argparse
 import datetime
+import hashlib
 import logging
 import pathlib
-import random
+import re
 
 import flask
 import sqlite3
 
 import database
+import feature
+import model_server
+import mosaic
+import review_queue
+import tile_downloader
 import util
 
 
-db_path = None
-nib_key_path = None
-tile_path = None
-feature_name = None
-
-
-app = flask.Flask(__name__, static_url_path='')
-
-
-@app.route("/")
+web_dir = pathlib.Path(__file__).parent / 'web'
+
+default_config = {
+        'DATABASE': 'data/tiles.db',
+        'NIB_KEY': 'secret/NiB_key.json',
+        'TILE_PATH': 'data/images',
+        'HEATMAP_PATH': 'data/heatmap',
+        'OVERVIEW_PATH': 'data/overviews',
+        # The first feature is served without a /features/<name> prefix
+        'FEATURES': [],
+        'DOWNLOAD_MISSING': True,
+        # URL of a model_server.py to score downloaded tiles right away
+        'MODEL_SERVER': None,
+        'MOSAIC_CACHE_BYTES': 64 * 1024 * 1024,
+        'SEND_FILE_MAX_AGE_DEFAULT': 60 * 60,
+        # Server processes, set to the same as gunicorn --workers. The review
+        # queues and their leases are kept in memory, so only one works
+        'WORKERS': 1,
+        }
+
+prefetch_count = 3
+mosaic_max_age = 60
+heatmap_max_age = 5 * 60
+immutable_max_age = 365 * 24 * 60 * 60
+placeholder_tile = '''<svg xmlns="http://www.w3.org/2000/svg"
+                           width="256" height="256">
+                        <rect width="256" height="256" fill="#808080"/>
+                      </svg>'''
+
+
+review_api = flask.Blueprint('review', __name__)
+tile_api = flask.Blueprint('tiles', __name__)
+
+
+class State(object):
+    """Everything a worker keeps in memory between requests.
+
+    Each worker process gets its own copy, so review queue leases are only
+    shared between threads in the same process.
+    """
+
+    def __init__(self, config):
+        self.db_path = pathlib.Path(config['DATABASE'])
+        self.tile_path = pathlib.Path(config['TILE_PATH'])
+        self.heatmap_path = pathlib.Path(config['HEATMAP_PATH'])
+        self.overview_path = pathlib.Path(config['OVERVIEW_PATH'])
+        self.queues = {feature_name: review_queue.ReviewQueue(self.db_path,
+                                                              feature_name)
+                       for feature_name in config['FEATURES']}
+        self.mosaics = mosaic.MosaicCache(
+                self.tile_path,
+                max_bytes=config['MOSAIC_CACHE_BYTES'])
+
+        self.downloader = None
+        if config['DOWNLOAD_MISSING']:
+            score_client = None
+            if config['MODEL_SERVER']:
+                score_client = model_server.Client(config['MODEL_SERVER'])
+            self.downloader = tile_downloader.TileDownloader(
+                    self.db_path,
+                    self.tile_path,
+                    pathlib.Path(config['NIB_KEY']),
+                    score_client=score_client)
+
+    def database(self):
+        return database.Database(self.db_path)
+
+
+def state():
+    return flask.current_app.extensions['solar_panels']
+
+
+def create_app(config=None):
+    """Application factory for WSGI servers, for example
+
+        SOLAR_PANELS_FEATURES=solar,playground \\
+            gunicorn --threads 8 'web:create_app()'
+
+    Configuration is read from SOLAR_PANELS_* environment variables, then
+    from the file named by SOLAR_PANELS_CONFIG if set, then from config.
+
+    Only a single worker process is supported, since the review queues,
+    their leases and the answered tiles are kept in memory. Use threads to
+    serve more requests.
+    """
+    app = flask.Flask(__name__,
+                      static_folder=web_dir / 'static',
+                      static_url_path='/static')
+    app.config.update(default_config)
+    app.config.from_prefixed_env('SOLAR_PANELS')
+    app.config.from_envvar('SOLAR_PANELS_CONFIG', silent=True)
+    if config:
+        app.config.update(config)
+
+    features = app.config['FEATURES']
+    if isinstance(features, str):
+        features = [name for name in features.split(',') if name]
+    if not features:
+        raise ValueError('No features configured')
+    for feature_name in features:
+        feature.result_type(feature_name)
+    app.config['FEATURES'] = features
+    if int(app.config['WORKERS']) != 1:
+        raise ValueError('Review queues are kept in memory, so only one '
+                         f'worker is supported, not {app.config["WORKERS"]}')
+
+    app.extensions['solar_panels'] = State(app.config)
+
+    app.register_blueprint(review_api)
+    app.register_blueprint(review_api,
+                           name='feature_review',
+                           url_prefix='/features/<feature_name>')
+    app.register_blueprint(tile_api)
+    return app
+
+
+@review_api.url_value_preprocessor
+def pick_feature(endpoint, values):
+    features = flask.current_app.config['FEATURES']
+    feature_name = (values or {}).pop('feature_name', features[0])
+    if feature_name not in features:
+        flask.abort(404)
+
+    flask.g.feature_name = feature_name
+    flask.g.tile_queue = state().queues[feature_name]
+
+
+@review_api.route("/")
 def send_index():
-    return flask.send_from_directory('web', 'index.html')
+    # Relative API paths in the page resolve to this feature
+    return flask.send_from_directory(web_dir, 'index.html', max_age=0)
 
 
-@app.route('/static/script.js')
-def send_script():
-    return flask.send_from_directory('web/static', 'script.js')
+def neighbourhood(cursor, z, x, y):
+    tiles = sorted((tile for tile in database.neighbourhood_tiles(cursor,
+                                                                  z, x, y)
+                    if tile[2] is not None),
+                   key=lambda tile: tile[3])
+    # The newest tile at each position wins
+    hashes = {(tile_x, tile_y): tile_hash
+              for tile_x, tile_y, tile_hash, _ in tiles}
+    return [[hashes.get((neighbour_x, neighbour_y))
+             for neighbour_x in [x - 1, x, x + 1]]
+            for neighbour_y in [y - 1, y, y + 1]]
 
 
-@app.route('/api/review/next_tile')
+@review_api.route('/api/review/next_tile')
 def get_next_tile_for_review():
-    db = database.Database(db_path)
-    tiles = db.tiles_for_review(feature_name, limit=1)
-    if not tiles:
+    tile_queue = flask.g.tile_queue
+    tile = tile_queue.next_tile()
+    if tile is None:
         return '', 204
 
-    tile_hash, z, x, y, score, model_version = list(tiles)[0]
+    tile_hash, z, x, y, score, model_version = tile
 
     top, left = util.tile2deg(x, y, z)
     bottom, right = util.tile2deg(x + 1, y + 1, z)
 
+    db = state().database()
+    with db.transaction('get_review_neighbourhoods') as c:
+        neighbours = neighbourhood(c, z, x, y)
+        upcoming = [(next_z, next_x, next_y, next_hash,
+                     neighbourhood(c, next_z, next_x, next_y))
+                    for next_hash, next_z, next_x, next_y, _, _
+                    in tile_queue.peek(prefetch_count)]
+
+    # Show the tile we are asking about, even if there is a newer one
+    neighbours[1][1] = tile_hash
+    for _, _, _, next_hash, next_neighbours in upcoming:
+        next_neighbours[1][1] = next_hash
+
+    state().mosaics.prerender([next_neighbours
+                               for _, _, _, _, next_neighbours in upcoming])
+
     return {
             'tile_hash': tile_hash,
             'z': z,
@@ -53,24 +202,32 @@ def get_next_tile_for_review():
             'left': left,
             'bottom': bottom,
             'right': right,
+            'neighbours': neighbours,
+            'mosaic': mosaic_url(z, x, y, tile_hash),
+            'prefetch': [mosaic_url(*upcoming_tile[:4])
+                         for upcoming_tile in upcoming],
             }
 
 
-def score_neighbours(cursor, own_hash):
+def mosaic_url(z, x, y, tile_hash):
+    return f'/api/tiles/mosaic/{z}/{x}/{y}.jpeg?centre={tile_hash}'
+
+
+def score_neighbours(cursor, own_hash, feature_name):
     now = datetime.datetime.now().isoformat()
     z, own_x, own_y = database.get_tile_pos(cursor, own_hash)
-    for neighbour_x in [own_x - 1, own_x, own_x + 1]:
-        for neighbour_y in [own_y - 1, own_y, own_y + 1]:
-            for neighbour_hash in database.get_tile_hash(cursor,
-                                                         z,
-                                                         neighbour_x,
-                                                         neighbour_y):
-                database.write_score(cursor,
-                                     neighbour_hash,
-                                     feature_name,
-                                     1.0,
-                                     'neighbour',
-                                     now)
+    for _, _, neighbour_hash, _ in database.neighbourhood_tiles(cursor, z,
+                                                                own_x,
+                                                                own_y):
+        if neighbour_hash is None:
+            continue
+
+        database.write_score(cursor,
+                             neighbour_hash,
+                             feature_name,
+                             1.0,
+                             'neighbour',
+                             now)
 
 
 def _write_ground_truth(tile_hash, feature_name, response, cursor):
@@ -82,7 +239,7 @@ def _write_ground_truth(tile_hash, feature_name, response, cursor):
                                 predicted_score)
     elif response == 'true':
         database.set_has_feature(cursor, tile_hash, feature_name, True)
-        score_neighbours(cursor, tile_hash)
+        score_neighbours(cursor, tile_hash, feature_name)
     elif response == 'false':
         if feature_name == 'solar_area':
             database.set_true_score(cursor, tile_hash, feature_name, 0.0)
@@ -94,8 +251,9 @@ def _write_ground_truth(tile_hash, feature_name, response, cursor):
         raise ValueError
 
 
-@app.route('/api/review/response', methods=['POST'])
+@review_api.route('/api/review/response', methods=['POST'])
 def accept_tile_response():
+    feature_name = flask.g.feature_name
     body = flask.request.json
     tile_hash = body['tile_hash']
     response = body['response']
@@ -106,7 +264,7 @@ def accept_tile_response():
     if feature_name == 'solar_area' and response == 'true':
         return 'Can\'t use "true" with solar_area', 400
 
-    db = database.Database(db_path)
+    db = state().database()
     while True:
         try:
             with db.transaction('write_ground_truth') as c:
@@ -119,72 +277,190 @@ def accept_tile_response():
             print(e)
             continue
 
+    if response == 'true':
+        # Neighbours were tagged for review, which changes what to show next
+        flask.g.tile_queue.invalidate()
+    else:
+        flask.g.tile_queue.answered(tile_hash)
+
     return {}
 
 
-@app.route('/api/review/surrounding', methods=['POST'])
+@review_api.route('/api/review/surrounding', methods=['POST'])
 def review_surrounding_tiles():
     body = flask.request.json
     tile_hash = body['tile_hash']
 
-    db = database.Database(db_path)
+    db = state().database()
     while True:
         try:
             with db.transaction('tag_neighbours_for_scoring') as c:
-                score_neighbours(c, tile_hash)
+                score_neighbours(c, tile_hash, flask.g.feature_name)
             break
         except sqlite3.OperationalError:
             continue
 
+    flask.g.tile_queue.invalidate()
     return {}
 
 
-@app.route('/api/tiles/by-hash/<tile_hash>.jpeg')
+@review_api.route('/api/review/refresh', methods=['POST'])
+def refresh_review_queue():
+    """Called by pipeline.py when new scores change what to review"""
+    flask.g.tile_queue.invalidate()
+    return {}
+
+
+@tile_api.route('/api/tiles/by-hash/<tile_hash>.jpeg')
 def get_tile_by_hash(tile_hash):
-    dir_name = tile_hash[:2]
-    file_name = tile_hash[2:]
+    # Tiles are content addressed, so the hash is all the validation needed
+    if tile_hash in flask.request.if_none_match:
+        response = flask.Response(status=304)
+    else:
+        dir_name = tile_hash[:2]
+        file_name = tile_hash[2:]
+        response = flask.send_from_directory(
+                state().tile_path,
+                '{}/{}.jpeg'.format(dir_name, file_name),
+                etag=False,
+                conditional=False,
+                max_age=immutable_max_age)
+
+    response.set_etag(tile_hash)
+    response.cache_control.public = True
+    response.cache_control.max_age = immutable_max_age
+    response.cache_control.immutable = True
+    return response
+
+
+@tile_api.route('/map')
+def send_map():
+    return flask.send_from_directory(web_dir, 'map.html', max_age=0)
+
+
+@tile_api.route('/api/heatmap/<feature_name>/<statistic>/'
+                '<int:z>/<int:x>/<int:y>.png')
+def get_heatmap_tile(feature_name, statistic, z, x, y):
+    if feature_name not in flask.current_app.config['FEATURES']:
+        return '', 404
+
     return flask.send_from_directory(
-            tile_path,
-            '{}/{}.jpeg'.format(dir_name, file_name))
+            state().heatmap_path,
+            f'{feature_name}/{statistic}/{z}/{x}/{y}.png',
+            max_age=heatmap_max_age)
 
 
-@app.route('/api/tiles/by-pos/<z>/<x>/<y>.jpeg')
-def get_nib_tile(z, x, y):
-    z = int(z)
-    x = int(x)
-    y = int(y)
+@tile_api.route('/api/tiles/overview/<int:z>/<int:x>/<int:y>.jpeg')
+def get_overview_tile(z, x, y):
+    db = state().database()
+    with db.transaction('get_overview_tile') as cursor:
+        tile_hash = database.get_overview_tile(cursor, z, x, y)
+
+    if tile_hash is None:
+        return '', 404
 
-    db = database.Database(db_path)
+    if tile_hash in flask.request.if_none_match:
+        response = flask.Response(status=304)
+    else:
+        response = flask.send_file(
+                util.tile_to_paths(state().overview_path, tile_hash),
+                etag=False,
+                conditional=False)
+
+    # Rebuilds change the tile at a position, so revalidate
+    response.set_etag(tile_hash)
+    response.cache_control.no_cache = True
+    return response
+
+
+def request_download(z, x, y):
+    downloader = state().downloader
+    if downloader is None:
+        return None
+
+    return downloader.request(z, x, y)
+
+
+@tile_api.route('/api/tiles/mosaic/<int:z>/<int:x>/<int:y>.jpeg')
+def get_mosaic(z, x, y):
+    db = state().database()
+    with db.transaction('get_mosaic_neighbourhood') as cursor:
+        neighbours = neighbourhood(cursor, z, x, y)
+
+    centre = flask.request.args.get('centre')
+    if centre is not None:
+        if not re.fullmatch('[0-9a-f]{64}', centre):
+            return 'Bad "centre" value', 400
+        neighbours[1][1] = centre
+
+    for row, hashes in enumerate(neighbours):
+        for column, tile_hash in enumerate(hashes):
+            if tile_hash is None:
+                request_download(z, x + column - 1, y + row - 1)
+
+    mosaics = state().mosaics
+    etag = hashlib.sha256(
+            ','.join([str(h) for h in mosaics.key(neighbours)]).encode()
+            ).hexdigest()
+    if etag in flask.request.if_none_match:
+        response = flask.Response(status=304)
+    else:
+        response = flask.Response(mosaics.get(neighbours),
+                                  mimetype='image/jpeg')
+
+    response.set_etag(etag)
+    response.cache_control.max_age = mosaic_max_age
+    return response
+
+
+@tile_api.route('/api/tiles/by-pos/<int:z>/<int:x>/<int:y>.jpeg')
+def get_nib_tile(z, x, y):
+    db = state().database()
     with db.transaction('get_tile_hashes_from_position') as cursor:
-        tiles = database.get_tile_hash(cursor, z, x, y)
+        tiles = database.latest_tile_hashes(cursor, z, x, y, x, y)
 
     if tiles:
-        tile_hash = random.choice(tiles)
+        tile_hash = tiles[(x, y)]
+    elif state().downloader is None:
+        return '', 404
     else:
-        print(f'No tiles found for {z}/{x}/{y}, trying to download')
-        nib_api_key = util.load_key(nib_key_path)
-        written, tile_hash = util.download_single_tile(
-                tile_path, nib_api_key, z, x, y)
-        if written:
-            with db.transaction('add_downloaded_tile_web_by_pos') as cursor:
-                database.add_tile_hash(cursor, z, x, y, tile_hash)
+        tile_hash = request_download(z, x, y)
+
+    if tile_hash is None:
+        response = flask.Response(placeholder_tile,
+                                  status=202,
+                                  mimetype='image/svg+xml')
+        response.headers['Retry-After'] = '2'
+        response.cache_control.no_store = True
+        return response
 
     return flask.redirect(f'/api/tiles/by-hash/{tile_hash}.jpeg', code=307)
 
 
-if __name__ == '__main__':
+def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--database', default='data/tiles.db')
     parser.add_argument('--NiB-key', type=str, default='secret/NiB_key.json')
     parser.add_argument('--tile-path', type=str, default='data/images')
-    parser.add_argument('--feature', type=str, required=True)
+    parser.add_argument('--feature', type=str, action='append',
+                        required=True)
+    parser.add_argument('--host', type=str, default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--model-server', type=str,
+                        help='Score downloaded tiles with this model server')
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.DEBUG)
 
-    db_path = pathlib.Path(args.database)
-    nib_key_path = pathlib.Path(args.NiB_key)
-    tile_path = pathlib.Path(args.tile_path)
-    feature_name = args.feature
+    app = create_app({
+        'DATABASE': args.database,
+        'NIB_KEY': args.NiB_key,
+        'TILE_PATH': args.tile_path,
+        'FEATURES': args.feature,
+        'MODEL_SERVER': args.model_server,
+        })
+    app.run(args.host, args.port, threaded=True)
 
-    app.run('0.0.0.0', 5000)
+
+if __name__ == '__main__':
+    main()
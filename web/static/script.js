@@ -24,20 +24,46 @@ function update_current_tile(tile)
     document.getElementById('tile_y').textContent = `${y}`;
     document.getElementById('tile_bbox').textContent = `${bbox_top},${bbox_left},${bbox_bottom},${bbox_right}`;
 
-    document.getElementById('review_tile').src = `/api/tiles/by-hash/${tile_hash}.jpeg`;
     document.getElementById('review_score').textContent = `${score}`
     document.getElementById('model_version').textContent = `${model_version}`
 
-    document.getElementById('context_00').src = `/api/tiles/by-pos/${z}/${x - 1}/${y - 1}.jpeg`;
-    document.getElementById('context_01').src = `/api/tiles/by-pos/${z}/${x + 0}/${y - 1}.jpeg`;
-    document.getElementById('context_02').src = `/api/tiles/by-pos/${z}/${x + 1}/${y - 1}.jpeg`;
+    document.getElementById('review_mosaic').src = tile['mosaic'];
 
-    document.getElementById('context_10').src = `/api/tiles/by-pos/${z}/${x - 1}/${y + 0}.jpeg`;
-    document.getElementById('context_12').src = `/api/tiles/by-pos/${z}/${x + 1}/${y + 0}.jpeg`;
+    missing = tile['neighbours'].flat().some((h) => h === null);
+    if (missing) {
+        // The server is downloading the missing neighbours, show them when
+        // they arrive
+        reload_mosaic(tile_hash, tile['mosaic'], 5);
+    }
+
+    prefetch_mosaics(tile['prefetch']);
+}
 
-    document.getElementById('context_20').src = `/api/tiles/by-pos/${z}/${x - 1}/${y + 1}.jpeg`;
-    document.getElementById('context_21').src = `/api/tiles/by-pos/${z}/${x + 0}/${y + 1}.jpeg`;
-    document.getElementById('context_22').src = `/api/tiles/by-pos/${z}/${x + 1}/${y + 1}.jpeg`;
+function reload_mosaic(for_tile, url, attempts)
+{
+    setTimeout(function () {
+        if (current_tile()['tile_hash'] != for_tile) {
+            // The reviewer has moved on
+            return;
+        }
+
+        document.getElementById('review_mosaic').src = `${url}&attempt=${attempts}`;
+        if (attempts > 1) {
+            reload_mosaic(for_tile, url, attempts - 1);
+        }
+    }, 2000);
+}
+
+var prefetched = [];
+
+function prefetch_mosaics(urls)
+{
+    // Keep references so the browser doesn't drop the requests
+    prefetched = urls.map(function (url) {
+        image = new Image();
+        image.src = url;
+        return image;
+    });
 }
 
 function get_next_to_check()
@@ -48,7 +74,7 @@ function get_next_to_check()
     document.getElementById('tile_y').textContent = "";
     document.getElementById('tile_bbox').textContent = "";
 
-    fetch("/api/review/next_tile")
+    fetch("api/review/next_tile")
         .then(function (response) {
             if (response.status == 200) {
                 response.json().then(update_current_tile)
@@ -115,7 +141,7 @@ function submit_result(result)
         'response': result,
     }
 
-    fetch('/api/review/response', {
+    fetch('api/review/response', {
         method: 'POST',
         headers: {
             'Content-Type': 'application/json'
@@ -133,7 +159,7 @@ function review_surrounding_tiles()
         'tile_hash': tile['tile_hash'],
     }
 
-    fetch('/api/review/surrounding', {
+    fetch('api/review/surrounding', {
         method: 'POST',
         headers: {
             'Content-Type': 'application/json'